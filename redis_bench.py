@@ -0,0 +1,540 @@
+#coding:utf-8
+"""
+性能基准：AsyncRedis.invoke的吞吐及延迟，编码、解析函数的微基准
+
+python -m ioloop_redis.redis_bench -o bench.json            #进程内的模拟redis
+python -m ioloop_redis.redis_bench --subprocess             #模拟redis运行在子进程中
+python -m ioloop_redis.redis_bench --server 127.0.0.1:6379  #真实redis，会写入bench:*的key
+python -m ioloop_redis.redis_bench --processes 1 2 4        #多进程扩展性，模拟redis同样以多进程运行
+
+结果为json，用于对比不同版本的性能变化
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import signal
+import json
+import socket
+import argparse
+import platform
+import subprocess
+import tornado
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, cpu_count
+from tornado.iostream import StreamClosedError
+from .redis_client import AsyncRedis
+from .redis_encode import _encode_req, redis_get, redis_set, redis_lrange
+from .redis_resp import RespReader, HiredisReader, RawReply, decode_redis_resp, decode_resp_ondemand, decode_raw, \
+    hiredis
+from .redis_error import ResponseError
+
+
+#应答形态 --> 模拟redis对GET, LRANGE的应答
+REPLY_SHAPES = {
+    'small': 'v' * 16,
+    'bulk_16k': 'v' * 16384,
+    'array_100': tuple('item%d' % _ for _ in xrange(100)),
+}
+
+
+def _encode_reply(value):
+    if value is None:
+        return '$-1\r\n'
+    if isinstance(value, tuple):
+        return ''.join(['*%d\r\n' % len(value)] + [_encode_reply(_) for _ in value])
+    if isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+
+class FakeRedis(TCPServer):
+    """
+    只实现基准需要的指令：读指令按当前应答形态返回，写指令返回+OK，支持MULTI/EXEC
+    请求用RespReader解析，与客户端共用同一实现
+    """
+    def __init__(self, shape='small', **kwargs):
+        TCPServer.__init__(self, **kwargs)
+        self.set_shape(shape)
+
+    def set_shape(self, shape):
+        self.__reply = _encode_reply(REPLY_SHAPES[shape])
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        reader = RespReader()
+        #MULTI后排队的应答
+        queued = None
+        try:
+            while True:
+                reader.feed((yield stream.read_bytes(65536, partial=True)))
+                out = []
+                while True:
+                    ok, req = reader.gets()
+                    if not ok:
+                        break
+                    name = req[0].upper()
+                    if 'MULTI' == name:
+                        queued = []
+                        out.append('+OK\r\n')
+                    elif 'EXEC' == name:
+                        out.append('*%d\r\n' % len(queued))
+                        out.extend(queued)
+                        queued = None
+                    else:
+                        reply = self.__reply if name in ('GET', 'LRANGE', 'HGET') else \
+                            '+PONG\r\n' if 'PING' == name else '+OK\r\n'
+                        if queued is None:
+                            out.append(reply)
+                        else:
+                            queued.append(reply)
+                            out.append('+QUEUED\r\n')
+                if out:
+                    stream.write(''.join(out))
+        except StreamClosedError:
+            pass
+
+
+def _listen(server, port=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(1024)
+    sock.setblocking(0)
+    server.add_sockets([sock])
+    return sock.getsockname()[1]
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+@gen.coroutine
+def bench_invoke(client, shape, concurrency, pipeline, requests):
+    """
+    concurrency个协程各自循环invoke，每次包含pipeline条指令，共requests次invoke
+
+    :return: 每秒指令数及invoke延迟(毫秒)
+    """
+    cmd = redis_lrange('bench:list', 0, -1) if shape.startswith('array') else redis_get('bench:key')
+    cmds = [cmd] * pipeline
+    latencies = []
+    remain = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remain[0] > 0:
+            remain[0] -= 1
+            start = time.time()
+            yield client.invoke(cmds, active_trans=False)
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in xrange(concurrency)]
+    elapsed = time.time() - start
+    latencies.sort()
+    raise gen.Return({
+        'shape': shape,
+        'concurrency': concurrency,
+        'pipeline': pipeline,
+        'requests': requests,
+        'seconds': elapsed,
+        'cmds_per_sec': requests * pipeline / elapsed,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+    })
+
+
+def _read_all(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(fd)
+    return ''.join(chunks)
+
+
+def bench_processes(addr, processes, shape, concurrency, pipeline, requests, auto_pipeline=False):
+    """
+    fork出processes个子进程，共用fork前已建立连接的AsyncRedis对象，各自在新的IOLoop上运行bench_invoke，
+    全部就绪后同时开始
+
+    :return: 汇总的每秒指令数，wall为最早开始到最晚结束的秒数
+    """
+    client = AsyncRedis(redis_tuple=(addr[0], addr[1], 0, None), auto_pipeline=auto_pipeline)
+    #父进程先建立连接，子进程应检测到fork并重建自己的连接
+    IOLoop.current().run_sync(lambda: client.invoke([redis_get('bench:key')], active_trans=False))
+    go_r, go_w = os.pipe()
+    children = []
+    for _ in xrange(processes):
+        ready_r, ready_w = os.pipe()
+        out_r, out_w = os.pipe()
+        pid = os.fork()
+        if 0 == pid:
+            code = 1
+            try:
+                os.close(out_r)
+                os.close(ready_r)
+                os.close(go_w)
+                io_loop = IOLoop()
+                io_loop.make_current()
+                io_loop.run_sync(lambda: client.invoke([redis_get('bench:key')], active_trans=False))
+                os.write(ready_w, 'r')
+                os.close(ready_w)
+                os.read(go_r, 1)
+                start = time.time()
+                result = io_loop.run_sync(lambda: bench_invoke(client, shape, concurrency, pipeline, requests))
+                result['start'] = start
+                os.write(out_w, json.dumps(result))
+                code = 0
+            finally:
+                os._exit(code)
+        os.close(ready_w)
+        os.close(out_w)
+        children.append((pid, ready_r, out_r))
+    for _, ready_r, _ in children:
+        _read_all(ready_r)
+    os.write(go_w, 'g' * processes)
+    os.close(go_w)
+    os.close(go_r)
+
+    results = []
+    for pid, _, out_r in children:
+        data = _read_all(out_r)
+        _, status = os.waitpid(pid, 0)
+        if status or not data:
+            raise RuntimeError('bench process {0} failed, status {1}'.format(pid, status))
+        results.append(json.loads(data))
+    client.close()
+
+    wall = max(_['start'] + _['seconds'] for _ in results) - min(_['start'] for _ in results)
+    return {
+        'processes': processes,
+        'shape': shape,
+        'concurrency': concurrency,
+        'pipeline': pipeline,
+        'requests': requests * processes,
+        'seconds': wall,
+        'cmds_per_sec': requests * pipeline * processes / wall,
+        'per_process_cmds_per_sec': [_['cmds_per_sec'] for _ in results],
+        'p99_ms': max(_['p99_ms'] for _ in results),
+    }
+
+
+def run_processes(args, addr):
+    """
+    扩展效率scaling = N进程吞吐 / (N * 单进程吞吐)，线性扩展时接近1.0
+    """
+    results = []
+    base = None
+    for processes in args.processes:
+        result = bench_processes(addr, processes, args.shapes[0], args.concurrency[-1], args.pipeline[0],
+                                 args.requests, args.auto_pipeline)
+        if 1 == processes:
+            base = result['cmds_per_sec']
+        result['scaling'] = result['cmds_per_sec'] / (processes * base) if base else None
+        results.append(result)
+        sys.stderr.write('processes={processes:<3} {cmds_per_sec:>10.0f} cmd/s scaling={scaling}\n'.format(**result))
+    return results
+
+
+def _timeit(func, min_seconds=0.1):
+    """
+    :return: 单次调用的平均微秒数
+    """
+    count = 0
+    batch = 1
+    start = time.time()
+    while True:
+        for _ in xrange(batch):
+            func()
+        count += batch
+        elapsed = time.time() - start
+        if elapsed >= min_seconds:
+            return elapsed / count * 1e6
+        batch = min(batch * 2, 1000)
+
+
+def _fragments(s, size):
+    return [s[i: i + size] for i in xrange(0, len(s), size)]
+
+
+def _reader_parse(reader_cls, chunks):
+    reader = reader_cls()
+    replies = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        while True:
+            ok, reply = reader.gets()
+            if not ok:
+                break
+            replies.append(reply)
+    return replies
+
+
+def _raw_parse(chunks):
+    """
+    每条聚合及bulk应答都以RawReply截取，再由decode_raw解析
+    """
+    reader = RespReader()
+    reader.set_raw(0, 0)
+    replies = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        while True:
+            ok, reply = reader.gets()
+            if not ok:
+                break
+            replies.append(decode_raw(reply, reader_cls=RespReader) if isinstance(reply, RawReply) else reply)
+            reader.set_raw(0, 0)
+    return replies
+
+
+def _ondemand_parse(chunks, cmd_count):
+    """
+    改用RespReader之前客户端的做法：每收到一段数据，拼接后从头解析
+    """
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        ok, p, remain = decode_resp_ondemand(buf, 0, False, cmd_count)
+        if ok:
+            return p
+
+
+def _corpus():
+    """
+    :return: 名称 --> (应答buf, 应答个数)
+    """
+    big_array = tuple('member:%d' % _ for _ in xrange(1000))
+    return {
+        'ok_x100': ('+OK\r\n' * 100, 100),
+        'int_x100': (''.join(':%d\r\n' % _ for _ in xrange(100)), 100),
+        'bulk_1m': (_encode_reply('x' * (1024 * 1024)), 1),
+        'array_1000': (_encode_reply(big_array), 1),
+        'nested': (_encode_reply(tuple((str(i), big_array[:10]) for i in xrange(100))), 1),
+        'nil_error_mix': ('$-1\r\n-ERR x\r\n$3\r\nabc\r\n' * 50, 150),
+    }
+
+
+def bench_micro(fragment_sizes=(64, 4096)):
+    results = []
+
+    def add(name, case, usec):
+        results.append({'name': name, 'case': case, 'usec': usec})
+
+    small = 'v' * 16
+    big = 'v' * 16384
+    add('_encode_req', 'SET small', _timeit(lambda: _encode_req('SET', 'bench:key', small)))
+    add('_encode_req', 'SET 16k', _timeit(lambda: _encode_req('SET', 'bench:key', big)))
+    add('_encode_req', 'MSET 100', _timeit(lambda: _encode_req('MSET', *(['k', small] * 50))))
+
+    readers = [('RespReader', RespReader)]
+    if hiredis is not None:
+        readers.append(('HiredisReader', HiredisReader))
+    for case, (buf, count) in sorted(_corpus().iteritems()):
+        add('decode_redis_resp', case, _timeit(lambda: decode_redis_resp(buf, count)))
+        add('decode_resp_ondemand', case, _timeit(lambda: decode_resp_ondemand(buf, 0, False, count)))
+        for name, reader_cls in readers:
+            add(name, case, _timeit(lambda: _reader_parse(reader_cls, [buf])))
+        for size in fragment_sizes:
+            chunks = _fragments(buf, size)
+            frag_case = '{0} /{1}B'.format(case, size)
+            if len(chunks) <= 200:
+                add('decode_resp_ondemand', frag_case, _timeit(lambda: _ondemand_parse(chunks, count)))
+            for name, reader_cls in readers:
+                add(name, frag_case, _timeit(lambda: _reader_parse(reader_cls, chunks)))
+    return results
+
+
+def _comparable(reply):
+    """
+    错误应答对象按类型及内容比较
+    """
+    if isinstance(reply, Exception):
+        return type(reply), reply.args
+    if isinstance(reply, (list, tuple)):
+        return tuple(_comparable(_) for _ in reply)
+    return reply
+
+
+def check_conformance(fragment_sizes=(1, 7, 64, 4096)):
+    """
+    各解析器对同一语料、不同分段方式的输出必须一致，
+    decode_resp_ondemand只比较不含错误应答的语料(其错误应答为字符串)，且分段数不超过200
+
+    :return: 不一致的(语料, 分段大小, 解析器)列表
+    """
+    readers = [('RespReader', RespReader)]
+    if hiredis is not None:
+        readers.append(('HiredisReader', HiredisReader))
+    mismatches = []
+    for case, (buf, count) in sorted(_corpus().iteritems()):
+        replies = _reader_parse(RespReader, [buf])
+        expect = _comparable(replies)
+        #ondemand每段都从头解析，分段过多时耗时过长
+        check_ondemand = not any(isinstance(_, ResponseError) for _ in replies)
+        if len(expect) != count:
+            mismatches.append({'case': case, 'fragment': None, 'reader': 'RespReader'})
+        expect_ondemand = expect[0] if 1 == count else tuple(expect)
+        for size in fragment_sizes:
+            #1字节分段只用于较小的语料
+            if 1 == size and len(buf) > 65536:
+                continue
+            chunks = _fragments(buf, size)
+            for name, reader_cls in readers:
+                if _comparable(_reader_parse(reader_cls, chunks)) != expect:
+                    mismatches.append({'case': case, 'fragment': size, 'reader': name})
+            if _comparable(_raw_parse(chunks)) != expect:
+                mismatches.append({'case': case, 'fragment': size, 'reader': 'RespReader.set_raw'})
+            if check_ondemand and len(chunks) <= 200 and _ondemand_parse(chunks, count) != expect_ondemand:
+                mismatches.append({'case': case, 'fragment': size, 'reader': 'decode_resp_ondemand'})
+    return mismatches
+
+
+def _serve(port, processes=1):
+    """
+    :param processes: 大于1时以fork_processes运行多个进程，共同accept同一端口
+    """
+    sockets = bind_sockets(port, '127.0.0.1', backlog=1024)
+    if processes > 1:
+        fork_processes(processes)
+    server = FakeRedis()
+    server.add_sockets(sockets)
+    IOLoop.instance().start()
+
+
+def _free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_port(port, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('fake redis did not start on port {0}'.format(port))
+
+
+@gen.coroutine
+def run(args, addr, server):
+    results = []
+    for shape in args.shapes:
+        if server is not None:
+            server.set_shape(shape)
+        elif addr is not None:
+            #真实redis，写入对应形态的数据
+            client = AsyncRedis(redis_tuple=(addr[0], addr[1], 0, None))
+            value = REPLY_SHAPES[shape]
+            if isinstance(value, tuple):
+                yield client.invoke([_encode_req('DEL', 'bench:list'), _encode_req('RPUSH', 'bench:list', *value)])
+            else:
+                yield client.invoke([redis_set('bench:key', value)])
+            client.close()
+        for concurrency in args.concurrency:
+            for pipeline in args.pipeline:
+                client = AsyncRedis(redis_tuple=(addr[0], addr[1], 0, None), auto_pipeline=args.auto_pipeline)
+                #预热，建立连接
+                yield client.invoke([redis_get('bench:key')], active_trans=False)
+                result = yield bench_invoke(client, shape, concurrency, pipeline, args.requests)
+                client.close()
+                results.append(result)
+                sys.stderr.write('{shape:>10} c={concurrency:<4} p={pipeline:<4} {cmds_per_sec:>10.0f} cmd/s '
+                                 'p50={p50_ms:.3f}ms p99={p99_ms:.3f}ms\n'.format(**result))
+    raise gen.Return(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ioloop_redis benchmark')
+    parser.add_argument('-o', '--output', help='json结果文件，默认输出到stdout')
+    parser.add_argument('--server', help='host:port，使用真实redis')
+    parser.add_argument('--subprocess', action='store_true', help='模拟redis运行在子进程中')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve-processes', type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument('--processes', type=int, nargs='+',
+                        help='多进程基准的进程数，如1 2 4；使用--shapes, --concurrency, --pipeline的第一个/最大值，'
+                             '未指定--server时模拟redis以最大进程数运行在子进程中')
+    parser.add_argument('--requests', type=int, default=1000, help='每组参数的invoke次数')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--pipeline', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--shapes', nargs='+', default=sorted(REPLY_SHAPES), choices=sorted(REPLY_SHAPES))
+    parser.add_argument('--auto-pipeline', action='store_true')
+    parser.add_argument('--skip-invoke', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        _serve(args.serve, args.serve_processes)
+        return
+    if args.processes:
+        args.subprocess = not args.server
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'tornado': tornado.version,
+            'hiredis': getattr(hiredis, '__version__', None),
+            'server': args.server or ('subprocess' if args.subprocess else 'in-process'),
+            'cpus': cpu_count(),
+        },
+        'conformance': check_conformance(),
+    }
+
+    if not args.skip_invoke:
+        child = server = None
+        if args.server:
+            host, port = args.server.rsplit(':', 1)
+            addr = (host, int(port))
+        elif args.subprocess:
+            port = _free_port()
+            module = '{0}.redis_bench'.format(__package__)
+            serve_processes = max(args.processes) if args.processes else 1
+            #独立进程组，结束时连同fork出的进程一起kill
+            child = subprocess.Popen([sys.executable, '-m', module, '--serve', str(port),
+                                      '--serve-processes', str(serve_processes)], preexec_fn=os.setsid)
+            _wait_port(port)
+            addr = ('127.0.0.1', port)
+        else:
+            server = FakeRedis()
+            addr = ('127.0.0.1', _listen(server))
+        try:
+            if args.processes:
+                report['processes'] = run_processes(args, addr)
+            else:
+                report['invoke'] = IOLoop.current().run_sync(lambda: run(args, addr, server))
+        finally:
+            if child is not None:
+                os.killpg(child.pid, signal.SIGKILL)
+            if server is not None:
+                server.stop()
+
+    if not args.skip_micro:
+        report['micro'] = bench_micro()
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print out
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,266 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import time
+from collections import OrderedDict
+from .redis_encode import decode_req, redis_client_id, redis_client_tracking, redis_subscribe
+from .redis_error import ResponseError
+
+
+#可缓存的只读指令，指令的第一个参数为key
+CACHEABLE_CMDS = frozenset([
+    'GET', 'HGET', 'HGETALL', 'HKEYS', 'HVALS', 'HEXISTS', 'EXISTS', 'GETBIT', 'BITCOUNT',
+    'LRANGE', 'LINDEX', 'SMEMBERS', 'SISMEMBER', 'SCARD',
+])
+
+#redirect模式下失效消息的频道
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+
+def _value_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_value_size(k) + _value_size(v) for k, v in value.iteritems())
+    if isinstance(value, (tuple, list, set, frozenset)):
+        return sum(_value_size(_) for _ in value)
+    return 8
+
+
+def _copy_value(value):
+    """
+    复制应答中的dict, list, set(HGETALL, SMEMBERS及解码后的值)，缓存与各调用方不共享可变对象
+    """
+    if isinstance(value, dict):
+        return dict((k, _copy_value(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_copy_value(_) for _ in value]
+    if isinstance(value, set):
+        return set(value)
+    if isinstance(value, tuple):
+        copied = [_copy_value(_) for _ in value]
+        if all(a is b for a, b in zip(copied, value)):
+            return value
+        return tuple(copied)
+    return value
+
+
+class ClientCache(object):
+    """
+    进程内只读指令缓存，以编码后的指令为键
+
+    通过CLIENT TRACKING保持一致：key被修改时redis推送失效消息，对应的缓存被删除；
+    跟踪连接断开期间无法收到失效消息，此时清空缓存且不再缓存，直到重新建立跟踪。
+
+    redirect模式下失效消息与应答在不同连接上，失效消息可能先于发出在前的读应答到达；
+    读请求发出时以begin记录key的标记，失效时删除标记，应答到达时标记已不存在则不缓存
+    """
+    def __init__(self, max_entries=10000, max_bytes=None, ttl=None):
+        """
+        :param max_entries: 最大缓存条数，超出时按LRU淘汰
+        :param max_bytes: 缓存值的总字节数上限(估算，dict, set等按其中的字符串计算)
+        :param ttl: 单条缓存的最长存活秒数，None表示只依赖失效消息
+        """
+        assert isinstance(max_entries, int) and max_entries > 0
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__ttl = ttl
+        #指令 --> (值, 过期时间, 字节数, key)
+        self.__entries = OrderedDict()
+        #key --> 指令集合
+        self.__keys = {}
+        self.__bytes = 0
+        #跟踪建立次数
+        self.__epoch = 0
+        #当前跟踪对应的epoch，None表示当前未跟踪
+        self.__generation = None
+        #key --> [标记, 未完成的读请求数]
+        self.__pending = {}
+        self.__stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def generation(self):
+        return self.__generation
+
+    def stats(self):
+        stats = dict(self.__stats)
+        stats['entries'] = len(self.__entries)
+        stats['bytes'] = self.__bytes
+        return stats
+
+    def cacheable(self, cmd):
+        """
+        :param cmd: 单条已编码的指令
+        :return: 可缓存时返回key，否则返回None
+        """
+        if self.__generation is None:
+            return None
+        args = decode_req(cmd)
+        if len(args) < 2 or args[0].upper() not in CACHEABLE_CMDS:
+            return None
+        return args[1]
+
+    def get(self, cmd):
+        """
+        :return: 是否命中, 值
+        """
+        entry = self.__entries.get(cmd)
+        if entry is not None and entry[1] is not None and entry[1] < time.time():
+            self.__remove(cmd)
+            entry = None
+        if entry is None:
+            self.__stats['misses'] += 1
+            return False, None
+        #移到队尾，LRU
+        del self.__entries[cmd]
+        self.__entries[cmd] = entry
+        self.__stats['hits'] += 1
+        return True, _copy_value(entry[0])
+
+    def begin(self, key):
+        """
+        缓存未命中、读请求发出前调用
+
+        :return: 应答到达后传给put或cancel的标记
+        """
+        pending = self.__pending.get(key)
+        if pending is None:
+            pending = self.__pending[key] = [object(), 0]
+        pending[1] += 1
+        return pending[0]
+
+    def cancel(self, key, marker):
+        """
+        读请求失败，释放begin返回的标记
+
+        :return: 请求发出后key是否未失效过
+        """
+        pending = self.__pending.get(key)
+        if pending is None or pending[0] is not marker:
+            return False
+        pending[1] -= 1
+        if not pending[1]:
+            del self.__pending[key]
+        return True
+
+    def put(self, cmd, key, value, marker):
+        """
+        :param marker: 请求发出前begin返回的标记，期间key失效过或跟踪中断过则不缓存
+        """
+        if not self.cancel(key, marker) or self.__generation is None or isinstance(value, ResponseError):
+            return
+        if cmd in self.__entries:
+            self.__remove(cmd)
+
+        size = _value_size(value)
+        expire = time.time() + self.__ttl if self.__ttl else None
+        #value同时返回给发出请求的调用方
+        self.__entries[cmd] = (_copy_value(value), expire, size, key)
+        self.__keys.setdefault(key, set()).add(cmd)
+        self.__bytes += size
+
+        while len(self.__entries) > self.__max_entries or \
+                (self.__max_bytes is not None and self.__bytes > self.__max_bytes and self.__entries):
+            self.__remove(next(iter(self.__entries)))
+            self.__stats['evictions'] += 1
+
+    def invalidate(self, keys):
+        """
+        :param keys: 失效的key列表，None表示全部失效(FLUSHDB等)
+        """
+        if keys is None:
+            self.flush()
+            return
+        for key in keys:
+            self.__pending.pop(key, None)
+            for cmd in self.__keys.pop(key, ()):
+                self.__remove(cmd, False)
+                self.__stats['invalidations'] += 1
+
+    def flush(self):
+        self.__entries.clear()
+        self.__keys.clear()
+        self.__pending.clear()
+        self.__bytes = 0
+
+    def start_tracking(self):
+        """
+        跟踪(重新)建立，之前的缓存可能已过期，全部清空
+        """
+        self.flush()
+        self.__epoch += 1
+        self.__generation = self.__epoch
+        return self.__generation
+
+    def stop_tracking(self):
+        self.flush()
+        self.__generation = None
+
+    def __remove(self, cmd, unlink_key=True):
+        value, _, size, key = self.__entries.pop(cmd)
+        self.__bytes -= size
+        if unlink_key:
+            cmds = self.__keys.get(key)
+            if cmds is not None:
+                cmds.discard(cmd)
+                if not cmds:
+                    del self.__keys[key]
+
+
+class _CacheTracker(object):
+    """
+    redirect模式的失效消息接收连接，连接后：
+    1. CLIENT ID获取本连接id
+    2. 以CLIENT TRACKING on REDIRECT <id>检查redis是否支持跟踪，并订阅__redis__:invalidate
+    3. 订阅成功后开始缓存，业务连接以CLIENT TRACKING on REDIRECT <id>开启跟踪
+    """
+    def __init__(self, cache, conn_factory, on_tracking):
+        """
+        :param conn_factory: conn_factory(push_callback, connect_callback, disconnect_callback)返回_RedisConnection
+        :param on_tracking: 开始跟踪后调用on_tracking(client_id)
+        """
+        self.__cache = cache
+        self.__on_tracking = on_tracking
+        self.__client_id = None
+        self.__tracking_ok = False
+        self.__conn = conn_factory(self.__on_push, self.__on_connect, self.__on_disconnect)
+
+    def client_id(self):
+        """
+        :return: 跟踪可用时返回接收失效消息的CLIENT ID，否则返回None
+        """
+        return self.__client_id if self.__tracking_ok else None
+
+    def close(self):
+        self.__conn.close()
+
+    def close_inherited(self):
+        self.__conn.close_inherited()
+
+    def __on_connect(self):
+        self.__client_id = None
+        self.__tracking_ok = False
+        self.__conn.send(redis_client_id())
+
+    def __on_disconnect(self):
+        self.__client_id = None
+        self.__tracking_ok = False
+        self.__cache.stop_tracking()
+
+    def __on_push(self, reply):
+        if self.__client_id is None:
+            #CLIENT ID应答，redis版本过低时为错误
+            if isinstance(reply, (int, long)):
+                self.__client_id = reply
+                self.__conn.send(''.join((redis_client_tracking(reply), redis_subscribe(INVALIDATE_CHANNEL))))
+            return
+        if not isinstance(reply, tuple):
+            #CLIENT TRACKING应答
+            self.__tracking_ok = 'OK' == reply
+            return
+        if 'subscribe' == reply[0] and self.__tracking_ok:
+            self.__cache.start_tracking()
+            self.__on_tracking(self.__client_id)
+        elif 'message' == reply[0]:
+            #('message', channel, keys)
+            self.__cache.invalidate(reply[2])
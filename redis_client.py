@@ -3,12 +3,25 @@
 from __future__ import absolute_import
 
 from tornado.ioloop import IOLoop
-from tornado.concurrent import TracebackFuture
+from tornado.concurrent import TracebackFuture, is_future, chain_future
+from tornado import gen
 from tornado.iostream import IOStream
 from tornado.stack_context import NullContext
+import os
+import sys
 import socket
-from .redis_resp import decode_resp_ondemand
-from .redis_encode import chain_select_cmd, _encode_req
+import random
+import functools
+import itertools
+from .redis_resp import DEFAULT_READER, RespReader, PushReply, RawReply, resp_count, assemble_resp, \
+    decode_raw, deserialize_reply
+from .redis_encode import chain_select_cmd, chain_select_count, _encode_req, CommandBuffer, \
+    redis_client_tracking, redis_script_load, redis_watch, redis_unwatch, decode_req, Script
+from .redis_pool import ConnectionPool
+from .redis_error import RedisTimeoutError, RedisConnectionError, ResponseError, NoScriptError, WatchError, \
+    first_error
+from .redis_cache import _CacheTracker
+from .redis_metrics import command_label
 from collections import deque
 from util.convert import resolve_redis_url
 
@@ -17,6 +30,44 @@ _RESP_FUTURE = 'future'
 RESP_ERR = 'err'
 RESP_RESULT = 'r'
 
+_MULTI_CMD = _encode_req('MULTI')
+_EXEC_CMD = _encode_req('EXEC')
+
+#invoke(executor=...)交给executor处理的默认阈值：元素个数，bulk字节数
+OFFLOAD_ITEMS = 1000
+OFFLOAD_BYTES = 1024 * 1024
+
+
+def _decode_reply(reply, decoder, deserializer):
+    """
+    value_codecs的ReplyDecoder与deserializer组合，可pickle；
+    deserializer作用于原应答中顶层的字符串元素，参数为解码后的值
+    """
+    if decoder is None:
+        return reply if deserializer is None else deserialize_reply(reply, deserializer)
+    decoded = decoder(reply)
+    if deserializer is None:
+        return decoded
+    if isinstance(reply, str):
+        return deserializer(decoded)
+    if isinstance(reply, tuple) and not isinstance(reply, PushReply):
+        return tuple([deserializer(v) if isinstance(r, str) else v for r, v in zip(reply, decoded)])
+    if isinstance(reply, dict):
+        return dict((k, deserializer(v) if isinstance(reply[k], str) else v) for k, v in decoded.iteritems())
+    return decoded
+
+
+def _decode_raw_reply(raw, decoder, deserializer, reader_cls):
+    return _decode_reply(decode_raw(raw, None, reader_cls), decoder, deserializer)
+
+
+def _count_errors(stats, replies, start, max_samples):
+    for i, reply in enumerate(replies):
+        if isinstance(reply, ResponseError):
+            stats['errors'] += 1
+            if len(stats['samples']) < max_samples:
+                stats['samples'].append((start + i, reply))
+
 
 def _chain_cmds(trans, cmds):
     """对单条指令和pipe均支持
@@ -29,166 +80,1259 @@ def _chain_cmds(trans, cmds):
 
     count = 0
     if trans:
-        yield count, _encode_req('MULTI')
+        yield count, _MULTI_CMD
     for _ in cmds:
         if not isinstance(_, str):
             raise ValueError('cmd not str: %s' % _)
         count += 1
         yield count, _
     if trans:
-        yield count, _encode_req('EXEC')
+        yield count, _EXEC_CMD
+
+
+def _resolve_redis(redis_uri, redis_tuple):
+    """
+    :param redis_uri: redis://:pwd@host:port/db
+    :param redis_tuple: (host, port, db, pwd)
+    :return: (host, port, db), pwd
+    """
+    if redis_uri:
+        host, port, db, pwd = resolve_redis_url(redis_uri)
+        return (host, port, db), pwd
+    assert 4 == len(redis_tuple)
+    return tuple(redis_tuple[:3]), redis_tuple[-1]
+
+
+def _handle_resp(resp):
+    f = resp.get(_RESP_FUTURE)
+    #已超时，丢弃迟到的应答
+    if f.done():
+        return
+    err = resp.get(RESP_ERR)
+    result = resp.get(RESP_RESULT)
+
+    if err:
+        f.set_exception(err)
+    else:
+        f.set_result(result)
 
 
 class AsyncRedis(object):
     """
     一个redis地址对应一个AsyncRedis对象
-    维护一个RedisConnection对象
+    维护一个ConnectionPool对象，默认只有一个连接，所有请求pipeline到该连接上
     """
-    def __init__(self, redis_uri=None, redis_tuple=None):
-        if redis_uri:
-            host, port, db, self.__pwd = resolve_redis_url(redis_uri)
-            self.__redis_tuple = host, port, db
-        elif redis_tuple:
-            assert 4 == len(redis_tuple)
-            self.__redis_tuple = redis_tuple[:3]
-            self.__pwd = redis_tuple[-1]
-        self.__conn = None
+    def __init__(self, redis_uri=None, redis_tuple=None, min_conns=0, max_conns=1, max_inflight=None,
+                 idle_timeout=None, pin_blocking=False, auto_pipeline=False, timeout=None, max_timeouts=None,
+                 reconnect_delay=0.1, max_reconnect_delay=10.0, max_queued_bytes=None, client_cache=None,
+                 reader_cls=None, protocol=2, metrics=None, raise_on_error=False, io_loop=None,
+                 value_codecs=None):
+        """
+        :param min_conns: 首次invoke(及fork后)绑定时预先建立的连接数，空闲回收时保留不少于该数
+        :param max_conns: 连接池最大连接数
+        :param max_inflight: 单个连接上未完成请求的上限，None表示不限制，为1时每次invoke独占一个连接
+        :param idle_timeout: 空闲连接回收秒数
+        :param pin_blocking: invoke(blocking=True)的指令是否使用专用连接
+        :param auto_pipeline: 是否将同一次IOLoop迭代内的请求合并为一次write
+        :param timeout: invoke默认超时秒数，None表示不超时
+        :param max_timeouts: 连接上连续超时达到该次数时关闭连接，None表示不回收
+        :param reconnect_delay: 连接断开后首次重连等待秒数，按指数退避并加入随机抖动；None表示不自动重连
+        :param max_reconnect_delay: 重连等待上限
+        :param max_queued_bytes: 断开期间缓存指令的字节数上限，None表示不限制
+        :param client_cache: ClientCache对象，缓存单条只读指令的应答，通过CLIENT TRACKING保持一致
+        :param reader_cls: 应答解析器，RespReader或HiredisReader，默认可导入hiredis时使用HiredisReader
+        :param protocol: 2或3，为3时以HELLO 3协商RESP3，应答为dict, set, float, bool等原生类型，
+            默认解析器为RespReader；client_cache通过推送消息接收失效通知，不再需要单独的跟踪连接
+        :param metrics: RedisMetrics等NullMetrics的子类对象，统计请求数、字节数、重连及各指令的延迟分布；
+            None时连接上不做任何统计
+        :param raise_on_error: invoke的默认值，为True时错误应答以ResponseError的子类抛出，否则作为应答值返回
+        :param io_loop: 连接使用的IOLoop，默认为首次invoke时的IOLoop.current()
+        :param value_codecs: redis_codec.KeyCodecs对象，invoke时写入指令(SET, HSET, RPUSH等)中的值按key前缀编码，
+            读取指令(GET, HGETALL, LRANGE等)应答中对应的值解码；None时不编码也不解码
+
+        构造时不建立连接也不创建IOLoop，首次invoke时才绑定到当前进程及IOLoop；
+        之后检测到进程号变化(fork)或IOLoop变化时丢弃原有连接并重建，fork后继承的连接只关闭本进程的文件描述符，
+        因此可以作为模块级对象在fork_processes之前创建
+        """
+        self.__redis_tuple, self.__pwd = _resolve_redis(redis_uri, redis_tuple)
+        self.__pin_blocking = pin_blocking
+        self.__timeout = timeout
+        self.__max_timeouts = max_timeouts
+        self.__conn_opts = {
+            'reconnect_delay': reconnect_delay,
+            'max_reconnect_delay': max_reconnect_delay,
+            'max_queued_bytes': max_queued_bytes,
+            'reader_cls': reader_cls,
+            'protocol': protocol,
+            'metrics': metrics,
+        }
+        #自动pipeline统计：write次数，合并的请求数，单次最大请求数
+        self.__batch_stats = {'flushes': 0, 'requests': 0, 'max_batch': 0} if auto_pipeline else None
+        #解析RawReply时使用与连接相同的解析器
+        self.__reader_cls = reader_cls or (DEFAULT_READER if 2 == protocol else RespReader)
+        self.__pool_args = (min_conns, max_conns, max_inflight, idle_timeout)
+        self.__io_loop = io_loop
+        #连接池及失效消息连接所属的进程号及IOLoop，首次invoke时绑定
+        self.__pid = None
+        self.__loop = None
+        self.__pool = None
+        self.__cache = client_cache
+        self.__tracker = None
+        #已注册的Lua脚本，sha1 --> 脚本
+        self.__scripts = {}
+        self.__raise_on_error = raise_on_error
+        self.__codecs = value_codecs
+        if client_cache is not None and 3 == protocol:
+            #RESP3下失效消息以推送形式在业务连接上返回
+            self.__conn_opts['push_callback'] = self.__on_push
+            self.__conn_opts['disconnect_callback'] = self.__on_conn_lost
+
+    def __bind(self):
+        """
+        :return: 当前进程及IOLoop的ConnectionPool，首次调用、fork之后或IOLoop变化时重建
+        """
+        io_loop = self.__io_loop or IOLoop.current()
+        pid = os.getpid()
+        if pid == self.__pid and io_loop is self.__loop:
+            return self.__pool
+
+        if self.__pool is not None and pid == self.__pid:
+            #同一进程内切换IOLoop，原连接在此关闭
+            self.__pool.close()
+            if self.__tracker is not None:
+                self.__tracker.close()
+        elif self.__pool is not None:
+            #fork之后原连接的socket与父进程共享，且注册在父进程的IOLoop上，
+            #只关闭本进程的文件描述符，父进程的连接不受影响
+            self.__pool.close_inherited()
+            if self.__tracker is not None:
+                self.__tracker.close_inherited()
+        self.__pid = pid
+        self.__loop = io_loop
+        self.__tracker = None
+        self.__conn_opts['io_loop'] = io_loop
+        min_conns, max_conns, max_inflight, idle_timeout = self.__pool_args
+        self.__pool = ConnectionPool(self.__new_conn, min_conns, max_conns, max_inflight, idle_timeout,
+                                     self.__new_dedicated_conn, io_loop)
+        if self.__cache is not None and 'push_callback' in self.__conn_opts:
+            self.__cache.start_tracking()
+        elif self.__cache is not None:
+            #跟踪连接建立前不使用缓存，父进程的缓存内容可能已过期
+            self.__cache.stop_tracking()
+            with NullContext():
+                self.__tracker = _CacheTracker(self.__cache, self.__new_push_conn, self.__on_tracking)
+        return self.__pool
+
+    def __new_conn(self):
+        conn = _RedisConnection(_handle_resp, self.__redis_tuple, self.__pwd, self.__batch_stats,
+                                init_cmds=self.__init_cmds, **self.__conn_opts)
+        conn.connect()
+        return conn
+
+    def __new_dedicated_conn(self):
+        """
+        独占连接断开后不重连，避免WATCH状态丢失后EXEC仍被重放
+        """
+        opts = dict(self.__conn_opts, reconnect_delay=None)
+        conn = _RedisConnection(_handle_resp, self.__redis_tuple, self.__pwd, init_cmds=self.__init_cmds, **opts)
+        conn.connect()
+        return conn
+
+    def __new_push_conn(self, push_callback, connect_callback, disconnect_callback):
+        conn = _RedisConnection(None, self.__redis_tuple, self.__pwd, push_callback=push_callback,
+                                connect_callback=connect_callback, disconnect_callback=disconnect_callback,
+                                **self.__conn_opts)
+        conn.connect()
+        return conn
+
+    def __init_cmds(self):
+        """
+        每次(重)连接时在AUTH, SELECT之后发送的指令
+        """
+        cmds = []
+        if self.__tracker is not None and self.__tracker.client_id() is not None:
+            cmds.append(redis_client_tracking(self.__tracker.client_id()))
+        elif self.__cache is not None and 'push_callback' in self.__conn_opts:
+            cmds.append(redis_client_tracking())
+        cmds.extend(redis_script_load(_) for _ in self.__scripts.itervalues())
+        return cmds
+
+    def __on_push(self, reply):
+        """
+        RESP3推送消息，只处理失效通知 (invalidate, keys)
+        """
+        if isinstance(reply, PushReply) and 2 == len(reply) and 'invalidate' == reply[0]:
+            self.__cache.invalidate(reply[1])
+
+    def __on_conn_lost(self):
+        """
+        连接断开期间的失效通知已丢失，清空缓存并丢弃进行中的缓存写入
+        """
+        self.__cache.start_tracking()
+
+    def __on_tracking(self, client_id):
+        """
+        失效消息连接(重新)建立，已有连接改为转发到新的CLIENT ID
+        """
+        cmd = redis_client_tracking(client_id)
+        for conn in self.__pool.connections():
+            conn.write_internal(cmd, 1)
+
+    def __cache_result(self, cmd, key, marker, future):
+        if future.exception() is None:
+            self.__cache.put(cmd, key, future.result(), marker)
+        else:
+            self.__cache.cancel(key, marker)
+
+    def redis_addr(self):
+        """
+        :return: (host, port)
+        """
+        return self.__redis_tuple[:2]
+
+    def batch_stats(self):
+        """
+        自动pipeline统计，未开启时返回None
+        """
+        if self.__batch_stats is None:
+            return None
+        stats = dict(self.__batch_stats)
+        stats['avg_batch'] = float(stats['requests']) / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+    def register_script(self, script):
+        """
+        注册Lua脚本，已建立的连接立即SCRIPT LOAD，之后每次(重)连接时在AUTH, SELECT之后加载
+
+        :param script: 脚本内容
+        :return: Script对象，调用后返回EVALSHA指令；执行时遇到NOSCRIPT自动加载并重试
+        """
+        script = Script(script)
+        if script.sha not in self.__scripts:
+            self.__scripts[script.sha] = script.script
+            if self.__pool is None or os.getpid() != self.__pid:
+                return script
+            cmd = redis_script_load(script.script)
+            for conn in self.__pool.connections():
+                conn.write_internal(cmd, 1)
+        return script
 
     def invoke(self, iter_redis_cmds, **kwargs):
         """异步调用redis相关接口
 
-        :param iter_redis_cmds: 多条redis指令
+        :param iter_redis_cmds: 多条redis指令，或CommandBuffer对象；
+            指令可以是(指令名, 参数...)的tuple，配置value_codecs时dict等需要序列化的值以此形式传入
         :param kwargs: 用于设置事务开关等
+            blocking: 为True且开启pin_blocking时，使用阻塞指令专用连接
+            timeout: 本次调用的超时秒数，覆盖默认值；超时后future抛出RedisTimeoutError，
+                     迟到的应答仍会被解析并丢弃，不影响后续请求
+            cache: 为False时不使用client_cache
+            sink: 单条指令且不开启事务时可用，bulk应答内容分段写入sink.write(chunk)，不缓存完整的值，
+                  future结果为内容长度；nil及错误应答按原值返回；超时后剩余内容被丢弃，不再写入sink。
+                  sink.write返回future时(如IOStream)，写入完成前连接暂停读取，其他应答同样等待。
+                  RespReader下内存占用与一次收到的数据量相当，HiredisReader下仍解析完整的值后写入
+            deserializer: 作用于单个字符串的函数，如json.loads，参见deserialize_reply；
+                          未指定executor时在IOLoop中执行
+            executor: concurrent.futures的ThreadPoolExecutor或ProcessPoolExecutor，单条指令且不开启事务时可用。
+                      应答元素个数达到offload_items(默认OFFLOAD_ITEMS)或bulk长度达到offload_bytes(默认OFFLOAD_BYTES)时：
+                      只扫描应答边界，解析及deserializer在executor中执行。
+                      hiredis无法截取原始字节，使用HiredisReader的连接收到此类请求后改用RespReader，
+                      该连接上其他应答的解析随之变慢；连接上有待收的应答时切换推迟到其全部收到，期间的请求仍在IOLoop中解析。
+                      完成后在IOLoop中设置future的结果，未达阈值的应答仍在IOLoop中处理，不经过client_cache。
+                      线程池受GIL限制，总耗时不变，但IOLoop可以在解析期间处理其他应答；
+                      进程池使用的deserializer须可pickle
+            codecs: 为False时本次不经过value_codecs，写入及返回原始的值；
+                    开启时与executor, deserializer同用，先解码，deserializer的参数为解码后的值
+
+            raise_on_error: 覆盖构造时的默认值，为True时以结果中的第一个错误应答(WrongTypeError等)结束future；
+                            为False时错误应答作为对应指令的应答值返回
+
+        注册过Lua脚本时，应答中已注册脚本的EVALSHA返回NOSCRIPT的，加载脚本后单独重试这些指令并替换其应答；
+        事务中只有全部指令均为NOSCRIPT时才加载后重新执行整个事务，否则其他指令已提交，
+        加载脚本后原样返回NoScriptError，由调用方决定是否重试
+        """
+        return self.__request(iter_redis_cmds, kwargs)
+
+    def __request(self, iter_redis_cmds, kwargs, conn=None):
         """
+        invoke的实现，conn为独占连接时在该连接上执行
+        """
+        raise_on_error = kwargs.get('raise_on_error', self.__raise_on_error)
+        iter_redis_cmds, decoder = self.__prepare(iter_redis_cmds, kwargs)
+        executor = kwargs.get('executor')
+        if self.__scripts and kwargs.get('sink') is None and executor is None:
+            future = self.__invoke_scripts(iter_redis_cmds, kwargs, conn)
+        else:
+            future = self.__invoke(iter_redis_cmds, kwargs, conn)
+        if executor is not None or kwargs.get('deserializer') is not None:
+            future = self.__offload(future, kwargs, decoder)
+        else:
+            future = self.__decode(future, decoder)
+        if not raise_on_error:
+            return future
+        return self.__raise_first_error(future, len(iter_redis_cmds) > 1)
+
+    def __prepare(self, cmds, kwargs):
+        """
+        tuple形式的指令编码为字符串；配置value_codecs时同时编码写入的值
+
+        :return: 指令列表或CommandBuffer, 应答的ReplyDecoder(不需要解码时为None)
+        """
+        if self.__codecs is not None and kwargs.get('codecs', True):
+            return self.__codecs.prepare(cmds)
+        if isinstance(cmds, CommandBuffer):
+            return cmds, None
+        return [_encode_req(*_) if isinstance(_, tuple) else _ for _ in cmds], None
+
+    def __decode(self, inner, decoder):
+        if decoder is None:
+            return inner
+        future = TracebackFuture()
+
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exc_info(f.exc_info())
+                return
+            try:
+                future.set_result(decoder(f.result()))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+
+        inner.add_done_callback(on_done)
+        return future
+
+    def __offload(self, inner, kwargs, decoder):
+        future = TracebackFuture()
+        executor = kwargs.get('executor')
+        deserializer = kwargs.get('deserializer')
+        min_items = kwargs.get('offload_items', OFFLOAD_ITEMS)
+        min_bytes = kwargs.get('offload_bytes', OFFLOAD_BYTES)
+
+        def on_job(job):
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exc_info(f.exc_info())
+                return
+            result = f.result()
+            if isinstance(result, RawReply):
+                job = executor.submit(_decode_raw_reply, result, decoder, deserializer, self.__reader_cls)
+            elif executor is not None and (deserializer is not None or decoder is not None) and \
+                    (isinstance(result, (tuple, dict)) and len(result) >= min_items or
+                     isinstance(result, str) and len(result) >= min_bytes):
+                job = executor.submit(_decode_reply, result, decoder, deserializer)
+            else:
+                try:
+                    future.set_result(_decode_reply(result, decoder, deserializer))
+                except Exception:
+                    future.set_exc_info(sys.exc_info())
+                return
+            #executor的future在工作线程中完成，回到IOLoop中设置结果
+            self.__loop.add_future(job, on_job)
+
+        inner.add_done_callback(on_done)
+        return future
+
+    def __raise_first_error(self, inner, multi):
+        future = TracebackFuture()
+
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exc_info(f.exc_info())
+                return
+            err = first_error(f.result(), multi)
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result(f.result())
+
+        inner.add_done_callback(on_done)
+        return future
+
+    def __invoke_scripts(self, cmds, kwargs, conn=None):
+        future = TracebackFuture()
+
+        def on_done(f):
+            if f.exception() is not None:
+                future.set_exc_info(f.exc_info())
+                return
+            result = f.result()
+            results = (result,) if 1 == len(cmds) else result
+            failed = []
+            if isinstance(results, tuple) and any(isinstance(_, NoScriptError) for _ in results):
+                cmd_list = list(cmds)
+                for i, r in enumerate(results):
+                    if not isinstance(r, NoScriptError):
+                        continue
+                    args = decode_req(cmd_list[i])
+                    if 'EVALSHA' == args[0].upper() and args[1] in self.__scripts:
+                        failed.append((i, args[1]))
+            if not failed:
+                future.set_result(result)
+                return
+
+            shas = list(set(sha for _, sha in failed))
+            loads = [redis_script_load(self.__scripts[_]) for _ in shas]
+            if kwargs.get('active_trans') in (None, True):
+                #在事务外重试会破坏原子性
+                rerun = len(failed) == len(cmd_list)
+                self.__invoke(loads, dict(kwargs, active_trans=False), conn).add_done_callback(
+                    functools.partial(on_load, result, rerun))
+                return
+
+            #先加载脚本，再以pipeline重试
+            retry = loads + [cmd_list[i] for i, _ in failed]
+            retry_kwargs = dict(kwargs, active_trans=False)
+            self.__invoke(retry, retry_kwargs, conn).add_done_callback(
+                functools.partial(on_retry, results, failed, len(shas)))
+
+        def on_load(result, rerun, f):
+            if f.exception() is not None or not rerun:
+                future.set_result(result)
+                return
+            chain_future(self.__invoke(cmds, kwargs, conn), future)
+
+        def on_retry(results, failed, load_count, f):
+            if f.exception() is not None:
+                future.set_exc_info(f.exc_info())
+                return
+            retried = f.result()[load_count:]
+            results = list(results)
+            for (i, _), r in zip(failed, retried):
+                results[i] = r
+            future.set_result(results[0] if 1 == len(cmds) else tuple(results))
+
+        self.__invoke(cmds, kwargs, conn).add_done_callback(on_done)
+        return future
+
+    @gen.coroutine
+    def transaction(self, func, watch_keys, max_retries=10, retry_delay=0.01, max_retry_delay=0.5):
+        """乐观事务(check-and-set)，在独占连接上：
+        1. WATCH watch_keys
+        2. 调用func(pinned)，func通过pinned.invoke读取数据，返回要在MULTI/EXEC中执行的写指令列表
+        3. 写指令为空时UNWATCH并返回None，否则MULTI, 写指令, EXEC
+        4. watch_keys被其他客户端修改时EXEC返回nil，按指数退避后从1重试
+
+        @gen.coroutine
+        def incr_if_below(pinned):
+            value = yield pinned.invoke([redis_get('counter')])
+            if int(value or 0) >= 100:
+                raise gen.Return([])
+            raise gen.Return([redis_incre('counter')])
+
+        result = yield client.transaction(incr_if_below, ['counter'])
+
+        :param func: 普通函数或返回future的函数，可能被调用多次
+        :param watch_keys: WATCH的key列表
+        :param max_retries: 最多重试次数，用完后抛出WatchError
+        :param retry_delay: 首次重试前的等待秒数，之后翻倍并加入随机抖动
+        :param max_retry_delay: 等待上限
+        :return: EXEC的结果，每条写指令一个元素的tuple；入队失败时为ExecAbortError，
+                 开启raise_on_error时抛出结果中的第一个错误应答
+        """
+        assert watch_keys
+        pinned = self.pinned()
+        #func抛出异常或请求超时后连接可能仍处于WATCH/MULTI状态，不再复用
+        clean = False
+        try:
+            for attempt in xrange(max_retries + 1):
+                if attempt:
+                    delay = min(max_retry_delay, retry_delay * (2 ** (attempt - 1)))
+                    yield gen.sleep(random.uniform(delay / 2, delay))
+
+                yield pinned.invoke([redis_watch(*watch_keys)], raise_on_error=False)
+                cmds = func(pinned)
+                if is_future(cmds):
+                    cmds = yield cmds
+                if not cmds:
+                    yield pinned.invoke([redis_unwatch()], raise_on_error=False)
+                    clean = True
+                    raise gen.Return(None)
+
+                #自行拼接MULTI/EXEC，以便区分nil(放弃)与单条指令的nil应答；
+                #value_codecs按写指令本身准备，解码作用于EXEC的应答而不是各指令的QUEUED
+                decoder = None
+                if self.__codecs is not None:
+                    cmds, decoder = self.__codecs.prepare(cmds, multi=True)
+                replies = yield pinned.invoke([_MULTI_CMD] + list(cmds) + [_EXEC_CMD], raise_on_error=False,
+                                              codecs=False)
+                result = replies[-1]
+                if result is not None:
+                    clean = True
+                    if decoder is not None:
+                        result = decoder(result)
+                    err = first_error(result, True) if self.__raise_on_error else None
+                    if err is not None:
+                        raise err
+                    raise gen.Return(result)
+            clean = True
+            raise WatchError('transaction aborted after {0} retries, keys: {1}'.format(max_retries, watch_keys))
+        finally:
+            pinned.release(close=not clean)
+
+    def pinned(self):
+        """
+        签出一个独占连接，返回对象的invoke均在该连接上执行，不与其他请求共用，断开后不自动重连；
+        用于BLPOP, BLMOVE等阻塞指令及依赖连接状态的指令序列。
+        用完后调用release()归还，连接状态不确定(如阻塞指令超时)时release(close=True)
+
+        queue = client.pinned()
+        try:
+            item = yield queue.invoke([redis_blmove('jobs', 'jobs:processing', 5)], timeout=6)
+        finally:
+            queue.release()
+        """
+        pool = self.__bind()
+        checkout = pool.checkout()
+        return _PinnedRedis(functools.partial(self.__invoke_pinned, checkout),
+                            functools.partial(self.__release_pinned, pool, checkout))
+
+    @gen.coroutine
+    def __invoke_pinned(self, checkout, cmds, kwargs):
+        """
+        独占连接均已签出时等待归还，等待时间计入本次timeout
+        """
+        if not checkout.done():
+            timeout = kwargs.get('timeout', self.__timeout)
+            if timeout:
+                start = self.__loop.time()
+                yield self.__wait_checkout(checkout, timeout)
+                kwargs = dict(kwargs, timeout=max(timeout - (self.__loop.time() - start), 0.001))
+            else:
+                yield checkout
+        result = yield self.__request(cmds, kwargs, checkout.result())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def __wait_checkout(self, checkout, timeout):
+        try:
+            yield gen.with_timeout(self.__loop.time() + timeout, checkout, io_loop=self.__loop,
+                                   quiet_exceptions=RedisConnectionError)
+        except gen.TimeoutError:
+            raise RedisTimeoutError('redis timeout after {0}s waiting for a dedicated connection'.format(timeout))
+
+    @staticmethod
+    def __release_pinned(pool, checkout, close):
+        #仍在等待时，签出后立即归还
+        checkout.add_done_callback(lambda f: f.exception() is None and pool.checkin(f.result(), close))
+
+    @gen.coroutine
+    def bulk_write(self, cmds, window=10000, batch_size=500, max_buffer=4 * 1024 * 1024, max_samples=10,
+                   timeout=None):
+        """流式批量写入，用于缓存预热、数据导入等
+
+        在独占连接上以pipeline发送，不开启事务，不影响其他invoke：
+        * 从cmds中每取batch_size条指令编码到同一CommandBuffer，一次写入
+        * 已发送未应答的指令数将超过window，或连接写缓冲超过max_buffer字节时，等待最早一批的应答
+        * 只统计指令数及错误应答，应答收到后即丢弃
+
+        stats = yield client.bulk_write(('SET', 'k%d' % i, i) for i in xrange(1000000))
+
+        :param cmds: 可迭代对象，元素为redis_*返回的已编码指令，或(指令名, 参数...)的tuple，按需读取；
+            配置value_codecs时其中的值同样编码
+        :param window: 未应答指令数的上限，不小于batch_size
+        :param max_samples: 保留的错误应答个数
+        :param timeout: 每批指令的超时秒数，None使用client的默认值
+        :return: {'total': 指令数, 'errors': 错误应答数, 'samples': [(指令序号, ResponseError), ...]}
+            连接断开或超时时抛出对应异常，已发送的指令是否执行未知
+        """
+        if not (isinstance(batch_size, int) and batch_size >= 1):
+            raise ValueError('batch_size invalid: {0}'.format(batch_size))
+        if not (isinstance(window, int) and window >= batch_size):
+            raise ValueError('window invalid: {0}'.format(window))
+
+        pool = self.__bind()
+        checkout = pool.checkout()
+        kwargs = {'active_trans': False, 'cache': False}
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        wait_timeout = kwargs.get('timeout', self.__timeout)
+        if not checkout.done() and wait_timeout:
+            try:
+                yield self.__wait_checkout(checkout, wait_timeout)
+            except RedisTimeoutError:
+                self.__release_pinned(pool, checkout, False)
+                raise
+        conn = yield checkout
+        stats = {'total': 0, 'errors': 0, 'samples': []}
+        #已发送未应答的批次: (future, 首条指令序号, 指令数)
+        inflight = deque()
+        pending = 0
+        clean = False
+        try:
+            it = iter(cmds)
+            index = 0
+            while True:
+                buf = CommandBuffer()
+                for cmd in itertools.islice(it, batch_size):
+                    if self.__codecs is not None:
+                        buf.append_encoded(self.__codecs.encode_cmd(cmd))
+                    elif isinstance(cmd, str):
+                        buf.append_encoded(cmd)
+                    else:
+                        buf.append(*cmd)
+                count = len(buf)
+                if not count:
+                    break
+
+                while inflight and (inflight[0][0].done() or pending + count > window or
+                                    conn.write_buffer_size() > max_buffer):
+                    future, start, n = inflight.popleft()
+                    replies = yield future
+                    pending -= n
+                    _count_errors(stats, replies if n > 1 else (replies,), start, max_samples)
+
+                inflight.append((self.__invoke(buf, kwargs, conn), index, count))
+                pending += count
+                index += count
+
+            while inflight:
+                future, start, n = inflight.popleft()
+                replies = yield future
+                _count_errors(stats, replies if n > 1 else (replies,), start, max_samples)
+            stats['total'] = index
+            clean = True
+        finally:
+            pool.checkin(conn, close=not clean)
+            if not clean:
+                #取走异常，避免未处理异常的日志
+                for future, _, _ in inflight:
+                    future.add_done_callback(lambda f: f.exception())
+        raise gen.Return(stats)
+
+    def __invoke(self, iter_redis_cmds, kwargs, conn=None):
+        #先绑定，fork之后的子进程在查询client_cache前已清空继承的缓存
+        pool = self.__bind()
         #如不包含事务参数，则默认开启；否则按设置执行
         active_trans = kwargs.get('active_trans')
         if active_trans is None:
             active_trans = True
 
-        cmd_count = 0
-        temp_buf = []
-        for i, redis_command in _chain_cmds(active_trans, iter_redis_cmds):
-            cmd_count = i
-            temp_buf.append(redis_command)
+        sink = kwargs.get('sink')
+        raw_limits = None
+        if kwargs.get('executor') is not None:
+            if sink is not None:
+                raise ValueError('sink and executor are exclusive')
+            raw_limits = (kwargs.get('offload_items', OFFLOAD_ITEMS), kwargs.get('offload_bytes', OFFLOAD_BYTES))
+        if sink is not None or raw_limits is not None:
+            iter_redis_cmds = list(iter_redis_cmds)
+            if active_trans or 1 != len(iter_redis_cmds):
+                raise ValueError('{0} requires a single command without transaction'.format(
+                    'sink' if sink is not None else 'executor'))
 
-        redis_stream = ''.join(temp_buf)
-        del temp_buf
+        #只缓存单条只读指令
+        cache_key = None
+        if self.__cache is not None and kwargs.get('cache', True) and sink is None and raw_limits is None:
+            iter_redis_cmds = list(iter_redis_cmds)
+            if 1 == len(iter_redis_cmds):
+                cache_key = self.__cache.cacheable(iter_redis_cmds[0])
+        if cache_key is not None:
+            hit, value = self.__cache.get(iter_redis_cmds[0])
+            if hit:
+                future = TracebackFuture()
+                future.set_result(value)
+                return future
+
+        if isinstance(iter_redis_cmds, CommandBuffer):
+            #已编码在同一缓冲区
+            cmd_count = len(iter_redis_cmds)
+            redis_stream = iter_redis_cmds.getvalue()
+            if active_trans:
+                redis_stream = ''.join((_MULTI_CMD, redis_stream, _EXEC_CMD))
+        else:
+            cmd_count = 0
+            temp_buf = []
+            for i, redis_command in _chain_cmds(active_trans, iter_redis_cmds):
+                cmd_count = i
+                temp_buf.append(redis_command)
+
+            redis_stream = ''.join(temp_buf)
+            del temp_buf
         future = TracebackFuture()
+        if cache_key is not None:
+            future.add_done_callback(functools.partial(
+                self.__cache_result, iter_redis_cmds[0], cache_key, self.__cache.begin(cache_key)))
+        timeout = kwargs.get('timeout', self.__timeout)
+        #已写入请求的连接
+        sent_conn = []
 
-        def handle_resp(resp):
-            f = resp.get(_RESP_FUTURE) or future
-            err = resp.get(RESP_ERR)
-            result = resp.get(RESP_RESULT)
+        def send(conn):
+            #在连接池中等待时已超时
+            if future.done():
+                return
+            conn.write(redis_stream, future, active_trans, cmd_count, sink, raw_limits)
+            sent_conn.append(conn)
 
-            if err:
-                f.set_exception(err)
-            else:
-                f.set_result(result)
+        def on_timeout():
+            if future.done():
+                return
+            future.set_exception(RedisTimeoutError('redis timeout after {0}s'.format(timeout)))
+            if not sent_conn:
+                return
+            conn = sent_conn[0]
+            if self.__max_timeouts and conn.record_timeout() >= self.__max_timeouts:
+                conn.close()
 
         with NullContext():
-            if self.__conn is None or not self.__conn.con_ok():
-                self.__conn = _RedisConnection(handle_resp, self.__redis_tuple, self.__pwd)
-                self.__conn.connect(future)
-            self.__conn.write(redis_stream, future, active_trans, cmd_count)
+            if timeout:
+                io_loop = self.__loop
+                handle = io_loop.add_timeout(io_loop.time() + timeout, on_timeout)
+                future.add_done_callback(lambda _: io_loop.remove_timeout(handle))
+
+            if conn is not None:
+                send(conn)
+            elif kwargs.get('blocking') and self.__pin_blocking:
+                send(pool.blocking_conn())
+            else:
+                pool.acquire(send, future)
         return future
 
+    def close(self):
+        """
+        关闭全部连接，未完成的请求以RedisConnectionError失败
+        """
+        if self.__pool is None or os.getpid() != self.__pid:
+            return
+        self.__pool.close()
+        if self.__tracker is not None:
+            self.__tracker.close()
+
+
+class _PinnedRedis(object):
+    """
+    AsyncRedis.pinned()的返回值，也是transaction中传给func的对象；
+    指令均在同一独占连接上执行，不经过client_cache
+    """
+    def __init__(self, invoke_on, release_on):
+        self.__invoke_on = invoke_on
+        self.__release_on = release_on
+
+    def release(self, close=False):
+        """
+        归还连接，重复调用无效
+
+        :param close: 为True时关闭连接而不归还
+        """
+        if self.__release_on is not None:
+            release_on, self.__release_on = self.__release_on, None
+            release_on(close)
+
+    def invoke(self, iter_redis_cmds, **kwargs):
+        """
+        参数与AsyncRedis.invoke一致(包括raise_on_error, value_codecs及Lua脚本的NOSCRIPT重试)，active_trans默认为False；
+        独占连接均已签出时等待其他连接归还，等待时间计入timeout
+        """
+        kwargs.setdefault('active_trans', False)
+        kwargs['cache'] = False
+        return self.__invoke_on(iter_redis_cmds, kwargs)
+
+
+#连接状态
+_STATE_CONNECTING = 'connecting'
+_STATE_CONNECTED = 'connected'
+#连接断开，等待重连
+_STATE_DISCONNECTED = 'disconnected'
+#已被主动关闭，不再重连
+_STATE_CLOSED = 'closed'
+
+#每次从socket读取的字节数上限，与IOStream的read_chunk_size一致
+_READ_CHUNK = 64 * 1024
+
+
+class _SinkWriter(object):
+    """
+    转发应答内容到sink.write，请求结束(如超时)后丢弃剩余内容；
+    sink.write返回future时(如IOStream)记录最近一次写入，连接在其完成前不再读取socket
+    """
+    def __init__(self, sink, future):
+        self.__sink = sink
+        self.__future = future
+        self.__pending = None
+
+    def write(self, chunk):
+        if self.__future.done():
+            return
+        result = self.__sink.write(chunk)
+        if is_future(result):
+            self.__pending = result
+
+    def waiting(self):
+        """
+        :return: 需要等待时为(sink写入的future, 请求的future)，任一完成后继续读取；否则为None
+        """
+        if self.__pending is None or self.__pending.done() or self.__future.done():
+            return None
+        return self.__pending, self.__future
+
 
 class _RedisConnection(object):
-    def __init__(self, final_callback, redis_tuple, redis_pwd):
+    def __init__(self, final_callback, redis_tuple, redis_pwd, batch_stats=None,
+                 reconnect_delay=0.1, max_reconnect_delay=10.0, max_queued_bytes=None,
+                 push_callback=None, connect_callback=None, disconnect_callback=None, init_cmds=None,
+                 reader_cls=None, protocol=2, metrics=None, io_loop=None):
         """
         :param final_callback: resp赋值时调用
-        :param redis_tuple: (ip, port, db)
+        :param redis_tuple: (ip, port, db)，db为None时不发送SELECT
         :param redis_pwd: redis密码
+        :param batch_stats: 不为None时开启自动pipeline，并在其中累计统计
+        :param reconnect_delay: 首次重连等待秒数，之后指数增长并加入随机抖动；None表示断开后不重连
+        :param max_reconnect_delay: 重连等待上限
+        :param max_queued_bytes: 未连接时缓存指令的字节数上限，超出的请求直接失败
+        :param push_callback: RESP3推送消息，以及没有待应答请求时收到的应答(SUBSCRIBE后的消息等)交由其处理
+        :param connect_callback: 每次(重)连接发送connect指令后调用
+        :param disconnect_callback: 连接断开时调用
+        :param init_cmds: 每次(重)连接时调用，返回在AUTH, SELECT之后发送的指令列表，其应答不返回给业务
+        :param reader_cls: 应答解析器，提供feed(data), gets() --> (ok, reply)，默认为DEFAULT_READER
+        :param protocol: 2或3，为3时连接后以HELLO 3协商RESP3
+        :param metrics: NullMetrics的子类对象，接收请求生命周期各阶段的回调；None时不统计
+        :param io_loop: 默认为IOLoop.instance()
         """
-        self.__io_loop = IOLoop.instance()
+        self.__io_loop = io_loop or IOLoop.instance()
         self.__resp_cb = final_callback
         self.__stream = None
-        #redis应答解析remain
-        self.__recv_buf = ''
+        #redis应答增量解析
+        #hiredis不支持RESP3
+        self.__reader_cls = reader_cls or (DEFAULT_READER if 2 == protocol else RespReader)
+        self.__protocol = protocol
+        self.__reader = self.__reader_cls()
+        #当前请求已收到的应答
+        self.__replies = []
         self.__redis_tuple = redis_tuple
         self.__redis_pwd = redis_pwd
-        #redis指令上下文, connect指令个数(AUTH, SELECT .etc)，trans，cmd_count
+        #已写入指令的上下文, future，connect指令个数(AUTH, SELECT .etc)，trans，cmd_count
         self.__cmd_env = deque()
-        self.__cache_before_connect = []
-        self.__connected = False
+        #未写入的指令及其上下文，连接成功后按序重放
+        self.__cache_before_connect = deque()
+        self.__queued_bytes = 0
+        #当前IOStream上已写入及确认已发送到socket的字节数
+        self.__written_bytes = 0
+        self.__flushed_bytes = 0
+        self.__state = _STATE_CONNECTING
+        self.__batch_stats = batch_stats
+        #连续超时次数
+        self.__timeouts = 0
+        #自动pipeline时，本次IOLoop迭代内待写入的请求
+        self.__write_batch = []
+        self.__reconnect_delay = reconnect_delay
+        self.__max_reconnect_delay = max_reconnect_delay
+        self.__max_queued_bytes = max_queued_bytes
+        #连续重连失败次数
+        self.__reconnect_attempts = 0
+        self.__push_cb = push_callback
+        self.__connect_cb = connect_callback
+        self.__disconnect_cb = disconnect_callback
+        self.__init_cmds = init_cmds
+        #future --> 流式读取应答的sink
+        self.__sinks = {}
+        #正在写入的_SinkWriter
+        self.__sink_writer = None
+        #future --> 原样返回应答的阈值
+        self.__raw_limits = {}
+        self.__metrics = metrics
+        #future --> [统计名称, 写入时间, 是否已收到首字节]
+        self.__traces = {}
+        self.__connected_once = False
+        #请求离开连接(收到应答或失败)时调用，参见set_settle_callback
+        self.__settle_cb = None
 
     def con_ok(self):
         """
         连接对象是否ok
         :return:
         """
-        return self.__connected
+        return _STATE_CONNECTED == self.__state
 
-    def connect(self, init_future):
+    def closed(self):
         """
-        connect指令包括：AUTH, SELECT
-        :param init_future: 第一个future对象
+        连接已关闭，不能再写入
         """
-        #future, connect_count, transaction, cmd_count
-        self.__cmd_env.append((init_future, 1 + int(bool(self.__redis_pwd)), False, 0))
+        return _STATE_CLOSED == self.__state
+
+    def set_settle_callback(self, callback):
+        """
+        每个write的请求离开连接时在IOLoop中调用callback(conn)：收到应答(包括超时后迟到的应答)、
+        连接断开而失败、或连接前已超时而不再发送；超时本身不算离开，应答仍在线路上
+
+        :param callback: 连接池以此计数连接上未完成的请求
+        """
+        self.__settle_cb = callback
+
+    def __settled(self, count=1):
+        if self.__settle_cb is None:
+            return
+        for _ in xrange(count):
+            self.__io_loop.add_callback(self.__settle_cb, self)
+
+    def record_timeout(self):
+        """
+        记录一次请求超时，返回连续超时次数
+        """
+        self.__timeouts += 1
+        return self.__timeouts
+
+    def close(self):
+        """
+        主动关闭，未完成及未发送的请求均以RedisConnectionError失败
+        """
+        if _STATE_CLOSED == self.__state:
+            return
+        stream_alive = self.__state in (_STATE_CONNECTING, _STATE_CONNECTED)
+        self.__state = _STATE_CLOSED
+        if stream_alive and self.__stream is not None:
+            self.__stream.close()
+        else:
+            self.__fail_all(RedisConnectionError('redis connection closed'))
+
+    def close_inherited(self):
+        """
+        fork之后在子进程中调用：socket仍被父进程使用，且注册在父进程的IOLoop上(epoll与父进程共享)，
+        因此不发送任何指令、不经过IOStream.close从IOLoop移除，只关闭本进程的文件描述符；
+        未完成的请求属于父进程，不再回调
+        """
+        self.__state = _STATE_CLOSED
+        if self.__stream is not None and self.__stream.socket is not None:
+            self.__stream.socket.close()
+
+    def connect(self):
+        """
+        发起连接，连接成功后先发送connect指令：AUTH, SELECT
+        """
+        self.__state = _STATE_CONNECTING
+        self.__reader = self.__reader_cls()
+        self.__replies = []
+        self.__sink_writer = None
+        self.__written_bytes = 0
+        self.__flushed_bytes = 0
         self.__stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0),
                                  io_loop=self.__io_loop)
         self.__stream.set_close_callback(self.__on_close)
         self.__stream.connect(self.__redis_tuple[:2], self.__on_connect)
 
     def __on_connect(self):
-        """连接，只需要发送初始cmd即可
+        """连接，只需要发送初始cmd以及断开期间缓存的指令即可
         """
-        self.__connected = True
+        self.__state = _STATE_CONNECTED
+        self.__reconnect_attempts = 0
         self.__stream.set_nodelay(True)
-        self.__stream.read_until_close(self.__last_closd_recv, self.__on_resp)
-        self.__stream.write(chain_select_cmd(self.__redis_pwd, self.__redis_tuple[-1]))
-        for x in self.__cache_before_connect:
-            self.__stream.write(x)
-        self.__cache_before_connect = []
+        self.__read()
+
+        #future, connect_count, transaction, cmd_count
+        init_cmds = self.__init_cmds() if self.__init_cmds is not None else []
+        connect_count = chain_select_count(self.__redis_pwd, self.__redis_tuple[-1], self.__protocol) + \
+            len(init_cmds)
+        if connect_count:
+            self.__cmd_env.append((None, connect_count, False, 0))
+        bufs = [chain_select_cmd(self.__redis_pwd, self.__redis_tuple[-1], self.__protocol)]
+        bufs.extend(init_cmds)
+        for buf, env in self.__cache_before_connect:
+            #等待期间已超时的请求不再发送
+            if env[0].done():
+                self.__settled()
+                continue
+            bufs.append(buf)
+            self.__cmd_env.append(env)
+        self.__cache_before_connect.clear()
+        self.__queued_bytes = 0
+        buf = ''.join(bufs)
+        self.__stream_write(buf)
+        if self.__metrics is not None:
+            self.__metrics.on_connect(self.__connected_once)
+            self.__metrics.on_flush(len(buf), len(bufs) - 1 - len(init_cmds))
+        self.__connected_once = True
+        if self.__connect_cb is not None:
+            self.__connect_cb()
+
+    def write_buffer_size(self):
+        """
+        已写入IOStream尚未发送到socket的字节数，未连接时为缓存的指令字节数
+        """
+        if _STATE_CONNECTED != self.__state:
+            return self.__queued_bytes
+        return self.__written_bytes - self.__flushed_bytes
+
+    def __stream_write(self, buf):
+        self.__written_bytes += len(buf)
+        self.__stream.write(buf, functools.partial(self.__on_flushed, self.__stream, self.__written_bytes))
+
+    def __on_flushed(self, stream, written_bytes):
+        """
+        IOStream的写缓冲已清空，此前写入的written_bytes字节均已发送；
+        每次write会替换IOStream的回调，只有最近一次write的回调被调用
+        """
+        if stream is self.__stream and written_bytes > self.__flushed_bytes:
+            self.__flushed_bytes = written_bytes
+
+    def send(self, buf):
+        """
+        写入不需要匹配应答的指令(SUBSCRIBE等)，未连接时丢弃并返回False，由connect_callback在连接后重新发送
+        """
+        if _STATE_CONNECTED != self.__state or self.__stream.closed():
+            return False
+        self.__stream_write(buf)
+        return True
+
+    def write_internal(self, buf, cmd_count):
+        """
+        写入客户端自身的指令(SCRIPT LOAD, CLIENT TRACKING等)，与AUTH, SELECT一样按connect指令计数：
+        应答被丢弃，不回调、不计入连接池的未完成请求数；
+        未连接时丢弃，(重)连接时由init_cmds重新发送
+
+        :param cmd_count: buf中的指令个数
+        """
+        if _STATE_CONNECTED != self.__state or self.__stream.closed():
+            return False
+        self.__cmd_env.append((None, cmd_count, False, 0))
+        self.__stream_write(buf)
+        return True
 
-    def write(self, buf, new_future, active_trans, cmd_count):
+    def write(self, buf, new_future, active_trans, cmd_count, sink=None, raw_limits=None):
         """
         :param new_future: 由于闭包的影响，在resp回调函数中会保存上一次的future对象，该对象必须得到更新
         :param active_trans: 事务是否激活
         :param cmd_count: 指令个数
+        :param sink: 不为None时应答内容分段写入sink，参见RespReader.set_sink
+        :param raw_limits: 不为None时超过阈值的应答以RawReply返回，参见RespReader.set_raw；
+            reader_cls不支持截取原始字节(HiredisReader)时本连接改用RespReader
         """
-        self.__cmd_env.append((new_future, 0, active_trans, cmd_count))
-        if not self.__connected:
-            self.__cache_before_connect.append(buf)
+        env = (new_future, 0, active_trans, cmd_count)
+        if sink is not None:
+            self.__sinks[new_future] = sink
+            #失败或超时后不再写入sink
+            new_future.add_done_callback(lambda f: self.__sinks.pop(f, None))
+        if raw_limits is not None:
+            self.__raw_limits[new_future] = raw_limits
+            new_future.add_done_callback(lambda f: self.__raw_limits.pop(f, None))
+            if not getattr(self.__reader_cls, 'raw_capture', False):
+                #重连时同样使用RespReader
+                self.__reader_cls = RespReader
+                self.__switch_reader()
+        if self.__metrics is not None:
+            self.__trace(buf, new_future, active_trans, cmd_count)
+        #对端已关闭但close回调尚未执行时同样缓存
+        if _STATE_CONNECTED != self.__state or self.__stream.closed():
+            self.__cache(buf, env)
+            return
+        if self.__batch_stats is None:
+            self.__cmd_env.append(env)
+            self.__stream_write(buf)
+            if self.__metrics is not None:
+                self.__metrics.on_flush(len(buf), 1)
+            return
+
+        if not self.__write_batch:
+            self.__io_loop.add_callback(self.__flush_batch)
+        self.__write_batch.append((buf, env))
+
+    def __trace(self, buf, future, active_trans, cmd_count):
+        label = command_label(buf, active_trans, cmd_count)
+        self.__traces[future] = [label, self.__io_loop.time(), False]
+        future.add_done_callback(self.__untrace)
+        depth = len(self.__cmd_env) + len(self.__write_batch) + len(self.__cache_before_connect) + 1
+        self.__metrics.on_enqueue(label, depth)
+
+    def __untrace(self, future):
+        #应答解析时已移除，仍存在说明未收到应答
+        trace = self.__traces.pop(future, None)
+        if trace is not None:
+            self.__metrics.on_fail(trace[0])
+
+    def __cache(self, buf, env):
+        if _STATE_CLOSED == self.__state:
+            self.__run_callback({_RESP_FUTURE: env[0], RESP_ERR: RedisConnectionError('redis connection closed')})
+            self.__settled()
             return
-        self.__stream.write(buf)
+        if self.__max_queued_bytes is not None and self.__queued_bytes + len(buf) > self.__max_queued_bytes:
+            #先移除已超时的请求
+            queued = len(self.__cache_before_connect)
+            self.__cache_before_connect = deque(_ for _ in self.__cache_before_connect if not _[1][0].done())
+            self.__queued_bytes = sum(len(_[0]) for _ in self.__cache_before_connect)
+            self.__settled(queued - len(self.__cache_before_connect))
+        if self.__max_queued_bytes is not None and self.__queued_bytes + len(buf) > self.__max_queued_bytes:
+            self.__run_callback({_RESP_FUTURE: env[0],
+                                 RESP_ERR: RedisConnectionError('redis disconnected, queued bytes exceed limit')})
+            self.__settled()
+            return
+        self.__cache_before_connect.append((buf, env))
+        self.__queued_bytes += len(buf)
 
-    def __last_closd_recv(self, data):
+    def __flush_batch(self):
         """
-        socket关闭时最后几个字节
+        将本次IOLoop迭代内的请求合并为一次write，应答仍按__cmd_env顺序分发
         """
-        if not data:
+        batch = self.__write_batch
+        if not batch or self.__stream.closed():
+            #已关闭时由__on_close转入缓存
             return
+        self.__write_batch = []
+
+        for _, env in batch:
+            self.__cmd_env.append(env)
+        buf = ''.join([buf for buf, _ in batch])
+        self.__stream_write(buf)
+        if self.__metrics is not None:
+            self.__metrics.on_flush(len(buf), len(batch))
+        stats = self.__batch_stats
+        stats['flushes'] += 1
+        stats['requests'] += len(batch)
+        if len(batch) > stats['max_batch']:
+            stats['max_batch'] = len(batch)
+
+    def __read(self):
+        self.__stream.read_bytes(_READ_CHUNK, self.__on_read, partial=True)
+
+    def __on_read(self, data):
+        """
+        每次处理完收到的数据后再发起下一次读取；
+        sink(如IOStream)的写入未完成时暂停读取，由TCP流控限制redis的发送速度
+        """
         self.__on_resp(data)
+        stream = self.__stream
+        if stream.closed():
+            return
+        waiting = self.__sink_writer.waiting() if self.__sink_writer is not None else None
+        if waiting is None:
+            self.__read()
+            return
+        resume = functools.partial(self.__resume, stream, [False])
+        for future in waiting:
+            self.__io_loop.add_future(future, resume)
+
+    def __resume(self, stream, resumed, _):
+        if resumed[0] or stream is not self.__stream or stream.closed():
+            return
+        resumed[0] = True
+        self.__read()
 
     def __on_resp(self, recv):
         """
         :param recv: 收到的buf
         """
-        recv = ''.join((self.__recv_buf, recv))
+        if self.__metrics is None:
+            self.__dispatch_resp(recv)
+            return
 
-        idx = 0
-        for future, connect, trans, cmd in self.__cmd_env:
-            ok, payload, recv = decode_resp_ondemand(recv, connect, trans, cmd)
-            if not ok:
-                break
+        self.__metrics.on_recv(len(recv))
+        trace = self.__traces.get(self.__cmd_env[0][0]) if self.__cmd_env else None
+        if trace is not None and not trace[2]:
+            trace[2] = True
+            self.__metrics.on_first_byte(trace[0], self.__io_loop.time() - trace[1])
+        try:
+            self.__dispatch_resp(recv)
+        except ValueError as e:
+            self.__metrics.on_parse_error(e)
+            raise
 
-            idx += 1
+    def __dispatch_resp(self, recv):
+        self.__reader.feed(recv)
+
+        cmd_env = self.__cmd_env
+        while cmd_env:
+            future, connect, trans, cmd = cmd_env[0]
+            replies = self.__replies
+            expect = resp_count(connect, trans, cmd)
+            if not replies and future in self.__sinks:
+                self.__sink_writer = _SinkWriter(self.__sinks.pop(future), future)
+                self.__reader.set_sink(self.__sink_writer)
+            elif not replies and future in self.__raw_limits:
+                self.__reader.set_raw(*self.__raw_limits.pop(future))
+            while len(replies) < expect:
+                ok, reply = self.__reader.gets()
+                if not ok:
+                    return
+                if isinstance(reply, PushReply):
+                    self.__on_push(reply)
+                    continue
+                replies.append(reply)
+
+            cmd_env.popleft()
+            self.__replies = []
+            self.__sink_writer = None
+            if not cmd_env:
+                self.__switch_reader()
             if not connect:
-                self.__run_callback({_RESP_FUTURE: future, RESP_RESULT: payload})
+                if not future.done():
+                    self.__timeouts = 0
+                result = assemble_resp(replies, connect, trans, cmd)
+                trace = self.__traces.pop(future, None)
+                if trace is not None:
+                    self.__metrics.on_reply(trace[0], self.__io_loop.time() - trace[1],
+                                            isinstance(result, ResponseError))
+                self.__run_callback({_RESP_FUTURE: future, RESP_RESULT: result})
+                self.__settled()
+
+        while self.__push_cb is not None and not cmd_env:
+            ok, reply = self.__reader.gets()
+            if not ok:
+                return
+            self.__push_cb(reply)
 
-        self.__recv_buf = recv
-        for _ in xrange(idx):
-            self.__cmd_env.popleft()
+    def __switch_reader(self):
+        """
+        reader_cls变更后，在未开始读取或没有待收的应答时换用新的解析器，此时旧解析器中没有未解析的数据
+        """
+        if type(self.__reader) is self.__reader_cls:
+            return
+        if _STATE_CONNECTED != self.__state or not (self.__cmd_env or self.__replies):
+            self.__reader = self.__reader_cls()
+
+    def __on_push(self, reply):
+        if self.__push_cb is not None:
+            self.__push_cb(reply)
 
     def __run_callback(self, resp):
         if self.__resp_cb is None:
             return
         self.__io_loop.add_callback(self.__resp_cb, resp)
 
-    def __on_close(self):
-        self.__connected = False
+    def __fail_inflight(self, err):
+        """
+        已写入的请求无法确定是否被执行，均以err失败
+        """
         while len(self.__cmd_env) > 0:
-            self.__run_callback({_RESP_FUTURE: self.__cmd_env.popleft(), RESP_RESULT: 0})
-        self.__cmd_env.clear()
\ No newline at end of file
+            future, connect, _, _ = self.__cmd_env.popleft()
+            if not connect:
+                self.__run_callback({_RESP_FUTURE: future, RESP_ERR: err})
+                self.__settled()
+
+    def __fail_all(self, err):
+        self.__fail_inflight(err)
+        for _, env in self.__cache_before_connect:
+            self.__run_callback({_RESP_FUTURE: env[0], RESP_ERR: err})
+        self.__settled(len(self.__cache_before_connect))
+        self.__cache_before_connect.clear()
+        self.__queued_bytes = 0
+
+    def __on_close(self):
+        err = RedisConnectionError('redis connection closed', self.__stream.error)
+        #合并写入前断开，这部分指令未发送，可以安全重放
+        batch = self.__write_batch
+        self.__write_batch = []
+        for buf, env in reversed(batch):
+            self.__cache_before_connect.appendleft((buf, env))
+            self.__queued_bytes += len(buf)
+
+        if self.__disconnect_cb is not None:
+            self.__disconnect_cb()
+        if self.__metrics is not None:
+            self.__metrics.on_disconnect()
+        if _STATE_CLOSED == self.__state or self.__reconnect_delay is None:
+            self.__state = _STATE_CLOSED
+            self.__fail_all(err)
+            return
+
+        self.__fail_inflight(err)
+        self.__state = _STATE_DISCONNECTED
+        delay = min(self.__max_reconnect_delay, self.__reconnect_delay * (2 ** min(self.__reconnect_attempts, 16)))
+        self.__reconnect_attempts += 1
+        #随机抖动，避免故障转移后大量客户端同时重连
+        delay = random.uniform(delay / 2, delay)
+        self.__io_loop.add_timeout(self.__io_loop.time() + delay, self.__reconnect)
+
+    def __reconnect(self):
+        if _STATE_DISCONNECTED != self.__state:
+            return
+        self.connect()
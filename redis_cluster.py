@@ -0,0 +1,273 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+from tornado import gen
+from tornado.log import app_log
+from .redis_client import AsyncRedis
+from .redis_encode import cmd_args, redis_cluster_slots, redis_asking
+from .redis_error import RedisError, ResponseError, MovedError, AskError, ExecAbortError, first_error
+
+
+CLUSTER_SLOTS = 16384
+
+#无key的指令，发往任意节点
+_KEYLESS_CMDS = frozenset([
+    'PING', 'ECHO', 'PUBLISH', 'INFO', 'TIME', 'DBSIZE', 'RANDOMKEY', 'SCRIPT',
+    'CLUSTER', 'CONFIG', 'CLIENT', 'SCAN', 'FLUSHDB', 'FLUSHALL',
+])
+
+
+def _make_crc16_table():
+    table = []
+    for i in xrange(256):
+        crc = i << 8
+        for _ in xrange(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data):
+    """
+    CRC16-XMODEM，与redis cluster一致
+    """
+    crc = 0
+    for c in data:
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[((crc >> 8) ^ ord(c)) & 0xff]
+    return crc
+
+
+def key_slot(key):
+    """
+    计算key所属slot，存在非空hash tag({...})时只计算tag部分
+    """
+    start = key.find('{')
+    if start > -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1: end]
+    return crc16(key) % CLUSTER_SLOTS
+
+
+def _cmd_key(args):
+    """
+    :param args: cmd_args解析出的参数
+    :return: 用于路由的key，无key时为None
+    """
+    name = args[0].upper()
+    if name in ('EVAL', 'EVALSHA'):
+        return args[3] if int(args[2]) > 0 else None
+    if name in _KEYLESS_CMDS or len(args) < 2:
+        return None
+    return args[1]
+
+
+class AsyncRedisCluster(object):
+    """
+    redis cluster客户端，每个主节点对应一个AsyncRedis对象(含连接池)
+
+    invoke的多条指令按节点拆分为子pipeline并行发送，应答按原顺序重新组合；
+    收到MOVED时更新slot映射并重试，收到ASK时以ASKING发往目标节点。
+    事务要求所有指令位于同一节点。
+    """
+    def __init__(self, startup_nodes, redis_pwd=None, max_redirects=5, **client_opts):
+        """
+        :param startup_nodes: [(host, port), ...]，用于获取slot映射
+        :param redis_pwd: redis密码
+        :param max_redirects: 单条指令最多重定向次数
+        :param client_opts: 节点AsyncRedis对象的参数，例如max_conns, timeout
+        """
+        assert startup_nodes
+        self.__startup_nodes = [tuple(_) for _ in startup_nodes]
+        self.__pwd = redis_pwd
+        self.__max_redirects = max_redirects
+        self.__client_opts = client_opts
+        #(host, port) --> AsyncRedis
+        self.__clients = {}
+        #slot --> (host, port)
+        self.__slots = None
+        self.__refreshing = None
+
+    def node_client(self, node):
+        """
+        :param node: (host, port)
+        """
+        client = self.__clients.get(node)
+        if client is None:
+            client = AsyncRedis(redis_tuple=(node[0], node[1], 0, self.__pwd), **self.__client_opts)
+            self.__clients[node] = client
+        return client
+
+    @gen.coroutine
+    def nodes(self):
+        """
+        :return: 全部主节点的AsyncRedis对象
+        """
+        yield self.__ensure_slots()
+        raise gen.Return([self.node_client(_) for _ in sorted(set(self.__slots))])
+
+    def refresh_slots(self):
+        """
+        重新获取slot映射，并发调用时共享同一次请求
+        """
+        if self.__refreshing is None:
+            self.__refreshing = self.__load_slots()
+            self.__refreshing.add_done_callback(self.__on_refreshed)
+        return self.__refreshing
+
+    def __on_refreshed(self, _):
+        self.__refreshing = None
+
+    def __refresh_background(self):
+        """
+        后台刷新slot映射，不等待结果；已有刷新进行中时复用，失败只记录日志
+        """
+        if self.__refreshing is not None:
+            return
+        self.refresh_slots().add_done_callback(self.__on_background_refreshed)
+
+    def __on_background_refreshed(self, future):
+        if future.exception() is not None:
+            app_log.warning('background cluster slots refresh failed: %s', future.exception())
+
+    @gen.coroutine
+    def __load_slots(self):
+        #已知节点优先，其次是startup_nodes
+        candidates = list(set(self.__slots or ())) + self.__startup_nodes
+        last_err = None
+        for node in candidates:
+            try:
+                reply = yield self.node_client(node).invoke([redis_cluster_slots()], active_trans=False)
+            except RedisError as e:
+                last_err = e
+                continue
+            if isinstance(reply, ResponseError):
+                last_err = reply
+                continue
+
+            #每次新建映射再整体替换，新应答中没有的slot不保留旧节点
+            slots = [node] * CLUSTER_SLOTS
+            for item in reply:
+                start, end, master = item[0], item[1], item[2]
+                #host为空表示与被查询节点相同
+                master_node = master[0] or node[0], int(master[1])
+                for slot in xrange(start, end + 1):
+                    slots[slot] = master_node
+            self.__slots = slots
+            return
+        raise RedisError('load cluster slots failed', last_err)
+
+    @gen.coroutine
+    def __ensure_slots(self):
+        if self.__slots is None:
+            yield self.refresh_slots()
+
+    def __node_of(self, args):
+        key = _cmd_key(args)
+        if key is None:
+            return self.__slots[0]
+        return self.__slots[key_slot(key)]
+
+    @gen.coroutine
+    def invoke(self, iter_redis_cmds, **kwargs):
+        """参数与AsyncRedis.invoke一致
+
+        :param iter_redis_cmds: 多条redis指令
+        :param kwargs: active_trans等，其余参数透传给节点
+            raise_on_error: 处理完重定向后再检查错误应答，节点上总是以错误对象返回
+        """
+        yield self.__ensure_slots()
+
+        active_trans = kwargs.pop('active_trans', None)
+        if active_trans is None:
+            active_trans = True
+        raise_on_error = kwargs.pop('raise_on_error', self.__client_opts.get('raise_on_error', False))
+        kwargs['raise_on_error'] = False
+        cmds = list(iter_redis_cmds)
+        if not cmds:
+            raise gen.Return(())
+
+        if active_trans:
+            result = yield self.__invoke_trans(cmds, kwargs)
+        else:
+            result = yield self.__invoke_pipeline(cmds, kwargs)
+        err = first_error(result, len(cmds) > 1) if raise_on_error else None
+        if err is not None:
+            raise err
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def __invoke_pipeline(self, cmds, kwargs):
+        results = [None] * len(cmds)
+        #(原序号, 指令, 目标节点, 是否ASKING)
+        pending = [(i, cmd, None, False) for i, cmd in enumerate(cmds)]
+        for _ in xrange(self.__max_redirects + 1):
+            if not pending:
+                break
+            #超过重定向次数时，结果中保留最后一次的MOVED/ASK应答
+            pending = yield self.__invoke_round(pending, results, kwargs)
+
+        raise gen.Return(results[0] if 1 == len(results) else tuple(results))
+
+    @gen.coroutine
+    def __invoke_round(self, pending, results, kwargs):
+        """
+        按节点拆分后并行发送，返回需重定向的指令
+        """
+        groups = {}
+        for i, cmd, node, asking in pending:
+            if node is None:
+                node = self.__node_of(cmd_args(cmd))
+            groups.setdefault(node, []).append((i, cmd, asking))
+
+        nodes = list(groups)
+        futures = []
+        for node in nodes:
+            sub_cmds = []
+            for _, cmd, asking in groups[node]:
+                if asking:
+                    sub_cmds.append(redis_asking())
+                sub_cmds.append(cmd)
+            futures.append(self.node_client(node).invoke(sub_cmds, active_trans=False, **kwargs))
+        replies = yield futures
+
+        redirects = []
+        moved = False
+        for node, reply in zip(nodes, replies):
+            if 1 == len(groups[node]) and not groups[node][0][2]:
+                reply = (reply,)
+            reply = iter(reply)
+            for i, cmd, asking in groups[node]:
+                if asking:
+                    #ASKING的+OK
+                    next(reply)
+                r = next(reply)
+                results[i] = r
+                if isinstance(r, MovedError):
+                    moved = True
+                    self.__slots[r.slot] = r.node
+                    redirects.append((i, cmd, r.node, False))
+                elif isinstance(r, AskError):
+                    redirects.append((i, cmd, r.node, True))
+
+        if moved:
+            #MOVED通常意味着发生了reshard，后台刷新完整映射
+            self.__refresh_background()
+        raise gen.Return(redirects)
+
+    @gen.coroutine
+    def __invoke_trans(self, cmds, kwargs):
+        for _ in xrange(self.__max_redirects + 1):
+            nodes = set(self.__node_of(cmd_args(cmd)) for cmd in cmds)
+            if 1 != len(nodes):
+                raise RedisError('transaction keys span multiple cluster nodes')
+            result = yield self.node_client(nodes.pop()).invoke(cmds, active_trans=True, **kwargs)
+            #MOVED时命令未被QUEUED，EXEC返回EXECABORT
+            if not isinstance(result, ExecAbortError):
+                raise gen.Return(result)
+            yield self.refresh_slots()
+        raise gen.Return(result)
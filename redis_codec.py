@@ -0,0 +1,333 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import json
+import zlib
+import cPickle
+from .redis_encode import _encode_req, decode_req
+from .redis_error import ResponseError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+
+SERIALIZERS = ('bytes', 'json', 'pickle', 'msgpack')
+COMPRESSORS = (None, 'zlib', 'lz4')
+
+#头部字节: 0xF5 + 压缩方式 * 4 + 序列化方式 - 1，均不是utf-8的首字节，文本值不会被误认
+#不压缩的bytes不加头部，原样保存
+_HEADER_BASE = 0xF5
+_HEADER_MIN = chr(_HEADER_BASE)
+
+
+def _header(serializer_id, compressor_id):
+    return chr(_HEADER_BASE + compressor_id * 4 + serializer_id - 1)
+
+
+def _serialize(serializer_id, value):
+    if 0 == serializer_id:
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value if isinstance(value, str) else str(value)
+    if 1 == serializer_id:
+        return json.dumps(value, separators=(',', ':'))
+    if 2 == serializer_id:
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _deserialize(serializer_id, data):
+    if 0 == serializer_id:
+        return data
+    if 1 == serializer_id:
+        return json.loads(data)
+    if 2 == serializer_id:
+        return cPickle.loads(data)
+    return msgpack.unpackb(data, raw=False)
+
+
+def _compress(compressor_id, data, level):
+    if 1 == compressor_id:
+        return zlib.compress(data, level)
+    return lz4.compress(data)
+
+
+def _decompress(compressor_id, data):
+    if 1 == compressor_id:
+        return zlib.decompress(data)
+    return lz4.decompress(data)
+
+
+def decode_value(data):
+    """
+    按头部字节解码ValueCodec.encode的结果，与编码时使用的ValueCodec无关；
+    没有头部的值，或头部之后的内容无法解压、反序列化的值(其他程序写入的二进制数据)原样返回
+
+    :param data: redis返回的字符串
+    """
+    if not data or data[0] < _HEADER_MIN:
+        return data
+    code = ord(data[0]) - _HEADER_BASE + 1
+    compressor_id, serializer_id = divmod(code, 4)
+    try:
+        if compressor_id:
+            payload = _decompress(compressor_id, buffer(data, 1))
+        else:
+            payload = data[1:]
+        return _deserialize(serializer_id, payload)
+    except Exception:
+        return data
+
+
+class ValueCodec(object):
+    """
+    值的序列化及压缩，结果首字节标明格式，解码时不需要知道编码参数
+
+    codec = ValueCodec('json', 'zlib', compress_threshold=512)
+    codec.decode(codec.encode({'a': 1})) --> {u'a': 1}
+    """
+    def __init__(self, serializer='json', compressor='zlib', compress_threshold=1024, level=6):
+        """
+        :param serializer: SERIALIZERS之一，bytes只做类型转换，msgpack需要安装msgpack
+        :param compressor: COMPRESSORS之一，lz4需要安装lz4
+        :param compress_threshold: 序列化后不少于该字节数时压缩，压缩后未变小时保存未压缩的值
+        :param level: zlib压缩级别
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError('serializer invalid: {0}'.format(serializer))
+        if compressor not in COMPRESSORS:
+            raise ValueError('compressor invalid: {0}'.format(compressor))
+        if 'msgpack' == serializer and msgpack is None:
+            raise ValueError('msgpack not installed')
+        if 'lz4' == compressor and lz4 is None:
+            raise ValueError('lz4 not installed')
+        self.__serializer_id = SERIALIZERS.index(serializer)
+        self.__compressor_id = COMPRESSORS.index(compressor)
+        self.__threshold = compress_threshold
+        self.__level = level
+
+    def encode(self, value):
+        """
+        :return: 带格式头部的字符串；bytes且未压缩时为原值
+        """
+        data = _serialize(self.__serializer_id, value)
+        if self.__compressor_id and len(data) >= self.__threshold:
+            compressed = _compress(self.__compressor_id, data, self.__level)
+            if len(compressed) < len(data):
+                return _header(self.__serializer_id, self.__compressor_id) + compressed
+        if 0 != self.__serializer_id:
+            return _header(self.__serializer_id, 0) + data
+        if not data or data[0] < _HEADER_MIN:
+            return data
+        #以头部字节开头的原始值，以zlib格式保存以免被误解码
+        return _header(0, 1) + zlib.compress(data, self.__level)
+
+    def decode(self, data):
+        return decode_value(data)
+
+
+#写入值的指令 --> (首个值的位置, 步长)，步长为None时只有一个值；LREM, LINSERT的比较值同样编码
+_WRITE_CMDS = {
+    'SET': (2, None), 'GETSET': (2, None), 'SETNX': (2, None), 'SETEX': (3, None), 'PSETEX': (3, None),
+    'HSET': (3, 2), 'HMSET': (3, 2), 'HSETNX': (3, None),
+    'RPUSH': (2, 1), 'LPUSH': (2, 1), 'RPUSHX': (2, 1), 'LPUSHX': (2, 1),
+    'LSET': (3, None), 'LREM': (3, None), 'LINSERT': (3, 1),
+}
+
+#key与值交替出现的指令
+_PAIR_CMDS = frozenset(['MSET', 'MSETNX'])
+
+#读取值的指令 --> 应答中值的位置
+#value: 应答为值(LPOP带count时为值的列表)，each: 应答的各元素，hash: HGETALL的值(RESP2为交替的域和值)，
+#keys: MGET各元素对应各自的key，pop: BLPOP的(key, 值)
+_READ_CMDS = {
+    'GET': 'value', 'GETDEL': 'value', 'GETEX': 'value', 'GETSET': 'value', 'HGET': 'value',
+    'LINDEX': 'value', 'LPOP': 'value', 'RPOP': 'value', 'RPOPLPUSH': 'value', 'BRPOPLPUSH': 'value',
+    'LMOVE': 'value', 'BLMOVE': 'value',
+    'LRANGE': 'each', 'HVALS': 'each', 'HMGET': 'each',
+    'HGETALL': 'hash',
+    'MGET': 'keys',
+    'BLPOP': 'pop', 'BRPOP': 'pop',
+}
+
+
+def _cmd_name(cmd):
+    """
+    :param cmd: 单条已编码的指令
+    :return: 大写的指令名，不解析其余参数
+    """
+    end = cmd.index('\r\n')
+    start = cmd.index('\r\n', end + 2) + 2
+    return cmd[start: start + int(cmd[end + 3: start - 2])].upper()
+
+
+def _decode_str(value):
+    return decode_value(value) if isinstance(value, str) else value
+
+
+def _decode_reply(spec, reply):
+    if spec is None or reply is None or isinstance(reply, ResponseError):
+        return reply
+    kind = spec[0]
+    if 'value' == kind:
+        if isinstance(reply, tuple):
+            return tuple([_decode_str(_) for _ in reply])
+        return _decode_str(reply)
+    if 'each' == kind and isinstance(reply, tuple):
+        return tuple([_decode_str(_) for _ in reply])
+    if 'hash' == kind:
+        if isinstance(reply, dict):
+            return dict((k, _decode_str(v)) for k, v in reply.iteritems())
+        if isinstance(reply, tuple):
+            return tuple([_decode_str(v) if i & 1 else v for i, v in enumerate(reply)])
+    if 'keys' == kind and isinstance(reply, tuple):
+        return tuple([_decode_str(v) if flag else v for flag, v in zip(spec[1], reply)])
+    if 'pop' == kind and isinstance(reply, tuple) and 2 == len(reply) and reply[0] in spec[1]:
+        return reply[0], _decode_str(reply[1])
+    return reply
+
+
+class ReplyDecoder(object):
+    """
+    按指令解码应答中属于已注册key前缀的值，其余字符串(key, 域名, 游标等)不变；只含基本类型，可pickle
+    """
+    def __init__(self, specs, multi):
+        """
+        :param specs: 每条指令的(类型, 参数)，不需要解码时为None
+        :param multi: 应答是否为每条指令一个元素的tuple
+        """
+        self.specs = specs
+        self.multi = multi
+
+    def __call__(self, result):
+        if not self.multi:
+            return _decode_reply(self.specs[0], result)
+        #事务被放弃(None)或EXECABORT
+        if not isinstance(result, tuple):
+            return result
+        return tuple([_decode_reply(spec, r) for spec, r in zip(self.specs, result)])
+
+
+class KeyCodecs(object):
+    """
+    key前缀 --> ValueCodec，按最长前缀匹配；前缀为''时作用于全部key
+
+    以AsyncRedis(value_codecs=...)配置，invoke时写入指令中的值按key编码，读取指令应答中的值解码：
+    codecs = KeyCodecs()
+    codecs.register('user:', ValueCodec('json', 'zlib'))
+    client = AsyncRedis('redis://localhost:6379/1', value_codecs=codecs)
+    yield client.invoke([('SET', 'user:1', {'name': 'a'})])  #dict等对象以参数tuple传入
+    user = yield client.invoke([redis_get('user:1')])  #dict
+    """
+    def __init__(self):
+        self.__codecs = {}
+        #已注册前缀的长度，从长到短
+        self.__lengths = ()
+
+    def register(self, prefix, codec):
+        """
+        :param codec: ValueCodec对象，None表示取消该前缀的注册
+        """
+        if codec is None:
+            self.__codecs.pop(prefix, None)
+        else:
+            self.__codecs[prefix] = codec
+        self.__lengths = tuple(sorted(set(len(_) for _ in self.__codecs), reverse=True))
+
+    def codec_for(self, key):
+        """
+        :return: key对应的ValueCodec，没有时返回None
+        """
+        for n in self.__lengths:
+            codec = self.__codecs.get(key[:n])
+            if codec is not None:
+                return codec
+        return None
+
+    def encode(self, key, value):
+        """
+        :return: key没有对应的codec时原样返回value
+        """
+        if not self.__lengths:
+            return value
+        codec = self.codec_for(key)
+        return value if codec is None else codec.encode(value)
+
+    def encode_args(self, args):
+        """
+        :param args: 指令名及参数
+        :return: 值已编码的参数tuple，不需要编码时返回args本身
+        """
+        name = args[0].upper()
+        if name in _PAIR_CMDS:
+            encoded = list(args)
+            for i in xrange(2, len(args), 2):
+                encoded[i] = self.encode(args[i - 1], args[i])
+            return tuple(encoded)
+        positions = _WRITE_CMDS.get(name)
+        if positions is None or len(args) < 2:
+            return args
+        codec = self.codec_for(args[1])
+        if codec is None:
+            return args
+        start, step = positions
+        encoded = list(args)
+        for i in xrange(start, len(args) if step else min(start + 1, len(args)), step or 1):
+            encoded[i] = codec.encode(args[i])
+        return tuple(encoded)
+
+    def encode_cmd(self, cmd):
+        """
+        :param cmd: 单条已编码的指令(redis_*函数的返回值)或参数tuple
+        :return: 值已编码的指令
+        """
+        if isinstance(cmd, tuple):
+            return _encode_req(*self.encode_args(cmd))
+        name = _cmd_name(cmd)
+        if name not in _WRITE_CMDS and name not in _PAIR_CMDS:
+            return cmd
+        args = decode_req(cmd)
+        encoded = self.encode_args(args)
+        return cmd if encoded is args else _encode_req(*encoded)
+
+    def reply_spec(self, cmd):
+        """
+        :param cmd: 单条已编码的指令
+        :return: 传给ReplyDecoder的(类型, 参数)，应答中没有需要解码的值时返回None
+        """
+        kind = _READ_CMDS.get(_cmd_name(cmd))
+        if kind is None:
+            return None
+        args = decode_req(cmd)
+        if len(args) < 2:
+            return None
+        if 'keys' == kind:
+            flags = tuple(self.codec_for(_) is not None for _ in args[1:])
+            return (kind, flags) if any(flags) else None
+        if 'pop' == kind:
+            keys = frozenset(_ for _ in args[1:-1] if self.codec_for(_) is not None)
+            return (kind, keys) if keys else None
+        return (kind,) if self.codec_for(args[1]) is not None else None
+
+    def prepare(self, cmds, multi=None):
+        """
+        invoke发送前调用
+
+        :param cmds: 已编码的指令或参数tuple
+        :param multi: 应答是否为每条指令一个元素的tuple，None时按指令条数判断；
+            自行拼接MULTI/EXEC时为True，解码EXEC的应答
+        :return: 值已编码的指令列表, ReplyDecoder(没有需要解码的应答时为None)
+        """
+        cmds = [self.encode_cmd(_) for _ in cmds]
+        specs = [self.reply_spec(_) for _ in cmds]
+        if not any(specs):
+            return cmds, None
+        return cmds, ReplyDecoder(tuple(specs), len(cmds) > 1 if multi is None else multi)
@@ -1,14 +1,20 @@
 #coding:utf-8
 
-
-from itertools import imap
-
+import hashlib
 
 _SYM_STAR = '*'
 _SYM_DOLLAR = '$'
 _SYM_CRLF = '\r\n'
 _SYM_EMPTY = ''
 
+#缓存长度小于该值的$len\r\n, *N\r\n头部
+_HEADER_CACHE_SIZE = 1024
+_BULK_HEADERS = ['$%d\r\n' % _ for _ in xrange(_HEADER_CACHE_SIZE)]
+_MULTI_HEADERS = ['*%d\r\n' % _ for _ in xrange(_HEADER_CACHE_SIZE)]
+#(指令名, 参数个数) --> 已编码的'*N\r\n$len\r\nNAME\r\n'
+_CMD_PREFIXES = {}
+_CMD_PREFIXES_LIMIT = 4096
+
 
 def __encode(value, encoding='utf-8', encoding_errors='strict'):
     """Return a bytestring representation of the value
@@ -17,19 +23,119 @@ def __encode(value, encoding='utf-8', encoding_errors='strict'):
         return value
     if isinstance(value, float):
         return repr(value)
-    if not isinstance(value, str):
-        return str(value)
     if isinstance(value, unicode):
         return value.encode(encoding, encoding_errors)
-    return value
+    return str(value)
+
+
+def _cmd_prefix(name, argc):
+    """
+    指令名及参数个数固定的部分，编码后缓存
+    """
+    key = name, argc
+    prefix = _CMD_PREFIXES.get(key)
+    if prefix is None:
+        name = __encode(name)
+        prefix = _SYM_EMPTY.join((_MULTI_HEADERS[argc] if argc < _HEADER_CACHE_SIZE else '*%d\r\n' % argc,
+                                  _BULK_HEADERS[len(name)], name, _SYM_CRLF))
+        if len(_CMD_PREFIXES) < _CMD_PREFIXES_LIMIT:
+            _CMD_PREFIXES[key] = prefix
+    return prefix
+
+
+def _encode_into(parts, args):
+    """
+    将一条指令的各部分追加到parts中，不生成中间字符串
+    """
+    parts.append(_cmd_prefix(args[0], len(args)))
+    for k in args[1:]:
+        if type(k) is not str:
+            k = __encode(k)
+        k_len = len(k)
+        parts.append(_BULK_HEADERS[k_len] if k_len < _HEADER_CACHE_SIZE else '$%d\r\n' % k_len)
+        parts.append(k)
+        parts.append(_SYM_CRLF)
 
 
 def _encode_req(*args):
     """编码请求格式, 从Redis库中摘来
+
+    指令名部分及常用长度的头部均使用缓存
+    """
+    parts = []
+    _encode_into(parts, args)
+    return _SYM_EMPTY.join(parts)
+
+
+class CommandBuffer(object):
+    """
+    多条指令编码到同一缓冲区，可直接传给AsyncRedis.invoke，省去逐条生成字符串再拼接
+
+    buf = CommandBuffer()
+    for k in keys:
+        buf.append('GET', k)
+    values = yield client.invoke(buf, active_trans=False)
     """
-    args_output = _SYM_EMPTY.join(
-        [_SYM_EMPTY.join((_SYM_DOLLAR, str(len(k)), _SYM_CRLF, k, _SYM_CRLF)) for k in imap(__encode, args)])
-    return _SYM_EMPTY.join((_SYM_STAR, str(len(args)), _SYM_CRLF, args_output))
+    def __init__(self):
+        self.__parts = []
+        #每条指令在parts中的结束位置
+        self.__bounds = []
+
+    def append(self, *args):
+        """
+        :param args: 指令名及参数，与_encode_req一致
+        """
+        _encode_into(self.__parts, args)
+        self.__bounds.append(len(self.__parts))
+
+    def append_encoded(self, cmd):
+        """
+        :param cmd: redis_*函数返回的已编码指令
+        """
+        self.__parts.append(cmd)
+        self.__bounds.append(len(self.__parts))
+
+    def getvalue(self):
+        return _SYM_EMPTY.join(self.__parts)
+
+    def __len__(self):
+        return len(self.__bounds)
+
+    def __iter__(self):
+        """
+        逐条返回已编码的指令，供需要按指令路由的场景使用
+        """
+        start = 0
+        for end in self.__bounds:
+            yield _SYM_EMPTY.join(self.__parts[start: end])
+            start = end
+
+
+def decode_req(buf):
+    """_encode_req的逆操作，用于路由等需要查看指令内容的场景
+
+    :param buf: 单条已编码的指令
+    :return: 参数tuple，首元素为指令名
+    """
+    end = buf.index(_SYM_CRLF)
+    count = int(buf[1: end])
+    pos = end + 2
+    args = []
+    for _ in xrange(count):
+        end = buf.index(_SYM_CRLF, pos)
+        arg_len = int(buf[pos + 1: end])
+        pos = end + 2
+        args.append(buf[pos: pos + arg_len])
+        pos += arg_len + 2
+    return tuple(args)
+
+
+def cmd_args(cmd):
+    """
+    :param cmd: 已编码的指令，或(指令名, 参数...)的tuple
+    :return: 参数tuple，首元素为指令名
+    """
+    return cmd if isinstance(cmd, tuple) else decode_req(cmd)
 
 
 def redis_auth(password):
@@ -44,6 +150,30 @@ def redis_pub(ch, msg):
     return _encode_req('PUBLISH', ch, msg)
 
 
+def redis_subscribe(*channels):
+    assert channels
+    return _encode_req('SUBSCRIBE', *channels)
+
+
+def redis_unsubscribe(*channels):
+    """
+    :param channels: 为空时退订全部频道
+    """
+    return _encode_req('UNSUBSCRIBE', *channels)
+
+
+def redis_psubscribe(*patterns):
+    assert patterns
+    return _encode_req('PSUBSCRIBE', *patterns)
+
+
+def redis_punsubscribe(*patterns):
+    """
+    :param patterns: 为空时退订全部模式
+    """
+    return _encode_req('PUNSUBSCRIBE', *patterns)
+
+
 def redis_hdel(key, field):
     assert key and isinstance(key, str)
     assert field and isinstance(field, str)
@@ -313,6 +443,7 @@ def redis_blpop(timeout, *keys):
     * 禁止pipeline
     * 禁止在server中使用，只能在mq中使用
     * 禁止和AUTH, SELECT等一起使用形成pipeline
+    以上限制均来自与其他请求共用连接，AsyncRedis.pinned()的独占连接及redis_queue.QueueConsumer不受影响
         
     :param timeout: 超时时间，一般为0，表示一直阻塞
     :param keys: 键值列表
@@ -325,6 +456,47 @@ def redis_blpop(timeout, *keys):
     return _encode_req('BLPOP', *params)
 
 
+def redis_lpush(key, value):
+    assert key and isinstance(key, str)
+
+    return _encode_req('LPUSH', key, value)
+
+
+def redis_lrem(key, count, value):
+    """
+    移除列表中与value相等的元素，count > 0从表头开始移除count个，< 0从表尾开始，0移除全部
+    """
+    assert key and isinstance(key, str)
+    assert isinstance(count, int)
+
+    return _encode_req('LREM', key, count, value)
+
+
+def redis_lmove(source, destination, wherefrom='LEFT', whereto='RIGHT'):
+    """
+    原子地从source弹出一个元素并推入destination，返回该元素；source为空时返回None。redis 6.2+
+    """
+    assert source and isinstance(source, str)
+    assert destination and isinstance(destination, str)
+    assert wherefrom in ('LEFT', 'RIGHT') and whereto in ('LEFT', 'RIGHT')
+
+    return _encode_req('LMOVE', source, destination, wherefrom, whereto)
+
+
+def redis_blmove(source, destination, timeout, wherefrom='LEFT', whereto='RIGHT'):
+    """
+    LMOVE的阻塞版本，超时返回None；使用限制同redis_blpop，应通过AsyncRedis.pinned()的独占连接发送
+
+    :param timeout: 秒数，可为小数，0表示一直阻塞
+    """
+    assert source and isinstance(source, str)
+    assert destination and isinstance(destination, str)
+    assert isinstance(timeout, (int, float)) and timeout >= 0
+    assert wherefrom in ('LEFT', 'RIGHT') and whereto in ('LEFT', 'RIGHT')
+
+    return _encode_req('BLMOVE', source, destination, wherefrom, whereto, timeout)
+
+
 def redis_lrange(key, begin, end):
     """
     :param begin: 开始索引
@@ -343,17 +515,169 @@ def redis_rpush(key, value):
     return _encode_req('RPUSH', key, value)
 
 
-def chain_select_cmd(auth_pwd, select_db):
+def _scan_req(params, match, count):
+    if match is not None:
+        assert match and isinstance(match, str)
+        params.extend(('MATCH', match))
+    if count is not None:
+        assert isinstance(count, int) and count > 0
+        params.extend(('COUNT', count))
+    return _encode_req(*params)
+
+
+def redis_scan(cursor, match=None, count=None, type_=None):
+    """
+    :param cursor: 游标，首次为0
+    :param type_: 只返回该类型的key(redis 6.0+)
+    :return: 应答为(next_cursor, (key, ...))，next_cursor为'0'时遍历结束
+    """
+    params = ['SCAN', cursor]
+    if type_ is not None:
+        assert type_ and isinstance(type_, str)
+        params.extend(('TYPE', type_))
+    return _scan_req(params, match, count)
+
+
+def redis_hscan(key, cursor, match=None, count=None):
+    """
+    :return: 应答为(next_cursor, (field, value, field, value...))
+    """
+    assert key and isinstance(key, str)
+    return _scan_req(['HSCAN', key, cursor], match, count)
+
+
+def redis_sscan(key, cursor, match=None, count=None):
+    assert key and isinstance(key, str)
+    return _scan_req(['SSCAN', key, cursor], match, count)
+
+
+def redis_zscan(key, cursor, match=None, count=None):
+    """
+    :return: 应答为(next_cursor, (member, score, member, score...))
+    """
+    assert key and isinstance(key, str)
+    return _scan_req(['ZSCAN', key, cursor], match, count)
+
+
+def redis_sentinel_master(service_name):
+    """
+    :return: 应答为(ip, port)，未知的service_name返回None
+    """
+    assert service_name and isinstance(service_name, str)
+    return _encode_req('SENTINEL', 'get-master-addr-by-name', service_name)
+
+
+def redis_sentinel_replicas(service_name):
+    """
+    :return: 应答为各从库的属性列表，每个从库为(name, value, name, value...)
+    """
+    assert service_name and isinstance(service_name, str)
+    return _encode_req('SENTINEL', 'slaves', service_name)
+
+
+def redis_client_id():
+    return _encode_req('CLIENT', 'ID')
+
+
+def redis_client_tracking(redirect_id=None):
+    """
+    开启客户端缓存跟踪
+
+    :param redirect_id: 失效消息转发到的连接CLIENT ID，None表示推送到本连接(RESP3)
+    """
+    if redirect_id is None:
+        return _encode_req('CLIENT', 'TRACKING', 'on')
+    return _encode_req('CLIENT', 'TRACKING', 'on', 'REDIRECT', redirect_id)
+
+
+def redis_cluster_slots():
+    return _encode_req('CLUSTER', 'SLOTS')
+
+
+def redis_asking():
+    """
+    收到ASK重定向后，在目标节点上先发送ASKING
+    """
+    return _encode_req('ASKING')
+
+
+def redis_watch(*keys):
+    assert keys
+    return _encode_req('WATCH', *keys)
+
+
+def redis_unwatch():
+    return _encode_req('UNWATCH')
+
+
+def redis_eval(script, keys=(), args=()):
+    """
+    :param keys: 脚本中的KEYS
+    :param args: 脚本中的ARGV
+    """
+    assert script and isinstance(script, str)
+    return _encode_req('EVAL', script, len(keys), *(tuple(keys) + tuple(args)))
+
+
+def redis_evalsha(sha, keys=(), args=()):
+    assert sha and isinstance(sha, str)
+    return _encode_req('EVALSHA', sha, len(keys), *(tuple(keys) + tuple(args)))
+
+
+def redis_script_load(script):
+    """
+    :return: 应答为脚本的sha1
+    """
+    assert script and isinstance(script, str)
+    return _encode_req('SCRIPT', 'LOAD', script)
+
+
+class Script(object):
+    """
+    Lua脚本，sha1在本地计算，调用时编码为EVALSHA
+
+    由AsyncRedis.register_script创建，连接(重连)后自动SCRIPT LOAD；
+    返回的指令可与其他指令一起pipeline或放入事务
+
+    incr_max = client.register_script(LUA_TEXT)
+    value = yield client.invoke([incr_max(keys=['counter'], args=[100])])
+    """
+    def __init__(self, script):
+        assert script and isinstance(script, str)
+        self.script = script
+        self.sha = hashlib.sha1(script).hexdigest()
+
+    def __call__(self, keys=(), args=()):
+        return redis_evalsha(self.sha, keys, args)
+
+
+def chain_select_cmd(auth_pwd, select_db, protocol=2):
     """
     选择库的同时发送指令，作为一个pipe
+
+    :param select_db: 为None时不发送SELECT(sentinel等不支持SELECT的服务)
+    :param protocol: 为3时以HELLO 3(包含AUTH)协商RESP3
     """
     if auth_pwd:
         if not isinstance(auth_pwd, str):
             raise ValueError('auth_pwd invalid: {0}'.format(auth_pwd))
-    if not (isinstance(select_db, int) and 0 <= select_db <= 15):
+    if select_db is not None and not (isinstance(select_db, int) and 0 <= select_db <= 15):
         raise ValueError('select_db invalid: {0}'.format(select_db))
+    if protocol not in (2, 3):
+        raise ValueError('protocol invalid: {0}'.format(protocol))
 
+    if 3 == protocol:
+        auth = _encode_req('HELLO', 3, 'AUTH', 'default', auth_pwd) if auth_pwd else _encode_req('HELLO', 3)
+    else:
+        auth = '' if not auth_pwd else _encode_req('AUTH', auth_pwd)
     return ''.join((
-        '' if not auth_pwd else _encode_req('AUTH', auth_pwd),
-        _encode_req('SELECT', select_db)
-    ))
\ No newline at end of file
+        auth,
+        '' if select_db is None else _encode_req('SELECT', select_db)
+    ))
+
+
+def chain_select_count(auth_pwd, select_db, protocol=2):
+    """
+    chain_select_cmd包含的指令个数
+    """
+    return int(bool(auth_pwd) or 3 == protocol) + int(select_db is not None)
@@ -0,0 +1,194 @@
+#coding:utf-8
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisTimeoutError(RedisError):
+    """
+    请求在超时时间内未收到应答
+    """
+    pass
+
+
+class RedisConnectionError(RedisError):
+    """
+    连接断开，请求未收到应答
+    """
+    pass
+
+
+class WatchError(RedisError):
+    """
+    WATCH的key被修改导致事务放弃，重试次数用完
+    """
+    pass
+
+
+class ResponseError(RedisError):
+    """
+    redis返回的错误应答(-ERR ...)，默认作为应答值原样返回，invoke(raise_on_error=True)时抛出
+
+    按错误前缀解析为对应的子类，未知前缀为ResponseError本身
+    """
+    @property
+    def code(self):
+        """
+        错误前缀，如ERR, WRONGTYPE
+        """
+        return str(self).split(' ', 1)[0]
+
+
+class _RedirectError(ResponseError):
+    """
+    集群重定向，格式: <MOVED|ASK> slot host:port
+    """
+    def __init__(self, msg):
+        ResponseError.__init__(self, msg)
+        _, slot, addr = msg.split(' ', 2)
+        host, port = addr.rsplit(':', 1)
+        self.slot = int(slot)
+        self.node = host, int(port)
+
+
+class MovedError(_RedirectError):
+    """
+    slot已迁移到其他节点，需更新slot映射
+    """
+    pass
+
+
+class AskError(_RedirectError):
+    """
+    slot迁移中，本次请求需以ASKING发往目标节点
+    """
+    pass
+
+
+class NoScriptError(ResponseError):
+    """
+    EVALSHA的脚本不在redis的脚本缓存中(SCRIPT FLUSH, 故障切换等)
+    """
+    pass
+
+
+class WrongTypeError(ResponseError):
+    """
+    指令与key的类型不符
+    """
+    pass
+
+
+class BusyError(ResponseError):
+    """
+    Lua脚本执行超时，redis暂不处理其他指令，可稍后重试或SCRIPT KILL
+    """
+    pass
+
+
+class LoadingError(ResponseError):
+    """
+    redis正在加载数据，可稍后重试
+    """
+    pass
+
+
+class OutOfMemoryError(ResponseError):
+    """
+    超过maxmemory，写指令被拒绝
+    """
+    pass
+
+
+class ExecAbortError(ResponseError):
+    """
+    事务中有指令入队失败，EXEC被放弃
+    """
+    pass
+
+
+class ReadOnlyError(ResponseError):
+    """
+    写指令发往了从库，通常发生在故障切换之后
+    """
+    pass
+
+
+class AuthenticationError(ResponseError):
+    """
+    NOAUTH, WRONGPASS
+    """
+    pass
+
+
+class NoPermissionError(ResponseError):
+    """
+    ACL不允许执行该指令
+    """
+    pass
+
+
+class TryAgainError(ResponseError):
+    """
+    集群slot迁移中多key指令暂时不可用
+    """
+    pass
+
+
+class ClusterDownError(ResponseError):
+    """
+    CLUSTERDOWN, MASTERDOWN
+    """
+    pass
+
+
+class CrossSlotError(ResponseError):
+    """
+    多key指令的key不在同一slot
+    """
+    pass
+
+
+#错误前缀 --> 错误类型
+_ERROR_PREFIXES = {
+    'MOVED': MovedError,
+    'ASK': AskError,
+    'NOSCRIPT': NoScriptError,
+    'WRONGTYPE': WrongTypeError,
+    'BUSY': BusyError,
+    'LOADING': LoadingError,
+    'OOM': OutOfMemoryError,
+    'EXECABORT': ExecAbortError,
+    'READONLY': ReadOnlyError,
+    'NOAUTH': AuthenticationError,
+    'WRONGPASS': AuthenticationError,
+    'NOPERM': NoPermissionError,
+    'TRYAGAIN': TryAgainError,
+    'CLUSTERDOWN': ClusterDownError,
+    'MASTERDOWN': ClusterDownError,
+    'CROSSSLOT': CrossSlotError,
+}
+
+
+def first_error(result, multi):
+    """
+    :param result: invoke的结果
+    :param multi: 结果是否为每条指令一个元素的tuple(多条指令)
+    :return: 结果中第一个ResponseError，没有时返回None
+    """
+    if isinstance(result, ResponseError):
+        return result
+    if multi and isinstance(result, tuple):
+        for r in result:
+            if isinstance(r, ResponseError):
+                return r
+    return None
+
+
+def response_error(msg):
+    """
+    :param msg: 错误应答内容，不包括'-'及结束符
+    :return: 按前缀对应的ResponseError对象
+    """
+    return _ERROR_PREFIXES.get(msg.split(' ', 1)[0], ResponseError)(msg)
@@ -0,0 +1,200 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import bisect
+
+
+#延迟分布的桶上限(秒)，最后一个桶为+Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+#snapshot中最后一个桶的上限，与prometheus的le标签一致，json.dumps后仍为合法JSON
+INF_BUCKET = '+Inf'
+
+
+def command_label(buf, active_trans, cmd_count):
+    """
+    一次请求的统计名称：单条指令为指令名，事务为MULTI，多条指令为PIPELINE
+
+    :param buf: 已编码的请求，'*N\r\n$len\r\nNAME\r\n...'
+    """
+    if active_trans:
+        return 'MULTI'
+    if 1 != cmd_count:
+        return 'PIPELINE'
+    start = buf.index('\r\n', buf.index('\r\n') + 2) + 2
+    return buf[start: buf.index('\r\n', start)].upper()
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.__counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.__count = 0
+        self.__sum = 0.0
+        self.__max = 0.0
+
+    def observe(self, value):
+        self.__counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.__count += 1
+        self.__sum += value
+        if value > self.__max:
+            self.__max = value
+
+    def percentile(self, p):
+        """
+        :return: 第p百分位所在桶的上限，落在最后一个桶时返回max
+        """
+        if not self.__count:
+            return 0.0
+        rank = self.__count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.__counts):
+            seen += n
+            if seen >= rank and n:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.__max
+        return self.__max
+
+    def snapshot(self):
+        return {
+            'count': self.__count,
+            'sum': self.__sum,
+            'max': self.__max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': zip(LATENCY_BUCKETS + (INF_BUCKET,), self.__counts),
+        }
+
+
+class NullMetrics(object):
+    """
+    请求生命周期的钩子，默认不做任何事；实现其中部分方法即可接入tracing
+
+    AsyncRedis(metrics=None)时连接上不调用任何钩子
+    """
+    def on_enqueue(self, label, depth):
+        """
+        请求交给连接
+
+        :param depth: 连接上未完成的请求数，含本次
+        """
+
+    def on_flush(self, nbytes, requests):
+        """
+        请求写入socket
+
+        :param requests: 本次写入包含的请求数，连接时的AUTH等指令不计入
+        """
+
+    def on_recv(self, nbytes):
+        pass
+
+    def on_first_byte(self, label, elapsed):
+        """
+        队首请求收到第一批应答数据
+
+        :param elapsed: 距on_enqueue的秒数
+        """
+
+    def on_reply(self, label, elapsed, error):
+        """
+        应答解析完成
+
+        :param error: 应答是否为ResponseError
+        """
+
+    def on_fail(self, label):
+        """
+        请求未收到应答即结束：超时、连接断开、连接池关闭等
+        """
+
+    def on_connect(self, reconnect):
+        pass
+
+    def on_disconnect(self):
+        pass
+
+    def on_parse_error(self, err):
+        pass
+
+
+class RedisMetrics(NullMetrics):
+    """
+    计数及按指令名统计的延迟分布，多个AsyncRedis可共用一个对象
+
+    metrics = RedisMetrics()
+    client = AsyncRedis('redis://localhost:6379/0', metrics=metrics)
+    print metrics.snapshot()
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.__counters = dict.fromkeys((
+            'requests', 'batched_requests', 'pipelines', 'transactions', 'replies', 'errors', 'failures',
+            'flushes', 'bytes_out', 'bytes_in', 'connects', 'reconnects', 'disconnects', 'parse_errors',
+        ), 0)
+        self.__inflight = 0
+        self.__max_depth = 0
+        #label --> _Histogram
+        self.__latency = {}
+        self.__first_byte = _Histogram()
+
+    def snapshot(self):
+        """
+        :return: dict，只包含基本类型，可直接序列化为json或转换为其他监控系统的格式
+            counters: 计数
+            gauges: inflight当前未完成请求数，max_depth单个连接上出现过的最大未完成请求数
+            latency: 指令名 --> {count, sum, max, p50, p99, buckets: [(上限秒数, 个数), ..., (INF_BUCKET, 个数)]}
+            first_byte: 队首请求收到首字节的延迟分布
+        """
+        return {
+            'counters': dict(self.__counters),
+            'gauges': {'inflight': self.__inflight, 'max_depth': self.__max_depth},
+            'latency': dict((k, v.snapshot()) for k, v in self.__latency.iteritems()),
+            'first_byte': self.__first_byte.snapshot(),
+        }
+
+    def on_enqueue(self, label, depth):
+        counters = self.__counters
+        counters['requests'] += 1
+        if 'MULTI' == label:
+            counters['transactions'] += 1
+        elif 'PIPELINE' == label:
+            counters['pipelines'] += 1
+        self.__inflight += 1
+        if depth > self.__max_depth:
+            self.__max_depth = depth
+
+    def on_flush(self, nbytes, requests):
+        self.__counters['flushes'] += 1
+        self.__counters['bytes_out'] += nbytes
+        if requests > 1:
+            self.__counters['batched_requests'] += requests
+
+    def on_recv(self, nbytes):
+        self.__counters['bytes_in'] += nbytes
+
+    def on_first_byte(self, label, elapsed):
+        self.__first_byte.observe(elapsed)
+
+    def on_reply(self, label, elapsed, error):
+        self.__inflight -= 1
+        self.__counters['replies'] += 1
+        if error:
+            self.__counters['errors'] += 1
+        hist = self.__latency.get(label)
+        if hist is None:
+            hist = self.__latency[label] = _Histogram()
+        hist.observe(elapsed)
+
+    def on_fail(self, label):
+        self.__inflight -= 1
+        self.__counters['failures'] += 1
+
+    def on_connect(self, reconnect):
+        self.__counters['reconnects' if reconnect else 'connects'] += 1
+
+    def on_disconnect(self):
+        self.__counters['disconnects'] += 1
+
+    def on_parse_error(self, err):
+        self.__counters['parse_errors'] += 1
@@ -0,0 +1,264 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.concurrent import TracebackFuture
+from collections import deque
+from .redis_error import RedisConnectionError
+
+
+class ConnectionPool(object):
+    """
+    按次签出的连接池，一个AsyncRedis对象持有一个ConnectionPool
+
+    每次invoke签出一个连接，应答返回后归还：
+    * 优先使用没有未完成请求的连接
+    * 均忙且连接数未达max_size时新建连接
+    * 否则选择未完成请求数最少且未达max_inflight的连接
+    * 仍没有可用连接时进入等待队列，有连接归还时按顺序分配
+
+    max_size为1、max_inflight为None时，所有请求pipeline到同一连接上；
+    独占连接(checkout)单独计数，同时签出的个数同样不超过max_size，超出时按顺序等待checkin
+    """
+    def __init__(self, conn_factory, min_size=0, max_size=1, max_inflight=None, idle_timeout=None,
+                 dedicated_factory=None, io_loop=None):
+        """
+        :param conn_factory: 返回已发起连接的_RedisConnection对象
+        :param dedicated_factory: 独占连接的工厂，默认同conn_factory
+        :param min_size: 创建时预先建立的连接数，空闲回收及连接关闭后同样保持不少于该数
+        :param max_size: 最大连接数
+        :param max_inflight: 单个连接上未完成请求的上限，None表示不限制
+        :param idle_timeout: 空闲超过该秒数的连接被关闭，None表示不回收
+        :param io_loop: 默认为IOLoop.instance()
+        """
+        if not (isinstance(max_size, int) and max_size >= 1):
+            raise ValueError('max_size invalid: {0}'.format(max_size))
+        if not (isinstance(min_size, int) and 0 <= min_size <= max_size):
+            raise ValueError('min_size invalid: {0}'.format(min_size))
+        if max_inflight is not None and not (isinstance(max_inflight, int) and max_inflight >= 1):
+            raise ValueError('max_inflight invalid: {0}'.format(max_inflight))
+
+        self.__io_loop = io_loop or IOLoop.instance()
+        self.__conn_factory = conn_factory
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__max_inflight = max_inflight
+        self.__idle_timeout = idle_timeout
+        #连接 --> 未完成请求数
+        self.__inflight = {}
+        #连接 --> 最近一次归还时间
+        self.__last_release = {}
+        #等待连接的回调
+        self.__waiters = deque()
+        self.__blocking_conn = None
+        self.__shrink_timer = None
+        self.__dedicated_factory = dedicated_factory or conn_factory
+        #已归还的独占连接
+        self.__dedicated = []
+        #已签出的独占连接
+        self.__checked_out = set()
+        #等待独占连接的future
+        self.__checkout_waiters = deque()
+        self.__closed = False
+        #预先建立连接，首批请求不必等待连接建立
+        self.__fill()
+
+    def size(self):
+        return len(self.__inflight)
+
+    def waiting(self):
+        return len(self.__waiters)
+
+    def connections(self):
+        """
+        :return: 参与共享签出的全部未关闭连接；不包括阻塞指令专用连接，其上的指令可能排在BLPOP等之后
+        """
+        self.__drop_closed()
+        return list(self.__inflight)
+
+    def inflight(self):
+        """
+        :return: 共享连接上未完成的请求数
+        """
+        return sum(self.__inflight.itervalues())
+
+    def acquire(self, callback, future):
+        """签出连接，可用时调用callback(conn)，请求离开连接时自动归还：
+        收到应答或连接失败时归还；超时后应答仍在线路上，连接保持占用直到迟到的应答被读取
+
+        :param callback: 使用连接发送指令
+        :param future: 本次请求的future对象
+        """
+        conn = self.__select()
+        if conn is None:
+            self.__waiters.append((callback, future))
+            return
+        self.__dispatch(conn, callback, future)
+
+    def blocking_conn(self):
+        """
+        阻塞指令(BLPOP等)专用连接，不参与签出，避免阻塞其他请求
+        """
+        if self.__blocking_conn is None or self.__blocking_conn.closed():
+            self.__blocking_conn = self.__conn_factory()
+        return self.__blocking_conn
+
+    def checkout(self):
+        """
+        签出独占连接，不参与共享签出，用于WATCH等依赖连接状态的指令序列，用完后以checkin归还；
+        已签出max_size个时等待其他连接归还
+
+        :return: future，结果为连接；连接池关闭时以RedisConnectionError失败
+        """
+        future = TracebackFuture()
+        if self.__closed:
+            future.set_exception(RedisConnectionError('redis connection pool closed'))
+        elif len(self.__checked_out) < self.__max_size:
+            future.set_result(self.__checkout_one())
+        else:
+            self.__checkout_waiters.append(future)
+        return future
+
+    def checkin(self, conn, close=False):
+        """
+        归还独占连接，每次checkout的连接必须归还一次；空闲的独占连接最多保留max_size个
+
+        :param close: 为True时关闭连接而不复用，如连接状态不确定
+        """
+        self.__checked_out.discard(conn)
+        if close or self.__closed:
+            conn.close()
+        if not conn.closed():
+            self.__dedicated.append(conn)
+        while self.__checkout_waiters and len(self.__checked_out) < self.__max_size:
+            self.__checkout_waiters.popleft().set_result(self.__checkout_one())
+        while len(self.__dedicated) > self.__max_size:
+            self.__dedicated.pop(0).close()
+
+    def __checkout_one(self):
+        conn = None
+        while self.__dedicated:
+            conn = self.__dedicated.pop()
+            if not conn.closed():
+                break
+            conn = None
+        if conn is None:
+            conn = self.__dedicated_factory()
+        self.__checked_out.add(conn)
+        return conn
+
+    def close(self):
+        """
+        关闭全部连接，等待中的请求以RedisConnectionError失败
+        """
+        if self.__shrink_timer is not None:
+            self.__shrink_timer.stop()
+            self.__shrink_timer = None
+        self.__closed = True
+        conns = list(self.__inflight) + self.__dedicated
+        self.__dedicated = []
+        if self.__blocking_conn is not None:
+            conns.append(self.__blocking_conn)
+            self.__blocking_conn = None
+        self.__inflight.clear()
+        self.__last_release.clear()
+        for conn in conns:
+            conn.close()
+
+        waiters = self.__waiters
+        self.__waiters = deque()
+        for _, future in waiters:
+            if not future.done():
+                future.set_exception(RedisConnectionError('redis connection pool closed'))
+        checkout_waiters = self.__checkout_waiters
+        self.__checkout_waiters = deque()
+        for future in checkout_waiters:
+            future.set_exception(RedisConnectionError('redis connection pool closed'))
+
+    def close_inherited(self):
+        """
+        fork之后在子进程中调用，关闭继承自父进程的全部连接(包括已签出的独占连接)的文件描述符，
+        参见_RedisConnection.close_inherited；之后不能再使用该连接池
+        """
+        self.__closed = True
+        conns = list(self.__inflight) + self.__dedicated + list(self.__checked_out)
+        if self.__blocking_conn is not None:
+            conns.append(self.__blocking_conn)
+        for conn in conns:
+            conn.close_inherited()
+
+    def __select(self):
+        self.__drop_closed()
+
+        best = None
+        best_inflight = None
+        for conn, inflight in self.__inflight.iteritems():
+            if 0 == inflight:
+                return conn
+            if self.__max_inflight is not None and inflight >= self.__max_inflight:
+                continue
+            if best is None or inflight < best_inflight:
+                best, best_inflight = conn, inflight
+
+        if len(self.__inflight) < self.__max_size:
+            return self.__new_conn()
+        return best
+
+    def __new_conn(self):
+        conn = self.__conn_factory()
+        conn.set_settle_callback(self.__release)
+        self.__inflight[conn] = 0
+        self.__last_release[conn] = self.__io_loop.time()
+        if self.__idle_timeout and self.__shrink_timer is None:
+            self.__shrink_timer = PeriodicCallback(self.__shrink, self.__idle_timeout * 500,
+                                                   io_loop=self.__io_loop)
+            self.__shrink_timer.start()
+        return conn
+
+    def __dispatch(self, conn, callback, future):
+        self.__inflight[conn] += 1
+        callback(conn)
+
+    def __release(self, conn):
+        if conn not in self.__inflight:
+            return
+        self.__inflight[conn] -= 1
+        self.__last_release[conn] = self.__io_loop.time()
+
+        while self.__waiters:
+            callback, future = self.__waiters[0]
+            #等待期间已超时，不再占用连接
+            if future.done():
+                self.__waiters.popleft()
+                continue
+            conn = self.__select()
+            if conn is None:
+                break
+            self.__waiters.popleft()
+            self.__dispatch(conn, callback, future)
+
+    def __drop_closed(self):
+        for conn in [_ for _ in self.__inflight if _.closed()]:
+            del self.__inflight[conn]
+            del self.__last_release[conn]
+
+    def __fill(self):
+        while len(self.__inflight) < self.__min_size:
+            self.__new_conn()
+
+    def __shrink(self):
+        """
+        关闭空闲超时的连接，保留min_size个，已关闭的连接补足到min_size个
+        """
+        self.__drop_closed()
+        self.__fill()
+        deadline = self.__io_loop.time() - self.__idle_timeout
+        for conn, inflight in self.__inflight.items():
+            if len(self.__inflight) <= self.__min_size:
+                break
+            if inflight or self.__last_release[conn] > deadline:
+                continue
+            del self.__inflight[conn]
+            del self.__last_release[conn]
+            conn.close()
@@ -0,0 +1,157 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+from tornado.concurrent import TracebackFuture
+from tornado.stack_context import NullContext
+from collections import deque
+from .redis_client import _RedisConnection, _resolve_redis
+from .redis_encode import redis_subscribe, redis_unsubscribe, redis_psubscribe, redis_punsubscribe
+from .redis_error import RedisConnectionError
+
+
+#消息队列满时丢弃最早的消息
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+#消息队列满时丢弃新消息
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+#消息队列满时关闭订阅，get_message抛出RedisConnectionError
+OVERFLOW_CLOSE = 'close'
+
+_MESSAGE_KINDS = ('message', 'pmessage')
+
+
+class AsyncSubscriber(object):
+    """
+    订阅专用连接，一个AsyncSubscriber对象维护一个_RedisConnection
+
+    消息为tuple: ('message', channel, data) 或 ('pmessage', pattern, channel, data)
+    设置callback时逐条回调，否则放入有界队列，通过get_message获取
+    断线重连后自动重新订阅全部频道及模式
+
+    sub = AsyncSubscriber('redis://localhost:6379/0')
+    sub.subscribe('news')
+    while 1:
+        kind, channel, data = yield sub.get_message()
+    """
+    def __init__(self, redis_uri=None, redis_tuple=None, callback=None, max_queue=1000,
+                 overflow=OVERFLOW_DROP_OLDEST, **conn_opts):
+        """
+        :param callback: 收到消息时调用callback(msg)，设置后不使用队列
+        :param max_queue: 消息队列上限
+        :param overflow: 队列满时的处理策略，OVERFLOW_*
+        :param conn_opts: 重连参数，参见_RedisConnection
+        """
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_CLOSE):
+            raise ValueError('overflow invalid: {0}'.format(overflow))
+        if not (isinstance(max_queue, int) and max_queue > 0):
+            raise ValueError('max_queue invalid: {0}'.format(max_queue))
+
+        self.__channels = set()
+        self.__patterns = set()
+        self.__callback = callback
+        self.__queue = deque()
+        #等待消息的future
+        self.__waiters = deque()
+        self.__max_queue = max_queue
+        self.__overflow = overflow
+        self.__dropped = 0
+        self.__closed = False
+
+        redis_tuple, pwd = _resolve_redis(redis_uri, redis_tuple)
+        with NullContext():
+            self.__conn = _RedisConnection(None, redis_tuple, pwd, push_callback=self.__on_push,
+                                           connect_callback=self.__on_connect, **conn_opts)
+            self.__conn.connect()
+
+    def dropped(self):
+        """
+        因队列满而丢弃的消息数
+        """
+        return self.__dropped
+
+    def channels(self):
+        return frozenset(self.__channels)
+
+    def patterns(self):
+        return frozenset(self.__patterns)
+
+    def subscribe(self, *channels):
+        assert channels
+        self.__channels.update(channels)
+        self.__conn.send(redis_subscribe(*channels))
+
+    def psubscribe(self, *patterns):
+        assert patterns
+        self.__patterns.update(patterns)
+        self.__conn.send(redis_psubscribe(*patterns))
+
+    def unsubscribe(self, *channels):
+        """
+        :param channels: 为空时退订全部频道
+        """
+        if channels:
+            self.__channels.difference_update(channels)
+        else:
+            self.__channels.clear()
+        self.__conn.send(redis_unsubscribe(*channels))
+
+    def punsubscribe(self, *patterns):
+        """
+        :param patterns: 为空时退订全部模式
+        """
+        if patterns:
+            self.__patterns.difference_update(patterns)
+        else:
+            self.__patterns.clear()
+        self.__conn.send(redis_punsubscribe(*patterns))
+
+    def get_message(self):
+        """
+        :return: future，结果为下一条消息
+        """
+        future = TracebackFuture()
+        if self.__queue:
+            future.set_result(self.__queue.popleft())
+        elif self.__closed:
+            future.set_exception(RedisConnectionError('subscriber closed'))
+        else:
+            self.__waiters.append(future)
+        return future
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__conn.close()
+        while self.__waiters:
+            self.__waiters.popleft().set_exception(RedisConnectionError('subscriber closed'))
+
+    def __on_connect(self):
+        """
+        (重)连接后恢复订阅
+        """
+        if self.__channels:
+            self.__conn.send(redis_subscribe(*self.__channels))
+        if self.__patterns:
+            self.__conn.send(redis_psubscribe(*self.__patterns))
+
+    def __on_push(self, reply):
+        #subscribe/unsubscribe等确认不投递
+        if not isinstance(reply, tuple) or not reply or reply[0] not in _MESSAGE_KINDS:
+            return
+        if self.__callback is not None:
+            self.__callback(reply)
+            return
+
+        if self.__waiters:
+            self.__waiters.popleft().set_result(reply)
+            return
+        if len(self.__queue) >= self.__max_queue:
+            self.__dropped += 1
+            if OVERFLOW_DROP_NEWEST == self.__overflow:
+                return
+            if OVERFLOW_CLOSE == self.__overflow:
+                self.close()
+                return
+            self.__queue.popleft()
+        self.__queue.append(reply)
@@ -0,0 +1,346 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import sys
+import random
+from tornado import gen
+from tornado.log import app_log
+from tornado.concurrent import TracebackFuture, is_future
+from collections import deque, OrderedDict
+from .redis_encode import _encode_req, redis_blpop, redis_lpop, redis_blmove, redis_lmove, redis_lrem
+from .redis_error import RedisError, ResponseError, first_error
+from .redis_codec import decode_value
+
+
+#本进程记录失败次数的元素数上限，超出时丢弃最早的记录
+_MAX_TRACKED_FAILURES = 10000
+
+class QueueConsumer(object):
+    """
+    列表队列的消费者，生产者以redis_rpush写入，从表头消费
+
+    * connections个独占连接各自循环执行阻塞指令，不占用AsyncRedis的共享连接，其他invoke不受影响
+    * 取到一条后以非阻塞指令pipeline预取，本地最多缓存prefetch条
+    * concurrency个handler并发执行
+    * 指定processing时为可靠队列：BLMOVE将元素原子地移入processing列表，handler完成后LREM确认(ack)；
+      进程崩溃时元素保留在processing中，重启后以recover()放回队列
+    * handler失败的元素放回队列表尾，不阻塞其后的元素；同一元素在本进程失败max_attempts次后移入dead_letter列表(未指定时丢弃)，
+      避免无法处理的元素无限循环
+    * 阻塞指令超时或连接断开时关闭该连接，按指数退避重新签出
+
+    consumer = QueueConsumer(client, 'jobs', handle_job, concurrency=8, processing='jobs:processing',
+                             max_attempts=5, dead_letter='jobs:dead')
+    yield consumer.recover()
+    consumer.start()
+    ...
+    yield consumer.stop()
+    """
+    def __init__(self, client, queue, handler, concurrency=1, prefetch=None, connections=1, processing=None,
+                 block_timeout=1, requeue_on_error=True, error_callback=None, decode_values=False,
+                 retry_delay=0.1, max_retry_delay=10.0, max_attempts=None, dead_letter=None):
+        """
+        :param client: AsyncRedis对象
+        :param queue: 队列的key
+        :param handler: handler(item)，返回future时等待其完成；正常结束即确认，抛出异常为处理失败
+        :param concurrency: 并发执行的handler数
+        :param prefetch: 本地缓存的最大条数，默认等于concurrency
+        :param connections: 执行阻塞指令的独占连接数，同时签出的独占连接不超过AsyncRedis的max_conns
+        :param processing: 可靠队列的处理中列表，None时以BLPOP消费，取出即从redis中删除
+        :param block_timeout: 阻塞指令的超时整数秒，客户端超时为其加1秒；stop()最多等待该时长
+        :param requeue_on_error: handler失败时是否放回队列表尾；为False时可靠队列的元素留在processing中
+        :param error_callback: handler失败时调用error_callback(item, exc_info)，其抛出的异常只记录日志
+        :param decode_values: 是否以decode_value解码后再交给handler，确认时仍使用原始值
+        :param retry_delay: 连接失败后首次重试的等待秒数，之后翻倍并加入随机抖动
+        :param max_retry_delay: 等待上限
+        :param max_attempts: 同一元素(按原始值)的最多处理次数，达到后不再放回队列而是移入dead_letter；
+            None表示不限制。失败次数只在本进程内记录，被其他消费者取走的元素重新计数
+        :param dead_letter: 超过max_attempts的元素RPUSH到该列表，None时丢弃
+        """
+        if not (isinstance(concurrency, int) and concurrency >= 1):
+            raise ValueError('concurrency invalid: {0}'.format(concurrency))
+        if not (isinstance(connections, int) and connections >= 1):
+            raise ValueError('connections invalid: {0}'.format(connections))
+        prefetch = concurrency if prefetch is None else prefetch
+        if not (isinstance(prefetch, int) and prefetch >= 1):
+            raise ValueError('prefetch invalid: {0}'.format(prefetch))
+        if processing == queue:
+            raise ValueError('processing must differ from queue')
+        if not (isinstance(block_timeout, int) and block_timeout >= 1):
+            raise ValueError('block_timeout invalid: {0}'.format(block_timeout))
+        if not (max_attempts is None or (isinstance(max_attempts, int) and max_attempts >= 1)):
+            raise ValueError('max_attempts invalid: {0}'.format(max_attempts))
+        if dead_letter is not None and dead_letter in (queue, processing):
+            raise ValueError('dead_letter must differ from queue and processing')
+
+        self.__client = client
+        self.__queue = queue
+        self.__handler = handler
+        self.__concurrency = concurrency
+        self.__prefetch = prefetch
+        self.__connections = connections
+        self.__processing = processing
+        self.__block_timeout = block_timeout
+        self.__requeue_on_error = requeue_on_error
+        self.__error_callback = error_callback
+        self.__decode_values = decode_values
+        self.__retry_delay = retry_delay
+        self.__max_retry_delay = max_retry_delay
+        self.__max_attempts = max_attempts
+        self.__dead_letter = dead_letter
+
+        #已取出未交给handler的原始值
+        self.__buffer = deque()
+        #等待buffer中有元素的worker，及等待buffer有空位的fetcher
+        self.__item_waiters = deque()
+        self.__room_waiters = deque()
+        self.__running = False
+        self.__tasks = []
+        #原始值 --> 本进程内的失败次数，确认或移入dead_letter后删除
+        self.__failures = OrderedDict()
+        self.__stats = dict.fromkeys(
+            ('fetched', 'acked', 'failed', 'requeued', 'dead_lettered', 'ack_errors', 'timeouts', 'reconnects'), 0)
+
+    def stats(self):
+        """
+        :return: fetched取出数，acked确认数，failed handler失败数，requeued放回队列数，dead_lettered移入dead_letter(或丢弃)数，
+                 ack_errors确认或放回失败数(可靠队列的元素留在processing中)，timeouts阻塞指令超时(未取到元素)次数，reconnects连接重建次数，buffered本地缓存数
+        """
+        stats = dict(self.__stats)
+        stats['buffered'] = len(self.__buffer)
+        return stats
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__tasks = [self.__fetch_loop() for _ in xrange(self.__connections)] + \
+                       [self.__work_loop() for _ in xrange(self.__concurrency)]
+
+    @gen.coroutine
+    def stop(self):
+        """
+        停止取新元素，等待执行中的handler结束；本地缓存中未处理的元素放回队列表头
+        """
+        if not self.__running:
+            return
+        self.__running = False
+        self.__wakeup(self.__item_waiters)
+        self.__wakeup(self.__room_waiters)
+        yield self.__tasks
+        self.__tasks = []
+        leftover = list(self.__buffer)
+        self.__buffer.clear()
+        for raw in reversed(leftover):
+            yield self.__requeue(raw, True)
+
+    @gen.coroutine
+    def recover(self):
+        """
+        将processing中的元素全部放回队列表头，应在start之前、没有其他消费者使用该processing时调用
+
+        :return: 放回的个数
+        """
+        if self.__processing is None:
+            raise gen.Return(0)
+        count = 0
+        while True:
+            item = yield self.__client.invoke([redis_lmove(self.__processing, self.__queue, 'RIGHT', 'LEFT')],
+                                              active_trans=False, cache=False, codecs=False)
+            if isinstance(item, ResponseError):
+                raise item
+            if item is None:
+                raise gen.Return(count)
+            count += 1
+
+    def __blocking_cmd(self):
+        if self.__processing is None:
+            return redis_blpop(self.__block_timeout, self.__queue)
+        return redis_blmove(self.__queue, self.__processing, self.__block_timeout)
+
+    def __prefetch_cmd(self):
+        if self.__processing is None:
+            return redis_lpop(self.__queue)
+        return redis_lmove(self.__queue, self.__processing)
+
+    @gen.coroutine
+    def __fetch_loop(self):
+        conn = None
+        attempt = 0
+        while self.__running:
+            if len(self.__buffer) >= self.__prefetch:
+                yield self.__wait(self.__room_waiters)
+                continue
+            if conn is None:
+                if attempt:
+                    delay = min(self.__max_retry_delay, self.__retry_delay * (2 ** (attempt - 1)))
+                    yield gen.sleep(random.uniform(delay / 2, delay))
+                    self.__stats['reconnects'] += 1
+                conn = self.__client.pinned()
+            try:
+                #阻塞取一条，取到的元素先放入缓存，再以pipeline非阻塞预取至多填满缓存
+                item = yield self.__pop(conn)
+                if item is None:
+                    self.__stats['timeouts'] += 1
+                    continue
+                self.__push([item])
+                room = self.__prefetch - len(self.__buffer)
+                if room > 0 and self.__running:
+                    self.__push((yield self.__prefetch_items(conn, room)))
+            except RedisError:
+                #超时后指令仍可能在redis中执行，连接状态不确定，不再复用；
+                #已收到的元素均已在缓存中，超时未收到应答的元素在可靠队列中留在processing里
+                conn.release(close=True)
+                conn = None
+                attempt += 1
+                continue
+            attempt = 0
+        if conn is not None:
+            conn.release()
+
+    def __invoke_kwargs(self):
+        return {'codecs': False, 'raise_on_error': False, 'timeout': self.__block_timeout + 1}
+
+    @gen.coroutine
+    def __pop(self, conn):
+        """
+        :return: 原始值，阻塞指令超时返回None
+        """
+        reply = yield conn.invoke([self.__blocking_cmd()], **self.__invoke_kwargs())
+        if isinstance(reply, ResponseError):
+            raise reply
+        if reply is None:
+            raise gen.Return(None)
+        #BLPOP返回(key, value)
+        raise gen.Return(reply if self.__processing is not None else reply[1])
+
+    @gen.coroutine
+    def __prefetch_items(self, conn, room):
+        """
+        :return: 原始值列表，遇到nil或错误应答为止
+        """
+        replies = yield conn.invoke([self.__prefetch_cmd()] * room, **self.__invoke_kwargs())
+        if 1 == room:
+            replies = (replies,)
+        items = []
+        for reply in replies:
+            if reply is None or isinstance(reply, ResponseError):
+                break
+            items.append(reply)
+        raise gen.Return(items)
+
+    def __push(self, items):
+        self.__stats['fetched'] += len(items)
+        self.__buffer.extend(items)
+        self.__wakeup(self.__item_waiters, len(items))
+
+    @gen.coroutine
+    def __work_loop(self):
+        while self.__running:
+            if not self.__buffer:
+                yield self.__wait(self.__item_waiters)
+                continue
+            raw = self.__buffer.popleft()
+            self.__wakeup(self.__room_waiters, 1)
+            item = decode_value(raw) if self.__decode_values else raw
+            try:
+                result = self.__handler(item)
+                if is_future(result):
+                    yield result
+            except Exception:
+                exc_info = sys.exc_info()
+                self.__stats['failed'] += 1
+                if self.__error_callback is not None:
+                    try:
+                        self.__error_callback(item, exc_info)
+                    except Exception:
+                        app_log.error('queue %s error_callback failed', self.__queue, exc_info=True)
+                if not self.__requeue_on_error:
+                    continue
+                if self.__exhausted(raw):
+                    done = self.__bury(raw)
+                else:
+                    done = self.__requeue(raw, False)
+            else:
+                self.__failures.pop(raw, None)
+                done = self.__ack(raw)
+            try:
+                yield done
+            except RedisError:
+                self.__stats['ack_errors'] += 1
+
+    @gen.coroutine
+    def __ack(self, raw):
+        if self.__processing is not None:
+            result = yield self.__client.invoke([redis_lrem(self.__processing, 1, raw)], active_trans=False,
+                                                cache=False, codecs=False)
+            if first_error(result, False) is not None:
+                self.__stats['ack_errors'] += 1
+                return
+        self.__stats['acked'] += 1
+
+    def __exhausted(self, raw):
+        """
+        记录一次失败
+
+        :return: 是否已达到max_attempts
+        """
+        if self.__max_attempts is None:
+            return False
+        failures = self.__failures.pop(raw, 0) + 1
+        if failures >= self.__max_attempts:
+            return True
+        self.__failures[raw] = failures
+        if len(self.__failures) > _MAX_TRACKED_FAILURES:
+            self.__failures.popitem(False)
+        return False
+
+    @gen.coroutine
+    def __requeue(self, raw, head):
+        """
+        放回队列，可靠队列在同一事务中从processing移除
+
+        :param head: 是否放回表头，stop()时未处理的元素保持原有顺序；handler失败的元素放回表尾
+        """
+        #raw已是编码后的值，不能经过redis_lpush再次编码
+        cmds = [_encode_req('LPUSH' if head else 'RPUSH', self.__queue, raw)]
+        if self.__processing is not None:
+            cmds.insert(0, redis_lrem(self.__processing, 1, raw))
+        result = yield self.__client.invoke(cmds, active_trans=self.__processing is not None, cache=False,
+                                            codecs=False)
+        if first_error(result, len(cmds) > 1) is not None:
+            self.__stats['ack_errors'] += 1
+            return
+        self.__stats['requeued'] += 1
+
+    @gen.coroutine
+    def __bury(self, raw):
+        """
+        超过max_attempts的元素移入dead_letter，可靠队列在同一事务中从processing移除
+        """
+        cmds = []
+        if self.__processing is not None:
+            cmds.append(redis_lrem(self.__processing, 1, raw))
+        if self.__dead_letter is not None:
+            cmds.append(_encode_req('RPUSH', self.__dead_letter, raw))
+        if cmds:
+            result = yield self.__client.invoke(cmds, active_trans=len(cmds) > 1, cache=False, codecs=False)
+            if first_error(result, len(cmds) > 1) is not None:
+                self.__stats['ack_errors'] += 1
+                return
+        app_log.warning('queue %s item dropped after %d attempts, dead_letter: %s', self.__queue,
+                        self.__max_attempts, self.__dead_letter)
+        self.__stats['dead_lettered'] += 1
+
+    @staticmethod
+    def __wait(waiters):
+        future = TracebackFuture()
+        waiters.append(future)
+        return future
+
+    @staticmethod
+    def __wakeup(waiters, n=None):
+        n = len(waiters) if n is None else min(n, len(waiters))
+        for _ in xrange(n):
+            waiters.popleft().set_result(None)
+
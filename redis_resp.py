@@ -1,6 +1,14 @@
 #coding:utf-8
 
+from __future__ import absolute_import
+
 import re
+from .redis_error import response_error
+
+try:
+    import hiredis
+except ImportError:
+    hiredis = None
 
 #应答结束字符
 _END_CRLF = '\r\n'
@@ -23,10 +31,13 @@ def _single_line(s):
 
 
 def _err(s):
+    """
+    @return ResponseError对象，剩余字符串
+    """
     m = _err_pat.search(s)
     if not m:
         return False, None, None
-    return True, m.groups()[0], s[m.end():]
+    return True, response_error(m.groups()[0]), s[m.end():]
 
 
 def _int(s):
@@ -88,7 +99,8 @@ def _batch(s):
 
     s = s[m.end():]
     ok, l, r = decode_redis_resp(s, batch_count=count)
-    if not ok:
+    #元素不足说明数据未收全
+    if not ok or l is None or len(l) < count:
         return False, None, None
 
     return True, l, r
@@ -165,6 +177,445 @@ def decode_redis_resp(s, batch_count=None):
     return True, tuple(result), remain
 
 
+#聚合类型未解析完毕的标识
+_AGGREGATE_OPENED = object()
+#RESP3属性(|)解析完毕的标识，属性本身被丢弃
+_ATTRIBUTE = object()
+#已解析部分超过该字节数时才从接收缓冲区中移除
+_COMPACT_THRESHOLD = 64 * 1024
+
+_HEAD_SINGLE = ord('+')
+_HEAD_ERR = ord('-')
+_HEAD_INT = ord(':')
+_HEAD_BULK = ord('$')
+_HEAD_BATCH = ord('*')
+#RESP3
+_HEAD_MAP = ord('%')
+_HEAD_SET = ord('~')
+_HEAD_PUSH = ord('>')
+_HEAD_ATTR = ord('|')
+_HEAD_DOUBLE = ord(',')
+_HEAD_BOOL = ord('#')
+_HEAD_NULL = ord('_')
+_HEAD_BIG_NUMBER = ord('(')
+_HEAD_VERBATIM = ord('=')
+_HEAD_BLOB_ERR = ord('!')
+
+
+class PushReply(tuple):
+    """
+    RESP3推送消息(>)，不属于任何请求的应答
+    """
+    pass
+
+
+class RawReply(str):
+    """
+    未解析的完整应答，参见RespReader.set_raw及decode_raw
+    """
+    pass
+
+
+def _finish_aggregate(head, items):
+    if _HEAD_BATCH == head:
+        return tuple(items)
+    if _HEAD_MAP == head:
+        return dict(zip(items[::2], items[1::2]))
+    if _HEAD_SET == head:
+        return set(items)
+    if _HEAD_PUSH == head:
+        return PushReply(items)
+    return _ATTRIBUTE
+
+
+def _finish_bulk(head, body):
+    if _HEAD_BULK == head:
+        return body
+    if _HEAD_VERBATIM == head:
+        #去掉格式前缀，例如txt:
+        return body[4:]
+    return response_error(body)
+
+
+class RespReader(object):
+    """增量式应答解析器
+
+    与decode_redis_resp不同，已消费的字节不会被重复解析：
+    游标记录buf中的解析位置，未完成的批应答保存在栈中，bulk头部解析后记录其长度，
+    下一次feed后从断点继续。
+
+    接收缓冲区为bytearray，解析通过memoryview读取，bulk内容只拷贝一次；
+    已解析的前缀超过_COMPACT_THRESHOLD时才整理缓冲区。
+
+    reader = RespReader()
+    reader.feed('*2\r\n$1\r\na\r\n')
+    reader.gets() --> False, None
+    reader.feed('$1\r\nb\r\n')
+    reader.gets() --> True, ('a', 'b')
+
+    错误应答解析为ResponseError对象，作为应答值返回，与正常的字符串应答区分
+
+    同时支持RESP3: %map --> dict, ~set --> set, ,double --> float, #bool --> bool, _null --> None,
+    (big number --> long, =verbatim --> str, !blob error --> ResponseError, >push --> PushReply；
+    |属性被解析后丢弃
+
+    set_sink后，下一条顶层bulk应答的内容按收到的分段写入sink，不在缓冲区中拼接完整的值；
+    set_raw后，下一条超过阈值的顶层应答只扫描边界，以RawReply原样返回，由decode_raw在其他线程或进程中解析
+    """
+    #set_raw时可原样截取应答字节
+    raw_capture = True
+
+    def __init__(self):
+        self.__buf = bytearray()
+        #buf中已解析位置
+        self.__pos = 0
+        #未完成的聚合应答，元素为[期待个数, 已解析元素, 类型]
+        self.__stack = []
+        #已解析头部，等待body的bulk长度及类型($, =, !)
+        self.__bulk_len = None
+        self.__bulk_head = None
+        #流式读取的目标及已写入字节数
+        self.__sink = None
+        self.__streamed = 0
+        #原样返回的阈值(元素个数, bulk字节数)
+        self.__raw_limits = None
+        #扫描中的原始应答，[起始位置, 剩余值个数, 待跳过的bulk字节数]
+        self.__raw = None
+
+    def set_raw(self, min_items, min_bytes):
+        """
+        下一条顶层应答为聚合应答且元素个数不少于min_items，或为bulk且长度不少于min_bytes时，
+        不创建任何对象，完整收到后以RawReply返回其原始字节；否则按原值返回
+        """
+        self.__raw_limits = (min_items, min_bytes)
+
+    def set_sink(self, sink):
+        """
+        下一条顶层应答为bulk时，内容分段调用sink.write(chunk)，应答值为内容总长度；
+        不为bulk(nil, 错误等)时按原值返回
+
+        :param sink: 提供write(chunk)，如文件对象、IOStream
+        """
+        self.__sink = sink
+
+    def feed(self, data):
+        """
+        :param data: 收到的buf
+        """
+        if not data:
+            return
+        buf = self.__buf
+        pos = self.__pos
+        #扫描原始应答时保留其起始位置之后的数据
+        keep = pos if self.__raw is None else self.__raw[0]
+        if keep and (keep == len(buf) or keep >= _COMPACT_THRESHOLD):
+            #丢弃已解析部分
+            del buf[:keep]
+            self.__pos = pos - keep
+            if self.__raw is not None:
+                self.__raw[0] = 0
+        buf.extend(data)
+
+    def gets(self):
+        """解析下一条完整应答
+
+        :return: ok, 应答；数据不足时ok为False，已解析部分保留在reader中
+        """
+        stack = self.__stack
+        while 1:
+            ok, value = self.__read_value()
+            if not ok:
+                return False, None
+
+            #逐层向上填充聚合应答
+            while value is not _AGGREGATE_OPENED and value is not _ATTRIBUTE:
+                if not stack:
+                    if not isinstance(value, PushReply):
+                        self.__sink = None
+                        self.__raw_limits = None
+                    return True, value
+                frame = stack[-1]
+                frame[1].append(value)
+                if len(frame[1]) < frame[0]:
+                    break
+                stack.pop()
+                value = _finish_aggregate(frame[2], frame[1])
+
+    def __read_value(self):
+        if self.__bulk_len is not None:
+            return self.__read_bulk()
+        if self.__raw is not None:
+            return self.__scan_raw()
+
+        buf = self.__buf
+        pos = self.__pos
+        end = buf.find(_END_CRLF, pos)
+        if end < 0:
+            return False, None
+
+        head = buf[pos]
+        self.__pos = end + 2
+
+        if _HEAD_BULK == head or _HEAD_VERBATIM == head or _HEAD_BLOB_ERR == head:
+            body_len = int(buf[pos + 1: end])
+            #-1 --> None
+            if -1 == body_len:
+                return True, None
+            if body_len < -1:
+                raise ValueError('bulk len invalid: {0}'.format(body_len))
+            if self.__raw_limits is not None and _HEAD_BULK == head and not self.__stack and \
+                    body_len >= self.__raw_limits[1]:
+                return self.__start_raw(pos)
+            self.__bulk_len = body_len
+            self.__bulk_head = head
+            if self.__sink is not None and _HEAD_BULK == head and not self.__stack:
+                self.__streamed = 0
+            return self.__read_bulk()
+        if _HEAD_BATCH == head or _HEAD_MAP == head or _HEAD_SET == head or \
+                _HEAD_PUSH == head or _HEAD_ATTR == head:
+            count = int(buf[pos + 1: end])
+            if -1 == count:
+                return True, None
+            if _HEAD_MAP == head or _HEAD_ATTR == head:
+                count *= 2
+            if self.__raw_limits is not None and _HEAD_ATTR != head and _HEAD_PUSH != head and \
+                    not self.__stack and count >= self.__raw_limits[0]:
+                return self.__start_raw(pos)
+            if 0 == count:
+                return True, _finish_aggregate(head, ())
+            self.__stack.append([count, [], head])
+            return True, _AGGREGATE_OPENED
+        if _HEAD_SINGLE == head:
+            return True, memoryview(buf)[pos + 1: end].tobytes()
+        if _HEAD_INT == head or _HEAD_BIG_NUMBER == head:
+            return True, int(buf[pos + 1: end])
+        if _HEAD_ERR == head:
+            return True, response_error(memoryview(buf)[pos + 1: end].tobytes())
+        if _HEAD_NULL == head:
+            return True, None
+        if _HEAD_DOUBLE == head:
+            return True, float(buf[pos + 1: end])
+        if _HEAD_BOOL == head:
+            return True, 't' == buf[pos + 1: end]
+
+        raise ValueError('resp head invalid: {0!r}'.format(chr(head)))
+
+    def __read_bulk(self):
+        if self.__sink is not None and _HEAD_BULK == self.__bulk_head and not self.__stack:
+            return self.__stream_bulk()
+        buf = self.__buf
+        start = self.__pos
+        end = start + self.__bulk_len
+        #body, \r\n
+        if len(buf) < end + 2:
+            return False, None
+        if buf[end: end + 2] != _END_CRLF:
+            raise ValueError('bulk not terminated by crlf')
+
+        self.__pos = end + 2
+        self.__bulk_len = None
+        body = memoryview(buf)[start: end].tobytes()
+        if _HEAD_BULK == self.__bulk_head:
+            return True, body
+        return True, _finish_bulk(self.__bulk_head, body)
+
+    def __start_raw(self, pos):
+        """
+        从pos处的头部开始重新扫描，整条应答计为一个值
+        """
+        self.__pos = pos
+        self.__raw = [pos, 1, 0]
+        return self.__scan_raw()
+
+    def __scan_raw(self):
+        """
+        只解析头部以跳过各个值，不拷贝内容；数据不足时保存进度，下一次feed后继续
+        """
+        buf = self.__buf
+        pos = self.__pos
+        raw = self.__raw
+        left = raw[1]
+        skip = raw[2]
+        while left:
+            if skip:
+                if len(buf) < pos + skip:
+                    break
+                pos += skip
+                skip = 0
+                left -= 1
+                continue
+            end = buf.find(_END_CRLF, pos)
+            if end < 0:
+                break
+            head = buf[pos]
+            if _HEAD_BULK == head or _HEAD_VERBATIM == head or _HEAD_BLOB_ERR == head:
+                body_len = int(buf[pos + 1: end])
+                if -1 == body_len:
+                    left -= 1
+                else:
+                    #body, \r\n
+                    skip = body_len + 2
+            elif _HEAD_BATCH == head or _HEAD_MAP == head or _HEAD_SET == head or _HEAD_ATTR == head:
+                count = int(buf[pos + 1: end])
+                if _HEAD_MAP == head or _HEAD_ATTR == head:
+                    count *= 2
+                #属性之后仍有其所修饰的值
+                if _HEAD_ATTR != head:
+                    left -= 1
+                if count > 0:
+                    left += count
+            else:
+                left -= 1
+            pos = end + 2
+
+        self.__pos = pos
+        if left:
+            raw[1] = left
+            raw[2] = skip
+            return False, None
+        self.__raw = None
+        return True, RawReply(memoryview(buf)[raw[0]: pos].tobytes())
+
+    def __stream_bulk(self):
+        """
+        已收到的内容写入sink后即被丢弃，缓冲区只保留一次feed的数据
+        """
+        buf = self.__buf
+        pos = self.__pos
+        left = self.__bulk_len
+        n = min(left, len(buf) - pos)
+        if n > 0:
+            self.__sink.write(memoryview(buf)[pos: pos + n].tobytes())
+            pos += n
+            left -= n
+            self.__pos = pos
+            self.__bulk_len = left
+            self.__streamed += n
+        if left or len(buf) < pos + 2:
+            return False, None
+        if buf[pos: pos + 2] != _END_CRLF:
+            raise ValueError('bulk not terminated by crlf')
+
+        self.__pos = pos + 2
+        self.__bulk_len = None
+        return True, self.__streamed
+
+
+def _freeze(reply):
+    """
+    list --> tuple，long --> int，与RespReader输出一致
+    """
+    if isinstance(reply, list):
+        return tuple([_freeze(_) for _ in reply])
+    if isinstance(reply, long):
+        return int(reply)
+    return reply
+
+
+class HiredisReader(object):
+    """
+    hiredis.Reader的适配，接口及输出与RespReader一致
+    """
+    #hiredis不返回应答的原始字节，set_raw无效
+    raw_capture = False
+
+    def __init__(self):
+        self.__reader = hiredis.Reader(protocolError=ValueError, replyError=response_error)
+        self.__sink = None
+
+    def feed(self, data):
+        if data:
+            self.__reader.feed(data)
+
+    def set_raw(self, min_items, min_bytes):
+        """
+        hiredis不返回原始字节，始终返回解析后的值；_RedisConnection收到raw请求后换用RespReader
+        """
+
+    def set_sink(self, sink):
+        """
+        hiredis不支持分段读取，完整的值解析后一次写入sink，内存占用与RespReader不同
+        """
+        self.__sink = sink
+
+    def gets(self):
+        reply = self.__reader.gets()
+        if reply is False:
+            return False, None
+        reply = _freeze(reply)
+        if self.__sink is not None and not isinstance(reply, PushReply):
+            sink, self.__sink = self.__sink, None
+            if isinstance(reply, str):
+                sink.write(reply)
+                return True, len(reply)
+        return True, reply
+
+
+#可导入hiredis时使用C实现，否则使用纯python实现
+DEFAULT_READER = RespReader if hiredis is None else HiredisReader
+
+
+def deserialize_reply(reply, deserializer):
+    """
+    :param deserializer: 作用于单个字符串的函数，如json.loads
+    :return: 顶层为tuple时对其中的字符串元素、dict时对其值、字符串时对其本身调用deserializer，
+             None, 整数及错误应答不变
+    """
+    if isinstance(reply, str):
+        return deserializer(reply)
+    if isinstance(reply, tuple) and not isinstance(reply, PushReply):
+        return tuple([deserializer(_) if isinstance(_, str) else _ for _ in reply])
+    if isinstance(reply, dict):
+        return dict((k, deserializer(v) if isinstance(v, str) else v) for k, v in reply.iteritems())
+    return reply
+
+
+def decode_raw(raw, deserializer=None, reader_cls=None):
+    """
+    解析RawReply，可在线程池或进程池中执行，参数均可pickle
+
+    :param reader_cls: 默认为DEFAULT_READER，RESP3的应答应使用RespReader
+    """
+    reader = (reader_cls or DEFAULT_READER)()
+    reader.feed(raw)
+    ok, reply = reader.gets()
+    if not ok:
+        raise ValueError('raw reply incomplete')
+    if deserializer is not None:
+        reply = deserialize_reply(reply, deserializer)
+    return reply
+
+
+def resp_count(connect_count, trans_active, cmd_count):
+    """一次请求对应的应答个数
+
+    :param connect_count: AUTH, SELECT等连接指令个数
+    :param trans_active: 是否启用事务，启用时包含MULTI的+OK，cmd_count个+QUEUED以及EXEC的应答
+    :param cmd_count: 请求命令个数
+    """
+    if trans_active:
+        return connect_count + cmd_count + 2
+    return connect_count + cmd_count
+
+
+def assemble_resp(replies, connect_count, trans_active, cmd_count):
+    """将一次请求的全部应答组装为业务结果，规则与decode_resp_ondemand一致
+
+    :param replies: resp_count个应答
+    """
+    if trans_active:
+        #EXEC应答，事务被中止时为None
+        p = replies[-1]
+        #None或EXECABORT等错误
+        if not isinstance(p, tuple) or 1 != cmd_count:
+            return p
+        return p[0]
+
+    if 1 == cmd_count:
+        return replies[connect_count]
+    return tuple(replies[connect_count:])
+
+
 #+OK\r\n
 CONNECT_RESP_LEN = 5
 
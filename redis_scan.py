@@ -0,0 +1,201 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import functools
+from tornado import gen
+from tornado.concurrent import TracebackFuture
+from collections import deque
+from .redis_encode import redis_scan, redis_hscan, redis_sscan, redis_zscan
+from .redis_error import ResponseError
+
+
+#指令 --> (编码函数, 元素是否为成对的(field, value))
+_SCAN_CMDS = {
+    'SCAN': (redis_scan, False),
+    'HSCAN': (redis_hscan, True),
+    'SSCAN': (redis_sscan, False),
+    'ZSCAN': (redis_zscan, True),
+}
+
+
+def _pairs(items):
+    it = iter(items)
+    return tuple(zip(it, it))
+
+
+class ScanIterator(object):
+    """
+    基于游标的分批遍历，代替KEYS, HGETALL, SMEMBERS等一次返回全部元素的指令
+
+    每批大小由COUNT控制；开启prefetch时收到一批后立即发出下一个游标的请求，
+    调用方处理当前批次期间下一批已在路上，内存中至多保留两批
+
+    it = ScanIterator(client, 'HSCAN', 'big_hash', count=500)
+    while 1:
+        batch = yield it.next_batch()
+        if batch is None:
+            break
+        for field, value in batch:
+            ...
+
+    同一redis的遍历过程中key被修改时，元素可能重复返回，调用方需自行去重
+    """
+    def __init__(self, client, cmd='SCAN', key=None, match=None, count=None, type_=None, prefetch=True,
+                 timeout=None):
+        """
+        :param client: AsyncRedis对象
+        :param cmd: SCAN, HSCAN, SSCAN, ZSCAN
+        :param key: HSCAN, SSCAN, ZSCAN遍历的key
+        :param match: 只返回匹配该模式的元素
+        :param count: 每批元素数的建议值
+        :param type_: SCAN只返回该类型的key
+        :param prefetch: 是否预取下一批
+        :param timeout: 单次请求超时秒数，None使用client的默认值
+        """
+        cmd = cmd.upper()
+        if cmd not in _SCAN_CMDS:
+            raise ValueError('cmd invalid: {0}'.format(cmd))
+        if ('SCAN' == cmd) != (key is None):
+            raise ValueError('key invalid: {0}'.format(key))
+        if type_ is not None and 'SCAN' != cmd:
+            raise ValueError('type_ only supported by SCAN')
+
+        encoder, self.__paired = _SCAN_CMDS[cmd]
+        if 'SCAN' == cmd:
+            self.__encode = lambda cursor: encoder(cursor, match, count, type_)
+        else:
+            self.__encode = lambda cursor: encoder(key, cursor, match, count)
+        self.__client = client
+        self.__key = key
+        self.__prefetch = prefetch
+        self.__kwargs = {'active_trans': False, 'cache': False}
+        if timeout is not None:
+            self.__kwargs['timeout'] = timeout
+        #下一次请求的游标，None表示遍历结束
+        self.__cursor = 0
+        #已发出未取走的请求
+        self.__pending = None
+
+    def finished(self):
+        return self.__cursor is None and self.__pending is None
+
+    def target(self):
+        """
+        :return: (client, key)，游标遍历的对象，SCAN的key为None
+        """
+        return self.__client, self.__key
+
+    @gen.coroutine
+    def next_batch(self):
+        """
+        同一对象不能并发调用
+
+        :return: 下一批元素的tuple，HSCAN, ZSCAN为(field, value)的tuple；遍历结束返回None
+            redis返回错误(如WRONGTYPE)时抛出ResponseError
+        """
+        while True:
+            if self.__pending is None:
+                if self.__cursor is None:
+                    raise gen.Return(None)
+                self.__pending = self.__request(self.__cursor)
+            future, self.__pending = self.__pending, None
+            reply = yield future
+            if isinstance(reply, ResponseError):
+                self.__cursor = None
+                raise reply
+            cursor, items = reply
+            self.__cursor = None if '0' == cursor else cursor
+            if self.__prefetch and self.__cursor is not None:
+                self.__pending = self.__request(self.__cursor)
+            #过滤条件下可能返回空批次，继续取下一批
+            if items:
+                raise gen.Return(_pairs(items) if self.__paired else tuple(items))
+
+    def close(self):
+        """
+        提前结束遍历，丢弃预取的请求
+        """
+        self.__cursor = None
+        if self.__pending is not None:
+            #取走异常，避免未处理异常的日志
+            self.__pending.add_done_callback(lambda f: f.exception())
+            self.__pending = None
+
+    def __request(self, cursor):
+        return self.__client.invoke([self.__encode(cursor)], **self.__kwargs)
+
+
+class ParallelScan(object):
+    """
+    多个游标并发遍历，先返回的批次先交给调用方
+
+    * cluster: 每个主节点一个SCAN游标
+        scan = ParallelScan([ScanIterator(_) for _ in (yield cluster.nodes())])
+    * 同一redis上的多个key: 每个key一个HSCAN, SSCAN或ZSCAN游标
+
+    同一redis的同一个keyspace只能有一个游标：SCAN及*SCAN的MATCH在服务端逐个过滤，
+    按前缀拆成N个游标时每个游标仍遍历全部key，服务端开销为N倍且不会更快
+
+    每个游标只有在上一批被取走后才继续请求，内存占用与游标个数成正比
+    """
+    def __init__(self, iterators):
+        """
+        :param iterators: ScanIterator对象列表，target()不能重复，否则抛出ValueError
+        """
+        assert iterators
+        targets = set()
+        for it in iterators:
+            if it.target() in targets:
+                raise ValueError('iterators overlap: {0}'.format(it.target()[1] or 'SCAN'))
+            targets.add(it.target())
+        #已返回的批次: (iterator, batch)
+        self.__ready = deque()
+        self.__waiters = deque()
+        self.__running = 0
+        self.__error = None
+        for it in iterators:
+            self.__advance(it)
+
+    def next_batch(self):
+        """
+        :return: future，结果为任意一个游标的下一批元素；全部结束返回None；
+                 任一游标出错时抛出该异常，其余游标停止
+        """
+        future = TracebackFuture()
+        self.__waiters.append(future)
+        self.__wakeup()
+        return future
+
+    def close(self):
+        self.__error = self.__error or StopIteration()
+        for it, _ in self.__ready:
+            it.close()
+        self.__ready.clear()
+
+    def __advance(self, it):
+        self.__running += 1
+        it.next_batch().add_done_callback(functools.partial(self.__on_batch, it))
+
+    def __on_batch(self, it, future):
+        self.__running -= 1
+        error = future.exception()
+        if self.__error is not None or error is not None:
+            self.__error = self.__error or error
+            it.close()
+        elif future.result() is not None:
+            self.__ready.append((it, future.result()))
+        self.__wakeup()
+
+    def __wakeup(self):
+        while self.__waiters:
+            if self.__ready:
+                it, batch = self.__ready.popleft()
+                self.__waiters.popleft().set_result(batch)
+                self.__advance(it)
+            elif self.__error is not None and not isinstance(self.__error, StopIteration):
+                self.__waiters.popleft().set_exception(self.__error)
+            elif 0 == self.__running:
+                self.__waiters.popleft().set_result(None)
+            else:
+                break
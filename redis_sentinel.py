@@ -0,0 +1,207 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+from tornado import gen
+from .redis_client import AsyncRedis
+from .redis_pubsub import AsyncSubscriber
+from .redis_encode import cmd_args, redis_sentinel_master, redis_sentinel_replicas
+from .redis_error import RedisError, RedisConnectionError, ResponseError
+
+
+#可发往从库的只读指令
+_READONLY_CMDS = frozenset([
+    'GET', 'MGET', 'STRLEN', 'GETRANGE', 'GETBIT', 'BITCOUNT', 'EXISTS', 'TTL', 'PTTL', 'TYPE',
+    'HGET', 'HMGET', 'HGETALL', 'HKEYS', 'HVALS', 'HLEN', 'HEXISTS', 'HSCAN',
+    'LRANGE', 'LINDEX', 'LLEN',
+    'SMEMBERS', 'SISMEMBER', 'SCARD', 'SRANDMEMBER', 'SSCAN',
+    'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZSCORE', 'ZCARD', 'ZRANK', 'ZSCAN',
+    'SCAN', 'PING', 'ECHO',
+])
+
+#主从变化相关的sentinel事件
+_SWITCH_MASTER = '+switch-master'
+_REPLICA_EVENTS = ('+slave', '+sdown', '-sdown', '+odown', '-odown')
+
+#不可用的从库
+_BAD_REPLICA_FLAGS = frozenset(['s_down', 'o_down', 'disconnected'])
+
+
+class AsyncSentinelRedis(object):
+    """
+    通过sentinel发现主库的客户端
+
+    订阅sentinel的+switch-master，故障转移后切换到新主库，无需重启；
+    开启read_from_replicas时，全部为只读指令的invoke按最少未完成请求数发往从库
+    """
+    def __init__(self, sentinels, service_name, redis_pwd=None, db=0, read_from_replicas=False,
+                 sentinel_pwd=None, sentinel_timeout=0.5, **client_opts):
+        """
+        :param sentinels: [(host, port), ...]
+        :param service_name: sentinel中配置的主库名
+        :param redis_pwd: 主从库密码
+        :param db: 主从库的db
+        :param read_from_replicas: 只读指令是否发往从库
+        :param sentinel_pwd: sentinel密码
+        :param sentinel_timeout: 查询单个sentinel的超时秒数，超时后尝试下一个
+        :param client_opts: 主从库AsyncRedis对象的参数
+        """
+        assert sentinels
+        self.__sentinels = [tuple(_) for _ in sentinels]
+        self.__service_name = service_name
+        self.__pwd = redis_pwd
+        self.__db = db
+        self.__read_from_replicas = read_from_replicas
+        self.__sentinel_pwd = sentinel_pwd
+        self.__sentinel_timeout = sentinel_timeout
+        self.__client_opts = client_opts
+        #(host, port) --> AsyncRedis
+        self.__sentinel_clients = {}
+        self.__master_addr = None
+        self.__master = None
+        #AsyncRedis --> 未完成请求数
+        self.__replicas = {}
+        self.__discovering = None
+        self.__watcher = None
+
+    def master_addr(self):
+        return self.__master_addr
+
+    def replica_addrs(self):
+        return [_.redis_addr() for _ in self.__replicas]
+
+    def discover(self):
+        """
+        向sentinel查询主库及从库，并发调用时共享同一次查询
+        """
+        if self.__discovering is None:
+            self.__discovering = self.__discover()
+            self.__discovering.add_done_callback(self.__on_discovered)
+        return self.__discovering
+
+    def __on_discovered(self, _):
+        self.__discovering = None
+
+    def __sentinel_client(self, addr):
+        client = self.__sentinel_clients.get(addr)
+        if client is None:
+            client = AsyncRedis(redis_tuple=(addr[0], addr[1], None, self.__sentinel_pwd),
+                                timeout=self.__sentinel_timeout, io_loop=self.__client_opts.get('io_loop'))
+            self.__sentinel_clients[addr] = client
+        return client
+
+    def __new_client(self, addr):
+        return AsyncRedis(redis_tuple=(addr[0], addr[1], self.__db, self.__pwd), **self.__client_opts)
+
+    @gen.coroutine
+    def __discover(self):
+        last_err = None
+        for addr in list(self.__sentinels):
+            client = self.__sentinel_client(addr)
+            try:
+                master, replicas = yield gen.multi([
+                    client.invoke([redis_sentinel_master(self.__service_name)], active_trans=False),
+                    client.invoke([redis_sentinel_replicas(self.__service_name)], active_trans=False),
+                ], quiet_exceptions=RedisError)
+            except RedisError as e:
+                #不可达的sentinel不再后台重连
+                del self.__sentinel_clients[addr]
+                client.close()
+                last_err = e
+                continue
+            if master is None or isinstance(master, ResponseError):
+                last_err = master
+                continue
+
+            #可用的sentinel放在首位
+            self.__sentinels.remove(addr)
+            self.__sentinels.insert(0, addr)
+            self.__switch_master((master[0], int(master[1])))
+            if not isinstance(replicas, ResponseError):
+                self.__update_replicas(replicas)
+            self.__watch(addr)
+            return
+        raise RedisError('no sentinel knows master {0}'.format(self.__service_name), last_err)
+
+    def __switch_master(self, addr):
+        if addr == self.__master_addr:
+            return
+        old = self.__master
+        self.__master_addr = addr
+        self.__master = self.__new_client(addr)
+        #原主库已降为从库，其上的写请求不再可靠
+        if old is not None:
+            old.close()
+
+    def __update_replicas(self, replicas):
+        addrs = set()
+        for attrs in replicas:
+            attrs = dict(zip(attrs[::2], attrs[1::2]))
+            if _BAD_REPLICA_FLAGS.intersection(attrs.get('flags', '').split(',')):
+                continue
+            addrs.add((attrs['ip'], int(attrs['port'])))
+
+        for client in list(self.__replicas):
+            if client.redis_addr() not in addrs:
+                del self.__replicas[client]
+                client.close()
+        known = set(_.redis_addr() for _ in self.__replicas)
+        for addr in addrs - known:
+            self.__replicas[self.__new_client(addr)] = 0
+
+    def __watch(self, addr):
+        if self.__watcher is not None:
+            return
+        self.__watcher = AsyncSubscriber(redis_tuple=(addr[0], addr[1], None, self.__sentinel_pwd),
+                                         callback=self.__on_event, io_loop=self.__client_opts.get('io_loop'))
+        self.__watcher.subscribe(_SWITCH_MASTER, *_REPLICA_EVENTS)
+
+    def __on_event(self, msg):
+        _, channel, data = msg
+        if _SWITCH_MASTER == channel:
+            #<master name> <old ip> <old port> <new ip> <new port>
+            parts = data.split(' ')
+            if parts[0] == self.__service_name:
+                self.__switch_master((parts[3], int(parts[4])))
+                self.discover()
+            return
+        #<instance type> <name> <ip> <port> @ <master name> <master ip> <master port>
+        if ('@ %s ' % self.__service_name) in data:
+            self.discover()
+
+    def __pick_replica(self):
+        best = None
+        for client, inflight in self.__replicas.iteritems():
+            if best is None or inflight < self.__replicas[best]:
+                best = client
+        return best
+
+    @gen.coroutine
+    def invoke(self, iter_redis_cmds, **kwargs):
+        """参数与AsyncRedis.invoke一致
+        """
+        if self.__master is None:
+            yield self.discover()
+
+        cmds = list(iter_redis_cmds)
+        replica = None
+        if self.__read_from_replicas and self.__replicas and cmds and \
+                all(cmd_args(_)[0].upper() in _READONLY_CMDS for _ in cmds):
+            replica = self.__pick_replica()
+
+        if replica is None:
+            try:
+                result = yield self.__master.invoke(cmds, **kwargs)
+            except RedisConnectionError:
+                #主库不可达时重新查询，本次请求仍然失败
+                self.discover()
+                raise
+            raise gen.Return(result)
+
+        self.__replicas[replica] += 1
+        try:
+            result = yield replica.invoke(cmds, **kwargs)
+        finally:
+            if replica in self.__replicas:
+                self.__replicas[replica] -= 1
+        raise gen.Return(result)
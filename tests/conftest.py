@@ -0,0 +1,15 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import os
+import sys
+import types
+
+#仓库根目录即ioloop_redis包(模块间为相对导入)，测试时以该名称注册
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'ioloop_redis' not in sys.modules:
+    _package = types.ModuleType('ioloop_redis')
+    _package.__path__ = [ROOT]
+    sys.modules['ioloop_redis'] = _package
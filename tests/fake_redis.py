@@ -0,0 +1,170 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import hashlib
+import socket
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+
+
+class Status(str):
+    pass
+
+
+class Error(str):
+    pass
+
+
+OK = Status('OK')
+
+
+def encode(value):
+    if value is None:
+        return '$-1\r\n'
+    if isinstance(value, Status):
+        return '+%s\r\n' % value
+    if isinstance(value, Error):
+        return '-%s\r\n' % value
+    if isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    if isinstance(value, (list, tuple)):
+        return '*%d\r\n' % len(value) + ''.join(encode(_) for _ in value)
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+
+class FakeRedis(TCPServer):
+    """
+    测试用的单机redis，只实现测试用到的字符串、列表、事务及连接指令
+
+    commands记录收到的指令名，按连接顺序
+    """
+    def __init__(self, io_loop):
+        TCPServer.__init__(self, io_loop=io_loop)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        sock.setblocking(0)
+        self.add_sockets([sock])
+        self.port = sock.getsockname()[1]
+        self.data = {}
+        self.commands = []
+        self.scripts = {}
+        #订阅过频道的连接
+        self.subscribers = []
+        self.__client_ids = 0
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        #事务中已入队的指令，None表示不在事务中
+        queued = None
+        try:
+            while True:
+                line = yield stream.read_until('\r\n')
+                args = []
+                for _ in xrange(int(line[1:-2])):
+                    header = yield stream.read_until('\r\n')
+                    data = yield stream.read_bytes(int(header[1:-2]) + 2)
+                    args.append(data[:-2])
+                name = args[0].upper()
+                self.commands.append(name)
+                if 'MULTI' == name:
+                    queued, reply = [], OK
+                elif 'EXEC' == name:
+                    reply = [self.run(_) for _ in queued]
+                    queued = None
+                elif queued is not None:
+                    queued.append(args)
+                    reply = Status('QUEUED')
+                elif 'SUBSCRIBE' == name:
+                    self.subscribers.append(stream)
+                    reply = ['subscribe', args[1], 1]
+                elif name in ('BLPOP', 'BLMOVE'):
+                    reply = yield self.__blocking(stream, args)
+                else:
+                    reply = self.run(args)
+                yield stream.write(encode(reply))
+        except StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def __blocking(self, stream, args):
+        timeout = float(args[-1])
+        args = ['LPOP', args[1]] if 'BLPOP' == args[0].upper() else ['LMOVE'] + args[1: -1]
+        waited = 0.0
+        while not stream.closed():
+            reply = self.run(args)
+            if reply is not None:
+                raise gen.Return([args[1], reply] if 'LPOP' == args[0] else reply)
+            if timeout and waited >= timeout:
+                break
+            yield gen.sleep(0.01)
+            waited += 0.01
+        raise gen.Return(None)
+
+    def run(self, args):
+        name = args[0].upper()
+        data = self.data
+        if name in ('PING',):
+            return Status('PONG')
+        if 'CLIENT' == name and 'ID' == args[1].upper():
+            self.__client_ids += 1
+            return self.__client_ids
+        if name in ('SELECT', 'AUTH', 'CLIENT', 'WATCH', 'UNWATCH'):
+            return OK
+        if 'SCRIPT' == name:
+            sha = hashlib.sha1(args[2]).hexdigest()
+            self.scripts[sha] = args[2]
+            return sha
+        if 'GET' == name:
+            return data.get(args[1])
+        if 'SET' == name:
+            data[args[1]] = args[2]
+            return OK
+        if 'GETSET' == name:
+            old = data.get(args[1])
+            data[args[1]] = args[2]
+            return old
+        if 'DEL' == name:
+            return sum(1 for _ in args[1:] if data.pop(_, None) is not None)
+        if name in ('LPUSH', 'RPUSH'):
+            items = data.setdefault(args[1], [])
+            for value in args[2:]:
+                if 'LPUSH' == name:
+                    items.insert(0, value)
+                else:
+                    items.append(value)
+            return len(items)
+        if name in ('LPOP', 'RPOP'):
+            items = data.get(args[1])
+            if not items:
+                return None
+            return items.pop(0 if 'LPOP' == name else -1)
+        if 'LMOVE' == name:
+            items = data.get(args[1])
+            if not items:
+                return None
+            where_from = args[3].upper() if len(args) > 3 else 'LEFT'
+            where_to = args[4].upper() if len(args) > 4 else 'RIGHT'
+            value = items.pop(0 if 'LEFT' == where_from else -1)
+            target = data.setdefault(args[2], [])
+            if 'LEFT' == where_to:
+                target.insert(0, value)
+            else:
+                target.append(value)
+            return value
+        if 'LREM' == name:
+            items = data.get(args[1], [])
+            if args[3] in items:
+                items.remove(args[3])
+                return 1
+            return 0
+        if 'LRANGE' == name:
+            items = data.get(args[1], [])
+            end = int(args[3])
+            return items[int(args[2]): None if -1 == end else end + 1]
+        if 'LLEN' == name:
+            return len(data.get(args[1], []))
+        return Error("ERR unknown command '%s'" % args[0])
@@ -0,0 +1,34 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+from ioloop_redis.redis_cache import ClientCache
+
+
+def _put(cache, cmd, key, value):
+    cache.put(cmd, key, value, cache.begin(key))
+
+
+def test_mutable_values_are_not_shared():
+    cache = ClientCache()
+    cache.start_tracking()
+    value = {'f': ['a', 'b'], 'g': set(['c'])}
+    _put(cache, 'HGETALL h', 'h', value)
+    value['f'].append('x')
+
+    hit, first = cache.get('HGETALL h')
+    assert hit
+    first['g'].add('y')
+    first['h'] = 'z'
+    assert {'f': ['a', 'b'], 'g': set(['c'])} == cache.get('HGETALL h')[1]
+
+
+def test_max_bytes_counts_containers():
+    cache = ClientCache(max_bytes=100)
+    cache.start_tracking()
+    _put(cache, 'HGETALL h', 'h', {'f': 'v' * 60})
+    _put(cache, 'SMEMBERS s', 's', set(['m' * 60]))
+    assert {'entries': 1, 'bytes': 60, 'evictions': 1} == \
+        dict((k, v) for k, v in cache.stats().iteritems() if k in ('entries', 'bytes', 'evictions'))
+    assert not cache.get('HGETALL h')[0]
+    assert cache.get('SMEMBERS s')[0]
@@ -0,0 +1,246 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import logging
+import socket
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+
+from ioloop_redis.redis_cluster import AsyncRedisCluster, key_slot
+from ioloop_redis.redis_encode import redis_get, redis_set
+
+
+def _encode(value):
+    if value is None:
+        return '$-1\r\n'
+    if isinstance(value, _Error):
+        return '-%s\r\n' % value
+    if isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    if isinstance(value, list):
+        return '*%d\r\n' % len(value) + ''.join(_encode(_) for _ in value)
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+
+class _Error(str):
+    pass
+
+
+class FakeNode(TCPServer):
+    """
+    只实现路由相关指令的cluster节点
+
+    slots为[(start, end, port), ...]，不属于本节点的key返回MOVED；
+    ask_slots中的slot返回ASK，带ASKING时直接执行
+    """
+    def __init__(self, io_loop):
+        TCPServer.__init__(self, io_loop=io_loop)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(128)
+        sock.setblocking(0)
+        self.add_sockets([sock])
+        self.port = sock.getsockname()[1]
+        self.io_loop = io_loop
+        self.data = {}
+        self.slots = []
+        #slot --> port
+        self.ask_slots = {}
+        self.slots_error = False
+        self.slots_delay = 0
+        self.slots_calls = 0
+        #(指令, key)
+        self.executed = []
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        asking = False
+        try:
+            while True:
+                line = yield stream.read_until('\r\n')
+                args = []
+                for _ in xrange(int(line[1:-2])):
+                    header = yield stream.read_until('\r\n')
+                    data = yield stream.read_bytes(int(header[1:-2]) + 2)
+                    args.append(data[:-2])
+                if 'CLUSTER' == args[0].upper():
+                    reply = yield self.__cluster_slots()
+                else:
+                    reply = self.__run(args, asking)
+                asking = 'ASKING' == args[0].upper()
+                yield stream.write(_encode(reply))
+        except StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def __cluster_slots(self):
+        self.slots_calls += 1
+        if self.slots_delay:
+            yield gen.sleep(self.slots_delay)
+        if self.slots_error:
+            raise gen.Return(_Error('ERR cluster support disabled'))
+        raise gen.Return([[start, end, ['127.0.0.1', port, 'id']] for start, end, port in self.slots])
+
+    def __run(self, args, asking):
+        name = args[0].upper()
+        if name not in ('GET', 'SET'):
+            return 'OK'
+        slot = key_slot(args[1])
+        if not asking:
+            if slot in self.ask_slots:
+                return _Error('ASK %d 127.0.0.1:%d' % (slot, self.ask_slots[slot]))
+            for start, end, port in self.slots:
+                if start <= slot <= end and port != self.port:
+                    return _Error('MOVED %d 127.0.0.1:%d' % (slot, port))
+        self.executed.append((name, args[1]))
+        if 'GET' == name:
+            return self.data.get(args[1])
+        self.data[args[1]] = args[2]
+        return 'OK'
+
+
+def _split_keys():
+    """
+    :return: 分别属于slot 0-8191与8192-16383的key
+    """
+    low = [_ for _ in ('k%d' % i for i in xrange(100)) if key_slot(_) < 8192]
+    high = [_ for _ in ('k%d' % i for i in xrange(100)) if key_slot(_) >= 8192]
+    return low[:3], high[:3]
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+@pytest.fixture
+def nodes(io_loop):
+    a, b = FakeNode(io_loop), FakeNode(io_loop)
+    a.slots = b.slots = [(0, 8191, a.port), (8192, 16383, b.port)]
+    yield a, b
+    a.stop()
+    b.stop()
+
+
+def _cluster(a, io_loop):
+    return AsyncRedisCluster([('127.0.0.1', a.port)], io_loop=io_loop)
+
+
+def test_pipeline_is_split_by_node(io_loop, nodes):
+    a, b = nodes
+    low, high = _split_keys()
+    keys = [low[0], high[0], low[1], high[1]]
+    cluster = _cluster(a, io_loop)
+
+    @gen.coroutine
+    def run():
+        yield cluster.invoke([redis_set(_, _ + 'v') for _ in keys], active_trans=False)
+        result = yield cluster.invoke([redis_get(_) for _ in keys], active_trans=False)
+        raise gen.Return(result)
+
+    assert io_loop.run_sync(run, timeout=5) == tuple(_ + 'v' for _ in keys)
+    assert sorted(a.data) == sorted(low[:2])
+    assert sorted(b.data) == sorted(high[:2])
+
+
+def test_moved_retries_on_target_and_refreshes_once(io_loop, nodes):
+    a, b = nodes
+    low, _ = _split_keys()
+    cluster = _cluster(a, io_loop)
+
+    @gen.coroutine
+    def run():
+        yield cluster.invoke([redis_set(low[0], 'x')], active_trans=False)
+        #reshard：全部slot迁到b
+        b.data.update(a.data)
+        a.data.clear()
+        a.slots = b.slots = [(0, 16383, b.port)]
+        a.slots_delay = b.slots_delay = 0.05
+        calls = a.slots_calls + b.slots_calls
+        #同一轮及并发请求的多个MOVED只触发一次后台刷新
+        result = yield [
+            cluster.invoke([redis_get(_) for _ in low], active_trans=False),
+            cluster.invoke([redis_get(low[0])], active_trans=False),
+        ]
+        yield gen.sleep(0.1)
+        raise gen.Return((result, a.slots_calls + b.slots_calls - calls))
+
+    result, refreshes = io_loop.run_sync(run, timeout=5)
+    assert result == [('x', None, None), 'x']
+    assert 1 == refreshes
+    assert not a.executed[1:]
+
+
+def test_ask_sends_asking_without_updating_slots(io_loop, nodes):
+    a, b = nodes
+    low, _ = _split_keys()
+    slot = key_slot(low[0])
+    a.ask_slots[slot] = b.port
+    cluster = _cluster(a, io_loop)
+
+    @gen.coroutine
+    def run():
+        first = yield cluster.invoke([redis_set(low[0], 'x'), redis_set(low[1], 'y')], active_trans=False)
+        #ASK只对本次请求生效，迁移完成前仍先发往a
+        del a.ask_slots[slot]
+        second = yield cluster.invoke([redis_get(low[0])], active_trans=False)
+        raise gen.Return((first, second))
+
+    first, second = io_loop.run_sync(run, timeout=5)
+    assert first == ('OK', 'OK')
+    assert b.data == {low[0]: 'x'}
+    assert a.data == {low[1]: 'y'}
+    assert second is None
+    assert ('GET', low[0]) in a.executed
+
+
+def test_background_refresh_failure_is_logged(io_loop, nodes, caplog):
+    a, b = nodes
+    low, _ = _split_keys()
+    cluster = _cluster(a, io_loop)
+
+    @gen.coroutine
+    def run():
+        yield cluster.invoke([redis_set(low[0], 'x')], active_trans=False)
+        b.data.update(a.data)
+        a.slots = b.slots = [(0, 16383, b.port)]
+        a.slots_error = b.slots_error = True
+        result = yield cluster.invoke([redis_get(low[0])], active_trans=False)
+        yield gen.sleep(0.05)
+        raise gen.Return(result)
+
+    with caplog.at_level(logging.WARNING):
+        assert 'x' == io_loop.run_sync(run, timeout=5)
+    assert any('background cluster slots refresh failed' in _.getMessage() for _ in caplog.records)
+
+
+def test_refresh_drops_slots_missing_from_reply(io_loop, nodes):
+    a, b = nodes
+    _, high = _split_keys()
+    cluster = _cluster(a, io_loop)
+
+    @gen.coroutine
+    def run():
+        yield cluster.invoke([redis_set(high[0], 'x')], active_trans=False)
+        #b下线期间a的应答中只有0-8191，8192-16383暂时没有主节点
+        a.slots = [(0, 8191, a.port)]
+        b.slots_error = True
+        yield cluster.refresh_slots()
+        nodes = yield cluster.nodes()
+        result = yield cluster.invoke([redis_get(high[0])], active_trans=False)
+        raise gen.Return((nodes, result))
+
+    nodes, result = io_loop.run_sync(run, timeout=5)
+    assert 1 == len(nodes)
+    assert result is None
+    assert ('GET', high[0]) in a.executed
+    assert ('GET', high[0]) not in b.executed
@@ -0,0 +1,137 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ioloop_redis.redis_client import AsyncRedis
+from ioloop_redis.redis_cache import ClientCache
+from ioloop_redis.redis_encode import redis_blpop, redis_get, redis_rpush, redis_set
+from ioloop_redis.redis_resp import RawReply, RespReader
+
+from fake_redis import FakeRedis
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+@pytest.fixture
+def server(io_loop):
+    server = FakeRedis(io_loop)
+    yield server
+    server.stop()
+
+
+def _pool(client):
+    return client._AsyncRedis__bind()
+
+
+def test_register_script_is_not_counted_as_a_request(io_loop, server):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), io_loop=io_loop)
+
+    @gen.coroutine
+    def run():
+        yield client.invoke([redis_get('k')])
+        client.register_script('return 1')
+        for _ in xrange(3):
+            yield client.invoke([redis_get('k')])
+        yield gen.sleep(0.05)
+
+    io_loop.run_sync(run, timeout=5)
+    assert 0 == _pool(client).inflight()
+    assert 1 == _pool(client).size()
+    assert 1 == server.commands.count('SCRIPT')
+
+
+def test_register_script_skips_blocking_conn(io_loop, server):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), pin_blocking=True, io_loop=io_loop)
+
+    @gen.coroutine
+    def run():
+        yield client.invoke([redis_get('k')])
+        blocked = client.invoke([redis_blpop(1, 'jobs')], active_trans=False, blocking=True)
+        yield gen.sleep(0.05)
+        client.register_script('return 1')
+        yield client.invoke([redis_rpush('jobs', 'a')])
+        popped = yield blocked
+        yield gen.sleep(0.05)
+        raise gen.Return(popped)
+
+    assert ('jobs', 'a') == io_loop.run_sync(run, timeout=5)
+    assert 0 == _pool(client).inflight()
+    assert 1 == server.commands.count('SCRIPT')
+
+
+def test_tracking_redirect_is_not_counted_as_a_request(io_loop, server):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), client_cache=ClientCache(),
+                        pin_blocking=True, reconnect_delay=0.01, io_loop=io_loop)
+
+    @gen.coroutine
+    def run():
+        yield client.invoke([redis_get('k')])
+        blocked = client.invoke([redis_blpop(1, 'jobs')], active_trans=False, blocking=True)
+        yield gen.sleep(0.1)
+        #失效消息连接断开重连后，再次向已有连接发送CLIENT TRACKING
+        for stream in server.subscribers:
+            stream.close()
+        yield gen.sleep(0.2)
+        for _ in xrange(3):
+            yield client.invoke([redis_get('k')])
+        yield client.invoke([redis_rpush('jobs', 'a')])
+        yield blocked
+        yield gen.sleep(0.05)
+
+    io_loop.run_sync(run, timeout=5)
+    assert 2 == len(server.subscribers)
+    assert 0 == _pool(client).inflight()
+    assert 1 == _pool(client).size()
+
+
+class _ParsedReader(RespReader):
+    """
+    与HiredisReader一样不支持截取原始字节
+    """
+    raw_capture = False
+
+    def set_raw(self, min_items, min_bytes):
+        pass
+
+
+class _RecordingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        ThreadPoolExecutor.__init__(self, 1)
+        self.raw = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.raw.append(isinstance(args[0], RawReply))
+        return ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+
+
+def test_raw_offload_switches_reader_without_raw_capture(io_loop, server):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), reader_cls=_ParsedReader, io_loop=io_loop)
+    executor = _RecordingExecutor()
+    kwargs = {'executor': executor, 'deserializer': str.upper, 'offload_bytes': 1, 'active_trans': False}
+
+    @gen.coroutine
+    def run():
+        yield client.invoke([redis_set('k', 'value')])
+        #有待收的应答时推迟切换，本次仍由原解析器解析
+        result = yield [client.invoke([redis_get('k')]), client.invoke([redis_get('k')], **kwargs)]
+        result.append((yield client.invoke([redis_get('k')], **kwargs)))
+        raise gen.Return(result)
+
+    try:
+        assert ['value', 'VALUE', 'VALUE'] == io_loop.run_sync(run, timeout=5)
+    finally:
+        executor.shutdown()
+    assert [False, True] == executor.raw
+    assert [RespReader] == [type(_._RedisConnection__reader) for _ in _pool(client).connections()]
@@ -0,0 +1,67 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ioloop_redis.redis_client import AsyncRedis
+from ioloop_redis.redis_queue import QueueConsumer
+
+from fake_redis import FakeRedis
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+@pytest.fixture
+def server(io_loop):
+    server = FakeRedis(io_loop)
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('processing', [None, 'jobs:processing'])
+def test_poison_item_is_dead_lettered(io_loop, server, processing):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), io_loop=io_loop)
+    server.data['jobs'] = ['bad', 'a', 'b']
+    handled = []
+
+    def handle(item):
+        handled.append(item)
+        if 'bad' == item:
+            raise ValueError(item)
+
+    consumer = QueueConsumer(client, 'jobs', handle, processing=processing, max_attempts=3,
+                             dead_letter='jobs:dead', error_callback=lambda item, exc_info: None)
+
+    @gen.coroutine
+    def run():
+        consumer.start()
+        while not server.data.get('jobs:dead'):
+            yield gen.sleep(0.01)
+        yield consumer.stop()
+
+    io_loop.run_sync(run, timeout=5)
+    #失败的元素放回表尾，不阻塞其后的元素
+    assert ['bad', 'a', 'b', 'bad', 'bad'] == handled
+    assert ['bad'] == server.data['jobs:dead']
+    assert not server.data['jobs']
+    assert not server.data.get('jobs:processing')
+    stats = consumer.stats()
+    assert (3, 2, 2, 1) == (stats['failed'], stats['requeued'], stats['acked'], stats['dead_lettered'])
+
+
+def test_invalid_dead_letter(io_loop, server):
+    client = AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), io_loop=io_loop)
+    with pytest.raises(ValueError):
+        QueueConsumer(client, 'jobs', lambda item: None, max_attempts=0)
+    with pytest.raises(ValueError):
+        QueueConsumer(client, 'jobs', lambda item: None, processing='jobs:processing', dead_letter='jobs:processing')
@@ -0,0 +1,143 @@
+#coding:utf-8
+"""
+RespReader与HiredisReader对同一语料、不同分段方式的输出必须一致
+"""
+
+from __future__ import absolute_import
+
+import pytest
+from ioloop_redis.redis_resp import RespReader, HiredisReader, RawReply, PushReply, decode_raw, hiredis
+from ioloop_redis.redis_error import ResponseError, WrongTypeError
+
+
+FRAGMENT_SIZES = (1, 7, 64, 4096)
+
+_MEMBERS = tuple('member:%d' % _ for _ in xrange(300))
+
+#名称 --> (应答buf, 期望的应答列表)
+RESP2_CORPUS = {
+    'simple': ('+OK\r\n+QUEUED\r\n', ['OK', 'QUEUED']),
+    'integer': (':0\r\n:-12\r\n:9223372036854775807\r\n', [0, -12, 9223372036854775807]),
+    'bulk': ('$3\r\nabc\r\n$0\r\n\r\n$6\r\na\r\nb\r\n\r\n', ['abc', '', 'a\r\nb\r\n']),
+    'nulls': ('$-1\r\n*-1\r\n*2\r\n$-1\r\n*-1\r\n', [None, None, (None, None)]),
+    'errors': ('-ERR unknown command\r\n-WRONGTYPE Operation\r\n*2\r\n-ERR x\r\n:1\r\n',
+               [ResponseError('ERR unknown command'), WrongTypeError('WRONGTYPE Operation'),
+                (ResponseError('ERR x'), 1)]),
+    'empty_array': ('*0\r\n', [()]),
+    'nested': ('*3\r\n*2\r\n$1\r\na\r\n*1\r\n:1\r\n*0\r\n$1\r\nb\r\n', [(('a', (1,)), (), 'b')]),
+    'scan': ('*2\r\n$2\r\n17\r\n*2\r\n$1\r\nx\r\n$1\r\ny\r\n', [('17', ('x', 'y'))]),
+    'large_array': ('*%d\r\n' % len(_MEMBERS) + ''.join('$%d\r\n%s\r\n' % (len(_), _) for _ in _MEMBERS),
+                    [_MEMBERS]),
+    'large_bulk': ('$20000\r\n' + 'x' * 20000 + '\r\n', ['x' * 20000]),
+}
+
+RESP3_CORPUS = {
+    'map': ('%2\r\n+a\r\n:1\r\n+b\r\n*1\r\n_\r\n', [{'a': 1, 'b': (None,)}]),
+    'set': ('~3\r\n+a\r\n+b\r\n+a\r\n', [set(['a', 'b'])]),
+    'null': ('_\r\n', [None]),
+    'double': (',1.5\r\n,-0.25\r\n,inf\r\n', [1.5, -0.25, float('inf')]),
+    'bool': ('#t\r\n#f\r\n', [True, False]),
+    'big_number': ('(3492890328409238509324850943850943825024385\r\n',
+                   [3492890328409238509324850943850943825024385]),
+    'verbatim': ('=15\r\ntxt:Some string\r\n', ['Some string']),
+    'blob_error': ('!21\r\nSYNTAX invalid syntax\r\n', [ResponseError('SYNTAX invalid syntax')]),
+    'push': ('>3\r\n$10\r\ninvalidate\r\n*1\r\n$1\r\nk\r\n:1\r\n+OK\r\n',
+             [PushReply(('invalidate', ('k',), 1)), 'OK']),
+    'attribute': ('|1\r\n+ttl\r\n:3600\r\n*2\r\n:1\r\n:2\r\n', [(1, 2)]),
+    'nested_map': ('*2\r\n%1\r\n+k\r\n~1\r\n:1\r\n#t\r\n', [({'k': set([1])}, True)]),
+}
+
+
+def _comparable(reply):
+    """
+    ResponseError不能直接比较，转为(类型, 内容)；同时区分PushReply与tuple
+    """
+    if isinstance(reply, ResponseError):
+        return type(reply), str(reply)
+    if isinstance(reply, tuple):
+        return type(reply), tuple(_comparable(_) for _ in reply)
+    if isinstance(reply, dict):
+        return dict((k, _comparable(v)) for k, v in reply.iteritems())
+    return type(reply), reply
+
+
+def _fragments(s, size):
+    return [s[i: i + size] for i in xrange(0, len(s), size)]
+
+
+def _parse(reader, chunks, raw=False):
+    replies = []
+    if raw:
+        reader.set_raw(0, 0)
+    for chunk in chunks:
+        reader.feed(chunk)
+        while True:
+            ok, reply = reader.gets()
+            if not ok:
+                break
+            if isinstance(reply, RawReply):
+                reply = decode_raw(reply, reader_cls=RespReader)
+            replies.append(reply)
+            if raw:
+                reader.set_raw(0, 0)
+    return replies
+
+
+def _hiredis_resp3():
+    if hiredis is None:
+        return False
+    reader = hiredis.Reader()
+    try:
+        reader.feed('_\r\n')
+        reader.gets()
+    except hiredis.ProtocolError:
+        return False
+    return True
+
+
+def _readers(resp3):
+    readers = [
+        pytest.param(lambda chunks: _parse(RespReader(), chunks), id='RespReader'),
+        pytest.param(lambda chunks: _parse(RespReader(), chunks, raw=True), id='RespReader.set_raw'),
+    ]
+    if hiredis is None:
+        reason = 'hiredis not installed'
+    elif resp3 and not _hiredis_resp3():
+        reason = 'installed hiredis does not support RESP3'
+    else:
+        reason = None
+    readers.append(pytest.param(lambda chunks: _parse(HiredisReader(), chunks), id='HiredisReader',
+                                marks=pytest.mark.skipif(reason is not None, reason=reason or '')))
+    return readers
+
+
+def _cases(corpus):
+    return [pytest.param(buf, expect, id=name) for name, (buf, expect) in sorted(corpus.iteritems())]
+
+
+@pytest.mark.parametrize('size', FRAGMENT_SIZES)
+@pytest.mark.parametrize('parse', _readers(resp3=False))
+@pytest.mark.parametrize('buf, expect', _cases(RESP2_CORPUS))
+def test_resp2(buf, expect, parse, size):
+    assert [_comparable(_) for _ in parse(_fragments(buf, size))] == [_comparable(_) for _ in expect]
+
+
+@pytest.mark.parametrize('size', FRAGMENT_SIZES)
+@pytest.mark.parametrize('parse', _readers(resp3=True))
+@pytest.mark.parametrize('buf, expect', _cases(RESP3_CORPUS))
+def test_resp3(buf, expect, parse, size):
+    assert [_comparable(_) for _ in parse(_fragments(buf, size))] == [_comparable(_) for _ in expect]
+
+
+@pytest.mark.parametrize('size', FRAGMENT_SIZES)
+def test_readers_agree_on_concatenated_corpus(size):
+    """
+    全部RESP2语料拼接后连续解析，两种解析器逐条一致
+    """
+    if hiredis is None:
+        pytest.skip('hiredis not installed')
+    buf = ''.join(buf for buf, _ in sorted(RESP2_CORPUS.itervalues()))
+    chunks = _fragments(buf, size)
+    expect = [_comparable(_) for _ in _parse(RespReader(), chunks)]
+    assert [_comparable(_) for _ in _parse(HiredisReader(), chunks)] == expect
+    assert len(expect) == sum(len(replies) for _, replies in RESP2_CORPUS.itervalues())
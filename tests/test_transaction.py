@@ -0,0 +1,58 @@
+#coding:utf-8
+
+from __future__ import absolute_import
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from ioloop_redis.redis_client import AsyncRedis
+from ioloop_redis.redis_codec import KeyCodecs, ValueCodec
+from ioloop_redis.redis_encode import redis_get
+
+from fake_redis import FakeRedis
+
+
+@pytest.fixture
+def io_loop():
+    loop = IOLoop()
+    loop.make_current()
+    yield loop
+    loop.clear_current()
+    loop.close(all_fds=True)
+
+
+@pytest.fixture
+def server(io_loop):
+    server = FakeRedis(io_loop)
+    yield server
+    server.stop()
+
+
+def _client(server, io_loop):
+    codecs = KeyCodecs()
+    codecs.register('user:', ValueCodec('json'))
+    return AsyncRedis(redis_tuple=('127.0.0.1', server.port, 0, None), value_codecs=codecs, io_loop=io_loop)
+
+
+@pytest.mark.parametrize('count', [1, 2])
+def test_transaction_decodes_exec_reply(io_loop, server, count):
+    client = _client(server, io_loop)
+
+    @gen.coroutine
+    def run():
+        yield client.invoke([('SET', 'user:1', {'n': 1})])
+
+        @gen.coroutine
+        def update(pinned):
+            value = yield pinned.invoke([redis_get('user:1')])
+            cmds = [('GETSET', 'user:1', {'n': value['n'] + 1})]
+            raise gen.Return(cmds + [('SET', 'plain', 'x')] * (count - 1))
+
+        result = yield client.transaction(update, ['user:1'])
+        value = yield client.invoke([redis_get('user:1')])
+        raise gen.Return((result, value))
+
+    result, value = io_loop.run_sync(run, timeout=5)
+    assert ({u'n': 1},) + ('OK',) * (count - 1) == result
+    assert {u'n': 2} == value